@@ -0,0 +1,873 @@
+"""
+Benchmarks for the POS hot paths.
+
+    python bench_pos.py sale --database miscelanea_bench --products 2000 --runs 50
+    python bench_pos.py import --database miscelanea_bench --rows 20000
+    python bench_pos.py search --products 100000
+    python bench_pos.py restock --products 100000 --days 730
+    python bench_pos.py money --lines 100000
+    python bench_pos.py registers --database miscelanea_bench --registers 8 --seconds 20
+    python bench_pos.py --backend sqlite suite --scale small --save-baseline
+    python bench_pos.py --backend sqlite suite --scale small
+    python bench_pos.py --backend sqlite service --spawn --connections 64 --seconds 20
+
+The database benchmarks run against the DBConfig MySQL server, or with
+--backend sqlite against a local file (search, restock and money run in memory). The target
+database is created and seeded if it does not exist. Never point this at the
+production database: every run books real sales rows.
+
+suite times get_all_products, create_sale, get_sales, POSApp startup and the
+Treeview refreshes (on a withdrawn Tk root; skipped without a display) at a fixed scale and exits
+with status 1 when p50 or p95 of any case got slower than the stored baseline
+allows. Baselines are per machine, backend and scale: record one with
+--save-baseline on the reference box before comparing.
+"""
+import argparse
+import asyncio
+import csv
+import itertools
+import json
+import os
+import random
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+import uuid
+try:
+    import tkinter as tk
+except ImportError:  # headless server without Tk: the GUI cases are skipped
+    tk = None
+from datetime import date, datetime, timedelta
+from decimal import Decimal
+from urllib.parse import urlsplit
+
+from pos import (BACKENDS, DBConfig, DBHandler, Money, POSApp, ProductCatalog, RestockReport, StockError,
+                 import_products_csv, load_daily_sales, money_text)
+
+# ---------------------------
+# Seeding
+# ---------------------------
+SCALES = {
+    # name: (products, sale detail rows)
+    "small": (1000, 10_000),
+    "medium": (10_000, 1_000_000),
+    "large": (100_000, 10_000_000),
+}
+
+def make_config(args, database=None):
+    cfg = DBConfig()
+    cfg.BACKEND = args.backend
+    cfg.DATABASE = database or args.database
+    cfg.SQLITE_PATH = args.sqlite_path or os.path.join(tempfile.gettempdir(), f"{cfg.DATABASE}.sqlite3")
+    return cfg
+
+def open_bench_db(cfg):
+    db = DBHandler(cfg)
+    db.report_error = lambda title, msg: print(f"{title}: {msg}")
+    return db
+
+def ensure_database(cfg, n_products):
+    if cfg.BACKEND == "mysql":
+        import mysql.connector
+        con = mysql.connector.connect(host=cfg.HOST, user=cfg.USER, password=cfg.PASSWORD)
+        con.cursor().execute(f"CREATE DATABASE IF NOT EXISTS `{cfg.DATABASE}`")
+        con.close()
+    db = open_bench_db(cfg)
+    db.ensure_schema()
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*) FROM producto")
+        have = cur.fetchone()[0]
+        rows = []
+        for i in range(have, n_products):
+            compra = Decimal(random.randint(100, 5000)) / 100
+            rows.append((f"Producto {i}", "bench", str(compra), str(compra * Decimal("1.3")), 10**9, f"BENCH-{i:07d}"))
+            if len(rows) == 1000 or i == n_products - 1:
+                cur.executemany("INSERT INTO producto (nombre, categoria, precio_compra, precio_venta, cantidad, sku) VALUES (%s,%s,%s,%s,%s,%s)", rows)
+                con.commit()
+                rows = []
+        cur.execute("SELECT id_producto, precio_venta FROM producto ORDER BY id_producto LIMIT %s", (n_products,))
+        return cur.fetchall()
+    finally:
+        con.close()
+        db.close()
+
+def ensure_sales(cfg, products, n_details, days=365):
+    """Tops the sales history up to n_details detail rows, spread over the last `days` days."""
+    db = open_bench_db(cfg)
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT COUNT(*) FROM venta_detalle")
+        have = cur.fetchone()[0]
+        if have >= n_details:
+            return have
+        cur.execute("SELECT COALESCE(MAX(id_venta), 0) FROM venta")
+        next_id = cur.fetchone()[0] + 1
+        now = datetime.now().replace(microsecond=0)
+        t0, reported = time.perf_counter(), have
+        while have < n_details:
+            sales, details = [], []
+            while len(details) < 20000 and have + len(details) < n_details:
+                total = Decimal("0.00")
+                for idp, price in random.sample(products, min(len(products), random.randint(1, 8))):
+                    qty = random.randint(1, 3)
+                    subtotal = price * qty
+                    details.append((next_id, idp, qty, str(price), str(subtotal)))
+                    total += subtotal
+                sales.append((next_id, now - timedelta(seconds=random.randrange(days * 86400)), str(total)))
+                next_id += 1
+            cur.executemany("INSERT INTO venta (id_venta, fecha, total) VALUES (%s,%s,%s)", sales)
+            cur.executemany("INSERT INTO venta_detalle (id_venta, id_producto, cantidad, precio_unitario, subtotal) "
+                            "VALUES (%s,%s,%s,%s,%s)", details)
+            con.commit()
+            have += len(details)
+            if have - reported >= 500_000 or have >= n_details:
+                print(f"  seeded {have} detail rows ({time.perf_counter() - t0:.0f}s)")
+                reported = have
+    finally:
+        con.close()
+    # The reports read the rollup tables; bring them in line with the seeded history
+    db.rebuild_rollup()
+    db.close()
+    return have
+
+def last_sale_id(db):
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT COALESCE(MAX(id_venta), 0) FROM venta")
+        return cur.fetchone()[0]
+    finally:
+        con.close()
+
+def discard_sales_after(db, sale_id):
+    """Deletes the sales a run booked, so the next run measures the same history."""
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT DATE(MIN(fecha)) FROM venta WHERE id_venta > %s", (sale_id,))
+        first = db.backend.to_date(cur.fetchone()[0])
+        cur.execute("DELETE FROM venta_detalle WHERE id_venta > %s", (sale_id,))
+        cur.execute("DELETE FROM venta WHERE id_venta > %s", (sale_id,))
+        con.commit()
+    finally:
+        con.close()
+    if first is not None:
+        db.rebuild_rollup(first)
+
+# ---------------------------
+# Baseline: the original one-round-trip-per-line sale
+# ---------------------------
+def create_sale_per_line(db, items):
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        for it in items:
+            cur.execute("SELECT cantidad FROM producto WHERE id_producto=%s FOR UPDATE", (it['id_producto'],))
+            row = cur.fetchone()
+            if not row:
+                raise ValueError(f"Producto ID {it['id_producto']} no existe")
+            if it['cantidad'] > row[0]:
+                raise ValueError(f"Stock insuficiente para producto ID {it['id_producto']} (disponible {row[0]})")
+        total = Decimal('0.00')
+        for it in items:
+            it['subtotal'] = (Decimal(str(it['precio_unitario'])) * Decimal(it['cantidad'])).quantize(Decimal('0.01'))
+            total += it['subtotal']
+        cur.execute(f"INSERT INTO venta (fecha, total) VALUES ({db.backend.NOW}, %s)", (str(total),))
+        sale_id = cur.lastrowid
+        for it in items:
+            cur.execute("""
+                INSERT INTO venta_detalle (id_venta, id_producto, cantidad, precio_unitario, subtotal)
+                VALUES (%s,%s,%s,%s,%s)
+            """, (sale_id, it['id_producto'], it['cantidad'], str(it['precio_unitario']), str(it['subtotal'])))
+            cur.execute("UPDATE producto SET cantidad = cantidad - %s WHERE id_producto=%s", (it['cantidad'], it['id_producto']))
+        con.commit()
+        return sale_id
+    except Exception:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+# ---------------------------
+# Benchmarks
+# ---------------------------
+def random_cart(products, size):
+    return [
+        {'id_producto': idp, 'cantidad': random.randint(1, 3), 'precio_unitario': str(price)}
+        for idp, price in random.sample(products, size)
+    ]
+
+def percentile(samples, q):
+    """Nearest-rank percentile of an already sorted list."""
+    if not samples:
+        return float("nan")
+    return samples[min(len(samples) - 1, int(len(samples) * q))]
+
+def time_calls(fn, carts):
+    samples = []
+    for cart in carts:
+        t0 = time.perf_counter()
+        if fn(cart) is None:
+            raise RuntimeError("sale failed during benchmark")
+        samples.append((time.perf_counter() - t0) * 1000)
+    return samples
+
+def bench_sale(args):
+    cfg = make_config(args)
+    products = ensure_database(cfg, args.products)
+    db = open_bench_db(cfg)
+    print(f"{'cart':>5} {'per-line p50':>13} {'batched p50':>12} {'speedup':>8}")
+    for size in args.cart_sizes:
+        carts = [random_cart(products, size) for _ in range(args.runs)]
+        # Same carts for both paths; warm the pool and buffer pool first
+        time_calls(lambda c: create_sale_per_line(db, [dict(i) for i in c]), carts[:3])
+        per_line = time_calls(lambda c: create_sale_per_line(db, [dict(i) for i in c]), carts)
+        batched = time_calls(lambda c: db.create_sale([dict(i) for i in c]), carts)
+        a, b = statistics.median(per_line), statistics.median(batched)
+        print(f"{size:>5} {a:>11.2f}ms {b:>10.2f}ms {a / b:>7.1f}x")
+    print("pool:", db.pool_stats())
+    db.close()
+
+def write_price_list(path, n, prefix):
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        w = csv.writer(fh)
+        w.writerow(("nombre", "categoria", "precio_compra", "precio_venta", "cantidad", "sku"))
+        for i in range(n):
+            compra = Decimal(random.randint(100, 5000)) / 100
+            w.writerow((f"Importado {i}", "bench", compra, compra * Decimal("1.3"), random.randint(0, 500), f"{prefix}-{i:07d}"))
+
+def delete_bench_imports(db):
+    con = db.connect()
+    try:
+        con.cursor().execute("DELETE FROM producto WHERE sku LIKE 'IMP%'")
+        con.commit()
+    finally:
+        con.close()
+    db.catalog.invalidate()
+
+def bench_import(args):
+    cfg = make_config(args)
+    ensure_database(cfg, 0)
+    db = open_bench_db(cfg)
+    delete_bench_imports(db)
+    tmp = tempfile.mkdtemp()
+    try:
+        # Baseline: the Inventory form path, one connection checkout and commit per product
+        one_by_one = min(args.rows, args.one_by_one)
+        path = os.path.join(tmp, "single.csv")
+        write_price_list(path, one_by_one, "IMP1")
+        with open(path, newline="", encoding="utf-8") as fh:
+            rows = list(csv.DictReader(fh))
+        t0 = time.perf_counter()
+        for r in rows:
+            db.add_product(r["nombre"], r["categoria"], Decimal(r["precio_compra"]), Decimal(r["precio_venta"]),
+                           int(r["cantidad"]), r["sku"])
+        base = one_by_one / (time.perf_counter() - t0)
+        print(f"{'one-by-one add_product':>28}: {base:>9.0f} rows/s  ({one_by_one} rows)")
+
+        path = os.path.join(tmp, "bulk.csv")
+        for batch in args.batch_sizes:
+            delete_bench_imports(db)
+            write_price_list(path, args.rows, "IMP2")
+            res = import_products_csv(db, path, batch)
+            rate = res["read"] / res["seconds"]
+            print(f"{f'bulk import, batch {batch}':>28}: {rate:>9.0f} rows/s  ({res['read']} rows, "
+                  f"{len(res['rejected'])} rejected, {rate / base:.1f}x)")
+            # Second pass over the same file exercises the update side of the upsert
+            res = import_products_csv(db, path, batch)
+            rate = res["read"] / res["seconds"]
+            print(f"{f'  re-import (all updates)':>28}: {rate:>9.0f} rows/s")
+    finally:
+        delete_bench_imports(db)
+        for name in os.listdir(tmp):
+            os.remove(os.path.join(tmp, name))
+        os.rmdir(tmp)
+        db.close()
+
+# ---------------------------
+# Load test: several tills selling the same hot products
+# ---------------------------
+def read_stock(db):
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute("SELECT id_producto, cantidad FROM producto")
+        return dict(cur.fetchall())
+    finally:
+        con.close()
+
+def set_stock(db, ids, qty):
+    con = db.connect()
+    try:
+        cur = con.cursor()
+        cur.execute(f"UPDATE producto SET cantidad=%s WHERE id_producto IN ({','.join(['%s'] * len(ids))})", [qty] + ids)
+        cur.execute("DELETE FROM reserva_stock")
+        con.commit()
+    finally:
+        con.close()
+
+def register_loop(cfg, products, hot, args, deadline, out):
+    """One till: builds carts biased towards the hot products and checks them out until the deadline."""
+    db = DBHandler(cfg)
+    db.report_error = lambda title, msg: None
+    res = {"latencies": [], "stockouts": 0, "errors": 0, "sold": {}}
+    while time.perf_counter() < deadline:
+        cart = {}
+        for _ in range(args.cart_size):
+            idp, price = random.choice(hot) if random.random() < args.hot_share else random.choice(products)
+            line = cart.setdefault(idp, {'id_producto': idp, 'cantidad': 0, 'precio_unitario': str(price)})
+            line['cantidad'] += random.randint(1, 3)
+        key = str(uuid.uuid4())
+        t0 = time.perf_counter()
+        try:
+            if cfg.MULTI_REGISTER:
+                # As the Sales tab does: hold each line while the cart is built
+                for idp, line in cart.items():
+                    db.reserve_stock(key, idp, line['cantidad'])
+            db.book_sale([dict(l) for l in cart.values()], cart_key=key)
+        except StockError:
+            res["stockouts"] += 1
+            if cfg.MULTI_REGISTER:
+                db.release_stock(key)
+            continue
+        except db.backend.Error:
+            res["errors"] += 1
+            continue
+        res["latencies"].append((time.perf_counter() - t0) * 1000)
+        for idp, line in cart.items():
+            res["sold"][idp] = res["sold"].get(idp, 0) + line['cantidad']
+    res["contention"] = db.contention_stats()
+    db.close()
+    out.append(res)
+
+def bench_registers(args):
+    base = make_config(args)
+    products = ensure_database(base, args.products)
+    setup = open_bench_db(base)
+    hot = products[:args.hot]
+    print(f"{args.registers} registers, {args.seconds}s per mode, {args.hot} hot products "
+          f"({args.hot_share:.0%} of lines) with {args.hot_stock} units each")
+    print(f"{'mode':>10} {'sales/s':>8} {'p50':>8} {'p95':>8} {'stockouts':>9} {'retries':>7} {'errors':>6}  stock")
+    for mode in args.modes:
+        cfg = make_config(args)
+        cfg.MULTI_REGISTER = mode == "optimistic"
+        set_stock(setup, [idp for idp, _ in hot], args.hot_stock)
+        before = read_stock(setup)
+        out = []
+        deadline = time.perf_counter() + args.seconds
+        threads = [threading.Thread(target=register_loop, args=(cfg, products, hot, args, deadline, out))
+                   for _ in range(args.registers)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        after = read_stock(setup)
+
+        lat = sorted(x for r in out for x in r["latencies"])
+        sold = {}
+        for r in out:
+            for idp, n in r["sold"].items():
+                sold[idp] = sold.get(idp, 0) + n
+        # Every unit sold must be gone from stock, and stock never goes negative
+        consistent = all(after[idp] == before[idp] - sold.get(idp, 0) and after[idp] >= 0 for idp in before)
+        print(f"{mode:>10} {len(lat) / args.seconds:>8.1f} {percentile(lat, 0.5):>6.1f}ms {percentile(lat, 0.95):>6.1f}ms "
+              f"{sum(r['stockouts'] for r in out):>9} {sum(r['contention']['retries'] for r in out):>7} "
+              f"{sum(r['errors'] for r in out):>6}  {'ok' if consistent else 'MISMATCH'}")
+    setup.close()
+
+SEARCH_WORDS = ["Refresco", "Coca", "Cola", "Jabón", "Zote", "Leche", "Lala", "Pan", "Bimbo", "Arroz",
+                "Frijol", "Atún", "Dolores", "Papas", "Sabritas", "Galletas", "María", "Agua", "Ciel", "Aceite"]
+
+def bench_search(args):
+    random.seed(args.seed)
+    vocab = SEARCH_WORDS + [f"Marca{i}" for i in range(args.products // 20)]
+    rows = [(i, f"{' '.join(random.sample(vocab, 3))} {random.randint(100, 999)}g", Decimal("1.00"),
+             Decimal("1.30"), 10, f"75{i:011d}") for i in range(1, args.products + 1)]
+    catalog = ProductCatalog()
+    t0 = time.perf_counter()
+    catalog.load(rows)
+    print(f"index build: {(time.perf_counter() - t0) * 1000:.0f}ms for {args.products} products")
+
+    def typo(word):
+        i = random.randrange(len(word) - 1)
+        return word[:i] + word[i + 1] + word[i] + word[i + 2:]
+    cases = {
+        "sku (barcode)": lambda: catalog.get_by_sku(f"75{random.randint(1, args.products):011d}"),
+        "prefix, 1 word": lambda: catalog.search(random.choice(vocab)[:3]),
+        "prefix, 2 words": lambda: catalog.search(" ".join(w[:4] for w in random.sample(SEARCH_WORDS, 2))),
+        "typo, 1 word": lambda: catalog.search(typo(random.choice(vocab))),
+    }
+    print(f"{'lookup':>16} {'p50':>9} {'p99':>9}")
+    for name, fn in cases.items():
+        samples = []
+        for _ in range(args.runs):
+            t0 = time.perf_counter()
+            fn()
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        print(f"{name:>16} {statistics.median(samples):>7.3f}ms {percentile(samples, 0.99):>7.3f}ms")
+
+class DailySalesRows:
+    """Stands in for DBHandler.iter_daily_sales with rows already in memory."""
+    def __init__(self, rows):
+        self.rows = rows
+
+    def iter_daily_sales(self, start_date, batch_size=50000):
+        for i in range(0, len(self.rows), batch_size):
+            yield self.rows[i:i + batch_size]
+
+def bench_restock(args):
+    import numpy as np
+    rng = np.random.default_rng(args.seed)
+    # A random `density` share of all (product, day) cells had sales
+    cells = rng.choice(args.products * args.days, int(args.products * args.days * args.density), replace=False)
+    rows = list(zip((cells // args.days + 1).tolist(), (-(cells % args.days) - 1).tolist(),
+                    rng.integers(1, 12, len(cells)).tolist()))
+    products = [(i, f"Producto {i}", Decimal("1.00"), Decimal("1.30"), int(q), f"BENCH-{i:07d}")
+                for i, q in enumerate(rng.integers(0, 60, args.products).tolist(), 1)]
+    print(f"{args.products} products x {args.days} days, {len(rows)} (product, day) rows")
+    t0 = time.perf_counter()
+    sales = load_daily_sales(DailySalesRows(rows), args.days)
+    t1 = time.perf_counter()
+    report = RestockReport(products, sales)
+    t2 = time.perf_counter()
+    print(f"rows -> arrays: {(t1 - t0) * 1000:.0f}ms")
+    print(f"forecast + report: {(t2 - t1) * 1000:.0f}ms ({len(report.low)} products at or below reorder point)")
+    for field in ("cover_days", "name", "suggested"):
+        samples = []
+        for descending in (False, True) * (args.runs // 2):
+            t0 = time.perf_counter()
+            report.sort(field, descending)
+            report.page(None, 200)
+            samples.append((time.perf_counter() - t0) * 1000)
+        samples.sort()
+        print(f"sort by {field} + first page: p50 {statistics.median(samples):.1f}ms")
+
+# DBHandler._insert_sale's line loop before Money: Decimal built from str() and
+# quantized per line, the subtotal kept on the item, amounts passed as text
+def decimal_sale_lines(items, sale_id=1):
+    total = Decimal('0.00')
+    for it in items:
+        subtotal = Decimal(str(it['precio_unitario'])) * Decimal(it['cantidad'])
+        it['subtotal'] = subtotal.quantize(Decimal('0.01'))
+        total += it['subtotal']
+    params = [(sale_id, it['id_producto'], it['cantidad'], str(it['precio_unitario']), str(it['subtotal'])) for it in items]
+    return str(total), params
+
+# ... and now (see _insert_sale)
+def money_sale_lines(items, sale_id=1):
+    prices = [Money.of(it['precio_unitario']) for it in items]
+    total = Money(sum(p.cents * it['cantidad'] for p, it in zip(prices, items)))
+    params = [(sale_id, it['id_producto'], it['cantidad'], str(p), money_text(p.cents * it['cantidad']))
+              for p, it in zip(prices, items)]
+    return str(total), params
+
+def per_line(fn, arg, n, runs):
+    """(ns, peak traced bytes, traced blocks still held) per line of fn(arg) over n lines."""
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn(arg)
+        samples.append((time.perf_counter() - t0) * 1e9 / n)
+    tracemalloc.start()
+    result = fn(arg)
+    peak = tracemalloc.get_traced_memory()[1]
+    blocks = sum(stat.count for stat in tracemalloc.take_snapshot().statistics("filename"))
+    tracemalloc.stop()
+    del result
+    return statistics.median(samples), peak / n, blocks / n
+
+def bench_money(args):
+    random.seed(args.seed)
+    prices = [Decimal(random.randint(1, 500_000)).scaleb(-2) for _ in range(args.lines)]
+    qtys = [random.randint(1, 12) for _ in range(args.lines)]
+    # The items each version's Cart.items() hands to the sale path: text prices
+    # before, Money now (whose text the cart view has already drawn)
+    text_items = [{'id_producto': i, 'cantidad': q, 'precio_unitario': str(p)} for i, (p, q) in enumerate(zip(prices, qtys))]
+    money_items = [{'id_producto': i, 'cantidad': q, 'precio_unitario': Money.of(p)} for i, (p, q) in enumerate(zip(prices, qtys))]
+    for it in money_items:
+        f"{it['precio_unitario']:.2f}"
+    old, new = decimal_sale_lines(text_items), money_sale_lines(money_items)
+    assert old == new, "Money and Decimal disagree"
+    old_ns, old_bytes, old_blocks = per_line(decimal_sale_lines, text_items, args.lines, args.runs)
+    new_ns, new_bytes, new_blocks = per_line(money_sale_lines, money_items, args.lines, args.runs)
+    print(f"{args.lines} sale lines, median of {args.runs} runs")
+    print(f"{'':>8} {'ns/line':>8} {'peak B/line':>12} {'blocks/line':>12}")
+    print(f"{'Decimal':>8} {old_ns:>8.0f} {old_bytes:>12.0f} {old_blocks:>12.2f}")
+    print(f"{'Money':>8} {new_ns:>8.0f} {new_bytes:>12.0f} {new_blocks:>12.2f}")
+
+# ---------------------------
+# Load generator for pos_service.py
+# ---------------------------
+SERVICE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pos_service.py")
+
+async def http_request(reader, writer, method, path, payload=None):
+    body = json.dumps(payload).encode() if payload is not None else b""
+    writer.write(f"{method} {path} HTTP/1.1\r\nHost: bench\r\nContent-Type: application/json\r\n"
+                 f"Content-Length: {len(body)}\r\n\r\n".encode() + body)
+    status = int((await reader.readline()).split()[1])
+    length = 0
+    while True:
+        line = await reader.readline()
+        if line in (b"\r\n", b""):
+            break
+        name, _, value = line.decode("latin-1").partition(":")
+        if name.lower() == "content-length":
+            length = int(value)
+    return status, json.loads(await reader.readexactly(length)) if length else None
+
+async def till_client(host, port, ids, args, deadline, out):
+    """One connection selling carts back to back (keep-alive), like a busy web till."""
+    reader, writer = await asyncio.open_connection(host, port)
+    loop = asyncio.get_running_loop()
+    try:
+        while loop.time() < deadline:
+            cart = [{"id_producto": idp, "cantidad": random.randint(1, 3)}
+                    for idp in random.sample(ids, args.cart_size)]
+            t0 = time.perf_counter()
+            status, _ = await http_request(reader, writer, "POST", "/sales", {"items": cart})
+            out["status"][status] = out["status"].get(status, 0) + 1
+            if status == 201:
+                out["latencies"].append((time.perf_counter() - t0) * 1000)
+            elif status == 503:
+                await asyncio.sleep(0.01)
+    finally:
+        writer.close()
+
+async def run_service_load(host, port, args):
+    reader, writer = await asyncio.open_connection(host, port)
+    ids, after = [], None
+    while len(ids) < args.products:
+        status, rows = await http_request(reader, writer, "GET", f"/products?limit=1000{f'&after={after}' if after else ''}")
+        if status != 200 or not rows:
+            break
+        ids += [r["id_producto"] for r in rows if r["cantidad"] > 10**6]
+        after = rows[-1]["id_producto"]
+    if len(ids) < args.cart_size:
+        raise SystemExit("the service has no bench products with stock to sell")
+    out = {"latencies": [], "status": {}}
+    t0 = time.perf_counter()
+    deadline = asyncio.get_running_loop().time() + args.seconds
+    await asyncio.gather(*[till_client(host, port, ids, args, deadline, out) for _ in range(args.connections)])
+    elapsed = time.perf_counter() - t0
+    _, health = await http_request(reader, writer, "GET", "/health")
+    writer.close()
+    return out, elapsed, health
+
+def wait_for_service(host, port, proc, timeout=60):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        if proc and proc.poll() is not None:
+            raise SystemExit(f"pos_service.py exited with status {proc.returncode}")
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise SystemExit(f"pos_service.py did not start listening on {host}:{port}")
+
+def bench_service(args):
+    url = urlsplit(args.url)
+    host, port = url.hostname, url.port or 80
+    proc = None
+    if args.spawn:
+        cfg = make_config(args)
+        ensure_database(cfg, args.products)
+        cmd = [sys.executable, SERVICE_PATH, "--host", host, "--port", str(port), "--backend", cfg.BACKEND,
+               "--database", cfg.DATABASE, "--sqlite-path", cfg.SQLITE_PATH]
+        # One core for the service, so sales/s is a per-core figure (Linux only)
+        pin = (lambda: os.sched_setaffinity(0, {args.cpu})) if hasattr(os, "sched_setaffinity") else None
+        proc = subprocess.Popen(cmd, preexec_fn=pin)
+    try:
+        wait_for_service(host, port, proc)
+        out, elapsed, health = asyncio.run(run_service_load(host, port, args))
+    finally:
+        if proc:
+            proc.terminate()
+            proc.wait()
+    lat = sorted(out["latencies"])
+    batches = health["sales"]["batches"] if health else 0
+    print(f"{args.connections} connections, {args.seconds:.0f}s, {args.cart_size} lines per sale"
+          + (f", service pinned to CPU {args.cpu}" if args.spawn else ""))
+    print(f"{len(lat) / elapsed:.0f} sales/s  p50 {percentile(lat, 0.5):.1f}ms  p95 {percentile(lat, 0.95):.1f}ms  "
+          f"p99 {percentile(lat, 0.99):.1f}ms")
+    print("responses: " + ", ".join(f"{k}: {v}" for k, v in sorted(out["status"].items())))
+    if batches:
+        print(f"service: {health['sales']['sales']} sales in {batches} batches "
+              f"({health['sales']['sales'] / batches:.1f} per commit), {health['sales']['rejected']} rejected")
+
+# ---------------------------
+# Regression suite: fixed cases at a given scale, checked against stored baselines
+# ---------------------------
+BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "bench_baseline.json")
+CHECKED_STATS = ("p50", "p95")
+
+def measure(fn, runs, warmup=1):
+    """Latency percentiles (ms) and throughput (calls/s) of runs calls to fn()."""
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(runs):
+        t0 = time.perf_counter()
+        fn()
+        samples.append((time.perf_counter() - t0) * 1000)
+    samples.sort()
+    return {"runs": runs, "p50": percentile(samples, 0.5), "p95": percentile(samples, 0.95),
+            "p99": percentile(samples, 0.99), "ops": runs * 1000 / max(sum(samples), 1e-9)}
+
+def db_cases(db, products, args):
+    """name -> (fn, runs) for the DBHandler entry points the GUI leans on."""
+    def sale(carts):
+        if db.create_sale(next(carts)) is None:
+            raise RuntimeError("sale failed during benchmark")
+
+    today = date.today()
+    week = (today - timedelta(days=6), today + timedelta(days=1))
+    cases = {
+        "get_all_products (reload)": (lambda: db.get_all_products(reload=True), args.heavy_runs),
+        "get_all_products (cached)": (db.get_all_products, args.runs),
+    }
+    for size in args.cart_sizes:
+        size = min(size, len(products))
+        carts = itertools.cycle([random_cart(products, size) for _ in range(args.runs + 1)])
+        cases[f"create_sale, {size} lines"] = (lambda carts=carts: sale(carts), args.runs)
+    cases["get_sales, last 7 days"] = (lambda: db.get_sales(*week), args.runs)
+    cases["get_sales, no range"] = (db.get_sales, args.heavy_runs)
+    cases["get_sales_page, first page"] = (lambda: db.get_sales_page(limit=200), args.runs)
+    return cases
+
+def open_gui(cfg, tmp):
+    """POSApp on a withdrawn root, with its tables drawing synchronously; None without a display."""
+    if tk is None:
+        print("GUI cases skipped: tkinter is not installed")
+        return None
+    try:
+        root = tk.Tk()
+    except tk.TclError as e:
+        print(f"GUI cases skipped: {e}")
+        return None
+    root.withdraw()
+    cfg.JOURNAL_PATH = os.path.join(tmp, "journal.db")
+    db = open_bench_db(cfg)
+    app = POSApp(root, db)
+    db.report_error = lambda title, msg: print(f"{title}: {msg}")
+    # Tabs are built on first show
+    for tab in (app.tab_inventory, app.tab_reports, app.tab_sales):
+        app.tab_control.select(tab)
+        root.update()
+    # Page fetches then happen inside the timed call instead of on a worker
+    for table in (app.inv_table, app.sales_table, app.report_inv_table):
+        table.jobs = None
+    return app
+
+def startup(cfg):
+    """A fresh POSApp up to its first frame, as at the start of a shift."""
+    root = tk.Tk()
+    root.withdraw()
+    db = open_bench_db(cfg)
+    app = POSApp(root, db)
+    try:
+        while app.first_frame_ms is None:
+            root.update()
+    finally:
+        app.close()
+        root.destroy()
+        db.close()
+
+def gui_cases(app, args):
+    root, db, cfg = app.root, app.db, app.db.cfg
+    start = date.today() - timedelta(days=29)
+    summary = db.get_sales_summary("day", start, date.today() + timedelta(days=1))
+    top = db.get_top_products(start, date.today() + timedelta(days=1))
+
+    def drawn(tab, fn, *a, **kw):
+        # Loads for a tab that is not on screen are deferred, so show it first
+        def run():
+            if app.tab_control.select() != str(tab):
+                app.tab_control.select(tab)
+                root.update()
+            fn(*a, **kw)
+            root.update()
+        return run
+
+    def page_down():
+        table = app.inv_table
+        table.scroll_to(0 if table.top + 2 * table.visible >= table._total else table.top + table.visible)
+
+    return {
+        "startup (to first frame)": (lambda: startup(cfg), args.heavy_runs),
+        "inventory refresh (reload)": (drawn(app.tab_inventory, app.load_products, reload=True), args.heavy_runs),
+        "inventory refresh": (drawn(app.tab_inventory, app.load_products), args.runs),
+        "inventory page down": (drawn(app.tab_inventory, page_down), args.runs),
+        "sales tab refresh": (drawn(app.tab_sales, app.load_products_for_sales), args.runs),
+        "inventory report refresh": (drawn(app.tab_reports, app.load_inventory_report), args.runs),
+        "sales summary, 30 days": (drawn(app.tab_reports, app.show_sales_summary, "day", summary), args.runs),
+        "top products": (drawn(app.tab_reports, app.show_top_products, top), args.runs),
+    }
+
+def compare(results, baseline, args):
+    """Failure messages for every checked stat that is slower than the baseline allows."""
+    failures = []
+    for name, res in results.items():
+        base = baseline.get(name)
+        if not base:
+            continue
+        for stat in CHECKED_STATS:
+            limit = base[stat] * (1 + args.tolerance) + args.slack_ms
+            if res[stat] > limit:
+                failures.append(f"{name}: {stat} {res[stat]:.2f}ms > {limit:.2f}ms (baseline {base[stat]:.2f}ms)")
+    return failures
+
+def bench_suite(args):
+    random.seed(args.seed)
+    n_products, n_details = SCALES[args.scale]
+    n_products = args.products or n_products
+    n_details = args.details if args.details is not None else n_details
+    cfg = make_config(args, args.database or f"miscelanea_bench_{args.scale}")
+    target = cfg.SQLITE_PATH if cfg.BACKEND == "sqlite" else cfg.DATABASE
+    print(f"{args.scale}: {n_products} products, {n_details} detail rows ({cfg.BACKEND}: {target})")
+    products = ensure_database(cfg, n_products)
+    ensure_sales(cfg, products, n_details)
+
+    db = open_bench_db(cfg)
+    seeded = last_sale_id(db)
+    tmp = tempfile.mkdtemp()
+    app = None if args.no_gui else open_gui(make_config(args, cfg.DATABASE), tmp)
+    results = {}
+    try:
+        cases = db_cases(db, products, args)
+        if app:
+            cases.update(gui_cases(app, args))
+        for name, (fn, runs) in cases.items():
+            results[name] = measure(fn, runs)
+    finally:
+        if app:
+            app.close()
+            app.root.destroy()
+            app.db.close()
+        discard_sales_after(db, seeded)
+        db.close()
+        shutil.rmtree(tmp, ignore_errors=True)
+
+    try:
+        with open(args.baseline, encoding="utf-8") as fh:
+            stored = json.load(fh)
+    except FileNotFoundError:
+        stored = {}
+    key = f"{cfg.BACKEND}/{args.scale}"
+    baseline = stored.get(key, {})
+    print(f"{'case':>28} {'runs':>5} {'p50':>10} {'p95':>10} {'p99':>10} {'ops/s':>9} {'p95 vs base':>12}")
+    for name, res in results.items():
+        base = baseline.get(name)
+        delta = f"{(res['p95'] / base['p95'] - 1) * 100:+.0f}%" if base and base["p95"] else "-"
+        print(f"{name:>28} {res['runs']:>5} {res['p50']:>8.2f}ms {res['p95']:>8.2f}ms {res['p99']:>8.2f}ms "
+              f"{res['ops']:>9.1f} {delta:>12}")
+
+    failures = compare(results, baseline, args)
+    if args.save_baseline:
+        stored[key] = results
+        with open(args.baseline, "w", encoding="utf-8") as fh:
+            json.dump(stored, fh, indent=1, sort_keys=True)
+        print(f"Baseline for {key} saved to {args.baseline}")
+    elif not baseline:
+        print(f"No baseline for {key} in {args.baseline}; run with --save-baseline to record one")
+    if failures:
+        print("REGRESSION")
+        for f in failures:
+            print("  " + f)
+        return 1
+    return 0
+
+def main():
+    parser = argparse.ArgumentParser(description="POS benchmarks")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=DBConfig.BACKEND)
+    parser.add_argument("--sqlite-path", help="database file for --backend sqlite (default: <database>.sqlite3 in the temp dir)")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("sale", help="batched create_sale vs the per-line version")
+    p.add_argument("--database", default="miscelanea_bench")
+    p.add_argument("--products", type=int, default=2000)
+    p.add_argument("--runs", type=int, default=50)
+    p.add_argument("--cart-sizes", type=int, nargs="+", default=[1, 5, 10, 40])
+    p.set_defaults(func=bench_sale)
+
+    p = sub.add_parser("import", help="bulk CSV import vs one add_product per row")
+    p.add_argument("--database", default="miscelanea_bench")
+    p.add_argument("--rows", type=int, default=20000)
+    p.add_argument("--one-by-one", type=int, default=2000, help="rows timed through add_product")
+    p.add_argument("--batch-sizes", type=int, nargs="+", default=[100, 500, 2000])
+    p.set_defaults(func=bench_import)
+
+    p = sub.add_parser("registers", help="N concurrent tills: locking vs optimistic checkout")
+    p.add_argument("--database", default="miscelanea_bench")
+    p.add_argument("--products", type=int, default=2000)
+    p.add_argument("--registers", type=int, default=8)
+    p.add_argument("--seconds", type=float, default=20)
+    p.add_argument("--cart-size", type=int, default=5)
+    p.add_argument("--hot", type=int, default=10, help="products most lines go to")
+    p.add_argument("--hot-share", type=float, default=0.6)
+    p.add_argument("--hot-stock", type=int, default=5000)
+    p.add_argument("--modes", nargs="+", choices=["locking", "optimistic"], default=["locking", "optimistic"])
+    p.set_defaults(func=bench_registers)
+
+    p = sub.add_parser("search", help="catalog sku lookup and name search (in memory, no MySQL)")
+    p.add_argument("--products", type=int, default=100000)
+    p.add_argument("--runs", type=int, default=2000)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_search)
+
+    p = sub.add_parser("restock", help="demand forecast and reorder points on synthetic history (in memory, no MySQL)")
+    p.add_argument("--products", type=int, default=100000)
+    p.add_argument("--days", type=int, default=730)
+    p.add_argument("--density", type=float, default=0.1, help="share of product-days with a sale")
+    p.add_argument("--runs", type=int, default=10)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_restock)
+
+    p = sub.add_parser("money", help="per-line cost and memory of the sale path, Money vs Decimal (in memory, no MySQL)")
+    p.add_argument("--lines", type=int, default=100000)
+    p.add_argument("--runs", type=int, default=5)
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_money)
+
+    p = sub.add_parser("suite", help="latency/throughput of the hot paths at a given scale, checked against a baseline")
+    p.add_argument("--scale", choices=list(SCALES), default="small")
+    p.add_argument("--database", help="default: miscelanea_bench_<scale>")
+    p.add_argument("--products", type=int, help="override the scale's product count")
+    p.add_argument("--details", type=int, help="override the scale's sale detail rows")
+    p.add_argument("--runs", type=int, default=30)
+    p.add_argument("--heavy-runs", type=int, default=3, help="runs of the full-table cases")
+    p.add_argument("--cart-sizes", type=int, nargs="+", default=[1, 5, 20, 50])
+    p.add_argument("--no-gui", action="store_true", help="skip the Treeview refresh cases")
+    p.add_argument("--baseline", default=BASELINE_PATH)
+    p.add_argument("--save-baseline", action="store_true", help="record this run as the baseline for backend/scale")
+    p.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown of p50/p95 over the baseline")
+    p.add_argument("--slack-ms", type=float, default=0.5, help="absolute allowance on top, for sub-millisecond cases")
+    p.add_argument("--seed", type=int, default=1)
+    p.set_defaults(func=bench_suite)
+
+    p = sub.add_parser("service", help="load generator: sustained sales/s through pos_service.py")
+    p.add_argument("--url", default="http://127.0.0.1:8089")
+    p.add_argument("--spawn", action="store_true", help="seed the database and start the service (pinned to --cpu)")
+    p.add_argument("--cpu", type=int, default=0)
+    p.add_argument("--database", default="miscelanea_bench")
+    p.add_argument("--products", type=int, default=2000)
+    p.add_argument("--connections", type=int, default=64)
+    p.add_argument("--seconds", type=float, default=20)
+    p.add_argument("--cart-size", type=int, default=3)
+    p.set_defaults(func=bench_service)
+
+    args = parser.parse_args()
+    sys.exit(args.func(args))
+
+if __name__ == "__main__":
+    main()
@@ -1,50 +1,1212 @@
 
-import tkinter as tk
-from tkinter import ttk, messagebox, simpledialog
-from datetime import datetime
-import mysql.connector
-from decimal import Decimal, InvalidOperation
+try:
+    import tkinter as tk
+    from tkinter import ttk, messagebox, simpledialog, filedialog
+except ImportError:  # headless server without Tk: only pos_service and the command-line tools work
+    tk = ttk = messagebox = simpledialog = filedialog = None
+from datetime import date, datetime, timedelta
+import argparse
+import bisect
+import collections
+import concurrent.futures
+import csv
+import functools
+import inspect
+import itertools
+import json
+import os
+import queue
+import random
+import re
+import sqlite3
+import sys
+import threading
+import time
+import unicodedata
+import uuid
+from decimal import ROUND_HALF_EVEN, Decimal, InvalidOperation
 
 # ---------------------------
 # Database configuration
 # ---------------------------
 class DBConfig:
+    BACKEND = "mysql"       # or "sqlite": embedded database file, for single-till shops
+    SQLITE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pos.sqlite3")
     HOST = "localhost"
     USER = "root"
     PASSWORD = "admin123"   # change if you have a password
     DATABASE = "miscelanea_don_papu"
+    POOL_SIZE = 5           # max open connections per register
+    POOL_TIMEOUT = 5.0      # seconds to wait for a free connection
+    POOL_VALIDATE_IDLE = 30.0  # ping connections idle longer than this
+    IMPORT_BATCH_SIZE = 500    # rows per upsert transaction in bulk imports
+    OFFLINE_CHECKOUT = False   # start with "offline sale" ticked (sales go to the local journal first)
+    JOURNAL_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pos_journal.db")
+    SYNC_INTERVAL = 5.0        # seconds between journal replays
+    MULTI_REGISTER = False     # several tills share the database: reserve stock per cart, optimistic checkout
+    RESERVATION_TTL = 600      # seconds a cart holds reserved stock without activity
+    DEADLOCK_RETRIES = 4       # retries of a transaction that hit a deadlock or lock wait timeout
+    RETRY_BACKOFF = 0.05       # seconds before the first retry, doubled (with jitter) each time
+    TRACE_CALLS = True         # time DBHandler calls and GUI loads/renders (Ctrl+Shift+D shows them)
+    TRACE_BUFFER = 5000        # most recent calls kept for the diagnostics tab and exports
+    TRACE_SLOW_MS = 100        # calls slower than this are listed as slow
+    CHANGE_FEED_INTERVAL = 1.0   # seconds between polls for stock/product changes made by other registers
+    CHANGE_FEED_RETENTION = 86400  # seconds of changes kept; a register offline longer re-reads the catalog
+    RESTOCK_HISTORY_DAYS = 730  # days of sales the restock forecast reads (two years: one for seasonality)
+    LEAD_TIME_DAYS = 7         # days from ordering a product to having it on the shelf
+    ORDER_COVER_DAYS = 14      # demand a suggested order covers beyond the lead time
+    SERVICE_LEVEL_Z = 1.65     # safety stock in standard deviations of lead-time demand (1.65 ~ 95%)
+
+# ---------------------------
+# Call tracing
+# ---------------------------
+class Tracer:
+    """
+    Timings of traced calls (see trace_methods). The most recent calls are kept
+    in a ring buffer with their row count (length of a returned list, unless the
+    call noted its own), time spent acquiring a connection
+    and time spent on locking statements; every call also lands in a per-name
+    latency histogram. Both can be exported as JSON lines or Prometheus text.
+
+    Code running inside a traced call adds to its figures with note().
+    """
+    BUCKETS_MS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+    FIELDS = ("rows", "acquire_ms", "lock_ms")
+
+    def __init__(self, size=5000):
+        self.enabled = True
+        self.calls = collections.deque(maxlen=size)
+        self.stats = {}  # name -> count, sum_ms, errors, FIELDS totals, buckets (last one is +Inf)
+        self._lock = threading.Lock()
+        self._local = threading.local()
+
+    def resize(self, size):
+        with self._lock:
+            self.calls = collections.deque(self.calls, maxlen=size)
+
+    def clear(self):
+        with self._lock:
+            self.calls.clear()
+            self.stats = {}
+
+    def wrap(self, name, fn):
+        @functools.wraps(fn)
+        def traced(*args, **kw):
+            if not self.enabled:
+                return fn(*args, **kw)
+            stack = self._stack()
+            span = {}
+            stack.append(span)
+            t0 = time.perf_counter()
+            try:
+                result = fn(*args, **kw)
+            except BaseException as e:
+                stack.pop()
+                self.record(name, (time.perf_counter() - t0) * 1000, span, type(e).__name__)
+                raise
+            stack.pop()
+            if "rows" not in span and isinstance(result, list):
+                span["rows"] = len(result)
+            self.record(name, (time.perf_counter() - t0) * 1000, span)
+            return result
+        return traced
+
+    def note(self, **fields):
+        """Adds to the figures of the innermost traced call on this thread."""
+        stack = self._stack()
+        if stack:
+            span = stack[-1]
+            for k, v in fields.items():
+                span[k] = span.get(k, 0) + v
+
+    def _stack(self):
+        stack = getattr(self._local, "stack", None)
+        if stack is None:
+            stack = self._local.stack = []
+        return stack
+
+    def record(self, name, ms, span=None, error=None):
+        """Adds one call; span holds the FIELDS figures, if any."""
+        span = span or {}
+        call = {"ts": time.time(), "call": name, "ms": ms, "thread": threading.current_thread().name}
+        call.update(span)
+        if error:
+            call["error"] = error
+        with self._lock:
+            self.calls.append(call)
+            st = self.stats.get(name)
+            if st is None:
+                st = self.stats[name] = {"count": 0, "sum_ms": 0.0, "errors": 0,
+                                         "buckets": [0] * (len(self.BUCKETS_MS) + 1)}
+                st.update((k, 0) for k in self.FIELDS)
+            st["count"] += 1
+            st["sum_ms"] += ms
+            st["buckets"][bisect.bisect_left(self.BUCKETS_MS, ms)] += 1
+            for k in self.FIELDS:
+                st[k] += span.get(k, 0)
+            if error:
+                st["errors"] += 1
+
+    # Reading
+    def recent(self, min_ms=0.0, limit=200):
+        """Newest buffered calls that took at least min_ms."""
+        with self._lock:
+            calls = list(self.calls)
+        return [c for c in reversed(calls) if c["ms"] >= min_ms][:limit]
+
+    def summary(self):
+        """Per call name: lifetime totals and histogram, percentiles over the buffered calls."""
+        with self._lock:
+            calls = list(self.calls)
+            stats = {name: dict(st, buckets=list(st["buckets"])) for name, st in self.stats.items()}
+        samples = {}
+        for c in calls:
+            samples.setdefault(c["call"], []).append(c["ms"])
+        for name, st in stats.items():
+            ms = sorted(samples.get(name, ()))
+            st["name"] = name
+            st["p50"] = ms[len(ms) // 2] if ms else None
+            st["p95"] = ms[min(len(ms) - 1, int(len(ms) * 0.95))] if ms else None
+            st["max"] = ms[-1] if ms else None
+        return sorted(stats.values(), key=lambda st: st["name"])
+
+    # Export
+    def write_jsonl(self, fh):
+        with self._lock:
+            calls = list(self.calls)
+        for c in calls:
+            fh.write(json.dumps({k: round(v, 3) if isinstance(v, float) and k != "ts" else v for k, v in c.items()}) + "\n")
+        return len(calls)
+
+    def prometheus(self):
+        lines = ["# HELP pos_call_duration_seconds Duration of traced POS calls.",
+                 "# TYPE pos_call_duration_seconds histogram"]
+        summary = self.summary()
+        for st in summary:
+            label = self._label(st["name"])
+            cumulative = 0
+            for le, n in zip(self.BUCKETS_MS + (None,), st["buckets"]):
+                cumulative += n
+                bound = "+Inf" if le is None else repr(le / 1000)
+                lines.append(f'pos_call_duration_seconds_bucket{{call="{label}",le="{bound}"}} {cumulative}')
+            lines.append(f'pos_call_duration_seconds_sum{{call="{label}"}} {st["sum_ms"] / 1000:.6f}')
+            lines.append(f'pos_call_duration_seconds_count{{call="{label}"}} {st["count"]}')
+        for metric, key, scale, help_text in (
+                ("pos_call_errors_total", "errors", 1, "Traced calls that raised."),
+                ("pos_call_rows_total", "rows", 1, "Rows returned or written by traced calls."),
+                ("pos_connection_acquire_seconds_total", "acquire_ms", 1000, "Time traced calls spent getting a pooled connection."),
+                ("pos_lock_wait_seconds_total", "lock_ms", 1000, "Time traced calls spent on row-locking statements.")):
+            lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+            for st in summary:
+                value = st[key] / scale if scale != 1 else st[key]
+                lines.append(f'{metric}{{call="{self._label(st["name"])}"}} {value!r}')
+        return "\n".join(lines) + "\n"
+
+    @staticmethod
+    def _label(name):
+        return name.replace("\\", "\\\\").replace('"', '\\"')
+
+TRACE = Tracer()
+IMPORTED = time.perf_counter()
+
+def process_age():
+    """Seconds since the process was launched (from /proc on Linux; elsewhere since pos was imported)."""
+    try:
+        with open("/proc/self/stat") as fh:
+            started = int(fh.read().rsplit(")", 1)[1].split()[19])  # field 22, in clock ticks after boot
+        with open("/proc/uptime") as fh:
+            uptime = float(fh.read().split()[0])
+        return uptime - started / os.sysconf("SC_CLK_TCK")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return time.perf_counter() - IMPORTED
+
+def trace_methods(cls, include):
+    """Wraps the methods of cls whose name passes include(name) with TRACE (generators excluded)."""
+    for name, fn in list(vars(cls).items()):
+        if inspect.isfunction(fn) and not inspect.isgeneratorfunction(fn) and include(name):
+            setattr(cls, name, TRACE.wrap(f"{cls.__name__}.{name}", fn))
+
+# ---------------------------
+# Connection pool
+# ---------------------------
+class PoolTimeout(Exception):
+    pass
+
+class PooledConnection:
+    """Wraps a MySQL connection; close() hands it back to the pool."""
+    def __init__(self, pool, con):
+        self._pool = pool
+        self._con = con
+
+    def close(self):
+        if self._con is not None:
+            con, self._con = self._con, None
+            self._pool.release(con)
+
+    def __getattr__(self, name):
+        if self._con is None:
+            raise AttributeError(f"connection already returned to pool ({name})")
+        return getattr(self._con, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+class ConnectionPool:
+    """
+    Bounded, thread-safe pool. At most `size` connections are open at once;
+    acquire() waits up to `timeout` seconds for one to be released.
+    """
+    def __init__(self, factory, size=5, timeout=5.0, validate_idle=30.0):
+        self._factory = factory
+        self._size = size
+        self._timeout = timeout
+        self._validate_idle = validate_idle
+        self._idle = []  # stack of (con, last_used)
+        self._open = 0
+        self._cond = threading.Condition()
+        self._stats = {"checkouts": 0, "waits": 0, "reconnects": 0, "timeouts": 0, "created": 0}
+
+    def acquire(self):
+        t0 = time.perf_counter()
+        try:
+            return self._acquire()
+        finally:
+            TRACE.note(acquire_ms=(time.perf_counter() - t0) * 1000)
+
+    def _acquire(self):
+        deadline = time.monotonic() + self._timeout
+        con = None
+        last_used = None
+        with self._cond:
+            waited = False
+            while not self._idle and self._open >= self._size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    self._stats["timeouts"] += 1
+                    raise PoolTimeout(f"no free connection after {self._timeout:.1f}s (pool size {self._size})")
+                if not waited:
+                    self._stats["waits"] += 1
+                    waited = True
+                self._cond.wait(remaining)
+            self._stats["checkouts"] += 1
+            if self._idle:
+                con, last_used = self._idle.pop()
+            else:
+                self._open += 1
+
+        # Connect / validate outside the lock so a slow handshake doesn't block other threads
+        try:
+            if con is None:
+                con = self._factory()
+                self._count("created")
+            elif time.monotonic() - last_used > self._validate_idle and not self._is_alive(con):
+                self._discard(con)
+                con = self._factory()
+                self._count("reconnects")
+        except Exception:
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            raise
+        return PooledConnection(self, con)
+
+    def release(self, con):
+        try:
+            # Never hand out a connection with an open transaction / stale snapshot
+            if con.in_transaction:
+                con.rollback()
+        except Exception:
+            self._discard(con)
+            with self._cond:
+                self._open -= 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._idle.append((con, time.monotonic()))
+            self._cond.notify()
+
+    def close_all(self):
+        with self._cond:
+            idle, self._idle = self._idle, []
+            self._open -= len(idle)
+        for con, _ in idle:
+            self._discard(con)
+
+    def stats(self):
+        with self._cond:
+            s = dict(self._stats)
+            s["open"] = self._open
+            s["idle"] = len(self._idle)
+            s["size"] = self._size
+        return s
+
+    def _count(self, key):
+        with self._cond:
+            self._stats[key] += 1
+
+    @staticmethod
+    def _is_alive(con):
+        try:
+            con.ping(reconnect=False)
+            return True
+        except Exception:
+            return False
+
+    @staticmethod
+    def _discard(con):
+        try:
+            con.close()
+        except Exception:
+            pass
+
+# ---------------------------
+# Product name search
+# ---------------------------
+_SEARCH_WORD = re.compile(r"[0-9a-z]+")
+
+def search_words(text):
+    """Lowercase, accent-free words: 'Jabón  ZOTE 400g' -> ['jabon', 'zote', '400g']"""
+    text = text or ""
+    if not text.isascii():
+        text = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    text = text.lower()
+    return list(dict.fromkeys(_SEARCH_WORD.findall(text)))
+
+def _one_letter_off(word):
+    """The word itself plus every way of deleting one letter from it."""
+    return {word} | {word[:i] + word[i + 1:] for i in range(len(word))}
+
+def _one_edit(a, b):
+    """True if a and b differ by at most one insert, delete, substitution or swap."""
+    if a == b:
+        return True
+    la, lb = len(a), len(b)
+    if abs(la - lb) > 1:
+        return False
+    i = 0
+    while i < la and i < lb and a[i] == b[i]:
+        i += 1
+    if la > lb:
+        return a[i + 1:] == b[i:]
+    if la < lb:
+        return a[i:] == b[i + 1:]
+    return a[i + 1:] == b[i + 1:] or (a[i:i + 1] == b[i + 1:i + 2] and a[i + 1:i + 2] == b[i:i + 1] and a[i + 2:] == b[i + 2:])
+
+class NameIndex:
+    """
+    Word index over product names. Every word of every name sits in one
+    sorted array, so a prefix search is two bisects; words one typo away are
+    found through a map keyed by each word with one letter deleted
+    (a deletion neighbourhood), without scanning the vocabulary.
+    """
+    MIN_FUZZY = 3  # shorter words only match by prefix
+
+    def __init__(self, rows=()):
+        self._entries = {}  # id -> (words, "words joined")
+        self._vocab = {}    # word -> number of products using it
+        self._near = {}     # word, or word with one letter deleted -> {words}
+        postings = {}
+        for idp, nombre in rows:
+            for w in self._register(idp, nombre):
+                postings.setdefault(w, []).append(idp)
+        self._words = []  # sorted, parallel to _ids
+        self._ids = []
+        for w in sorted(postings):
+            self._words.extend([w] * len(postings[w]))
+            self._ids.extend(postings[w])
+
+    def add(self, idp, nombre):
+        if idp in self._entries:
+            self.remove(idp)
+        for w in self._register(idp, nombre):
+            i = bisect.bisect_right(self._words, w)
+            self._words.insert(i, w)
+            self._ids.insert(i, idp)
+
+    def remove(self, idp):
+        entry = self._entries.pop(idp, None)
+        if entry is None:
+            return
+        for w in entry[0]:
+            lo, hi = bisect.bisect_left(self._words, w), bisect.bisect_right(self._words, w)
+            i = self._ids.index(idp, lo, hi)
+            del self._words[i], self._ids[i]
+            self._vocab[w] -= 1
+            if not self._vocab[w]:
+                del self._vocab[w]
+                for v in _one_letter_off(w):
+                    near = self._near[v]
+                    near.discard(w)
+                    if not near:
+                        del self._near[v]
+
+    def search(self, text, limit=20):
+        """
+        Ids of products whose name has, for every query word, a word starting
+        with it (or, failing that, one typo away from it). Names starting with
+        the query come first, then alphabetical.
+        """
+        words = search_words(text)
+        if not words:
+            return []
+        terms = []
+        for w in words:
+            lo, hi = bisect.bisect_left(self._words, w), bisect.bisect_left(self._words, w + "\x7f")
+            if hi > lo:
+                terms.append((hi - lo, w, None, [(lo, hi)]))
+                continue
+            near = self._typos(w)
+            if not near:
+                return []
+            spans = [(bisect.bisect_left(self._words, t), bisect.bisect_right(self._words, t)) for t in near]
+            terms.append((sum(hi - lo for lo, hi in spans), w, near, spans))
+        # Walk the rarest term's postings and check the others against each name
+        terms.sort(key=lambda t: t[0])
+        rest = terms[1:]
+        found = {}
+        for idp in (self._ids[i] for lo, hi in terms[0][3] for i in range(lo, hi)):
+            if idp in found:
+                continue
+            name_words, joined = self._entries[idp]
+            if all(any(x in near if near else x.startswith(w) for x in name_words) for _, w, near, _ in rest):
+                found[idp] = joined
+                if len(found) >= limit * 4:
+                    break
+        query = " ".join(words)
+        ranked = sorted(found, key=lambda i: (not found[i].startswith(query), found[i]))
+        return ranked[:limit]
+
+    def _register(self, idp, nombre):
+        words = search_words(nombre)
+        self._entries[idp] = (words, " ".join(words))
+        for w in words:
+            if w not in self._vocab:
+                self._vocab[w] = 0
+                for v in _one_letter_off(w):
+                    self._near.setdefault(v, set()).add(w)
+            self._vocab[w] += 1
+        return words
+
+    def _typos(self, word):
+        if len(word) < self.MIN_FUZZY:
+            return set()
+        candidates = set()
+        for v in _one_letter_off(word):
+            candidates |= self._near.get(v, set())
+        return {w for w in candidates if _one_edit(word, w)}
+
+# ---------------------------
+# Product catalog cache
+# ---------------------------
+class ProductCatalog:
+    """
+    Process-local copy of the producto table, indexed by id_producto, sku and
+    the words of nombre (for the Sales search box).
+    Rows are the tuples get_all_products() returns:
+    (id_producto, nombre, precio_compra, precio_venta, cantidad, sku)
+    """
+    def __init__(self):
+        self._by_id = {}
+        self._by_sku = {}
+        self._names = NameIndex()
+        self._loaded = False
+        self._ordered = True  # _by_id iterates in id order
+        self._ids = None      # sorted id list for paging, rebuilt after inserts/deletes
+        self._lock = threading.RLock()
+        self._stats = {"hits": 0, "misses": 0, "refreshes": 0, "full_loads": 0}
+
+    @property
+    def loaded(self):
+        return self._loaded
+
+    def load(self, rows):
+        """Replaces the whole catalog with a full table read."""
+        with self._lock:
+            self._by_id = {}
+            self._by_sku = {}
+            self._ids = None
+            for r in rows:
+                self._put(r, index=False)
+            self._names = NameIndex((r[0], r[1]) for r in self._by_id.values())
+            self._ordered = all(a < b for a, b in zip(self._by_id, list(self._by_id)[1:]))
+            self._loaded = True
+            self._stats["full_loads"] += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._loaded = False
+
+    def rows(self):
+        """All rows in id order, or None (a miss) while the catalog is not loaded."""
+        with self._lock:
+            if not self._loaded:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            if not self._ordered:
+                self._by_id = dict(sorted(self._by_id.items()))
+                self._ordered = True
+            return list(self._by_id.values())
+
+    def page(self, after_id, limit):
+        """Keyset page in id order, or None (a miss) while the catalog is not loaded."""
+        with self._lock:
+            if not self._loaded:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            if self._ids is None:
+                self._ids = sorted(self._by_id)
+            start = 0 if after_id is None else bisect.bisect_right(self._ids, after_id)
+            return [self._by_id[i] for i in self._ids[start:start + limit]]
+
+    def get(self, id_producto):
+        with self._lock:
+            row = self._by_id.get(id_producto)
+            self._stats["hits" if row is not None else "misses"] += 1
+            return row
+
+    def get_by_sku(self, sku):
+        with self._lock:
+            idp = self._by_sku.get(sku)
+            self._stats["hits" if idp is not None else "misses"] += 1
+            return self._by_id.get(idp) if idp is not None else None
+
+    def search(self, text, limit=20):
+        """Rows matching a name search, or None (a miss) while the catalog is not loaded."""
+        with self._lock:
+            if not self._loaded:
+                self._stats["misses"] += 1
+                return None
+            self._stats["hits"] += 1
+            return [self._by_id[i] for i in self._names.search(text, limit)]
+
+    def apply_rows(self, rows):
+        """Upserts rows that were just read or written by this register."""
+        with self._lock:
+            for r in rows:
+                self._put(r)
+            self._stats["refreshes"] += 1
+
+    def apply_stock(self, quantities):
+        """quantities: {id_producto: new cantidad}"""
+        with self._lock:
+            for idp, qty in quantities.items():
+                row = self._by_id.get(idp)
+                if row is not None:
+                    self._by_id[idp] = row[:4] + (qty,) + row[5:]
+            self._stats["refreshes"] += 1
+
+    def remove(self, ids):
+        with self._lock:
+            for idp in ids:
+                row = self._by_id.pop(idp, None)
+                if row is not None:
+                    self._ids = None
+                    self._names.remove(idp)
+                    if row[5] is not None:
+                        self._by_sku.pop(row[5], None)
+            self._stats["refreshes"] += 1
+
+    def stats(self):
+        with self._lock:
+            s = dict(self._stats)
+            s["size"] = len(self._by_id)
+        return s
+
+    def _put(self, row, index=True):
+        idp, sku = row[0], row[5]
+        old = self._by_id.get(idp)
+        if index and (old is None or old[1] != row[1]):
+            self._names.add(idp, row[1])
+        if old is None:
+            self._ids = None
+            if self._by_id and self._ordered and idp < next(reversed(self._by_id)):
+                self._ordered = False
+        if old is not None and old[5] is not None and old[5] != sku:
+            self._by_sku.pop(old[5], None)
+        self._by_id[idp] = row
+        if sku is not None:
+            self._by_sku[sku] = idp
+
+# ---------------------------
+# Money
+# ---------------------------
+class Money:
+    """
+    An amount as a whole number of cents. Built from str/Decimal/int/float
+    with the rounding of Decimal.quantize(Decimal("0.01")) (half to even);
+    sums and line totals (price * quantity) are plain int arithmetic, with
+    no Decimal context or string conversions along the way. The text is
+    computed once per value, so a price the cart has drawn is not formatted
+    again for the INSERT.
+
+    >>> [str(Money.of(t)) for t in ("0.005", "0.015", "0.025", "-0.015", "1.005")]
+    ['0.00', '0.02', '0.02', '-0.02', '1.00']
+    >>> [str(Money.of(t)) for t in (".5", "-.5", "+7", " 12.3 ", "1e2")]
+    ['0.50', '-0.50', '7.00', '12.30', '100.00']
+    >>> [str(Money.of(f)) for f in (0.125, 0.375, 2.675, -0.1, 1e-3)]
+    ['0.12', '0.38', '2.68', '-0.10', '0.00']
+    >>> Money.of(Decimal("19.999")), Money.of(3), Money.of("-0.001")
+    (Money('20.00'), Money('3.00'), Money('0.00'))
+    >>> all(Money.of(str(Money(c))).cents == c for c in (0, 1, -1, 99, -100, 123456, 10 ** 13, -10 ** 15 - 7))
+    True
+    >>> Money.of("2.50") == Decimal("2.50"), Money.of("2.50") < 3, Money.of("0.10") * 3 == Money.of("0.30")
+    (True, True, True)
+    """
+    __slots__ = ("cents", "_text")
+
+    def __init__(self, cents=0):
+        self.cents = cents
+
+    @classmethod
+    def of(cls, value):
+        """value as Money; raises InvalidOperation for text that is not a number."""
+        if type(value) is cls:
+            return value
+        if type(value) is Decimal:
+            if not value.is_finite():
+                raise InvalidOperation(f"{value} is not an amount of money")
+            # Exact when the price has at most two decimals, the usual case
+            scaled = value * 100
+            cents = int(scaled)
+            return cls(cents if scaled == cents else int(scaled.to_integral_value(ROUND_HALF_EVEN)))
+        if isinstance(value, int):
+            return cls(value * 100)
+        if isinstance(value, str):
+            # "12.34", "-5", ".5": parsed directly; anything else goes through Decimal
+            text = value.strip()
+            whole, _, frac = text.partition(".")
+            digits = whole[1:] if whole[:1] in ("-", "+") else whole
+            if len(frac) <= 2 and (digits or frac) and (not digits or digits.isdecimal()) and (not frac or frac.isdecimal()):
+                cents = int(digits or 0) * 100 + int(frac.ljust(2, "0"))
+                return cls(-cents if whole[:1] == "-" else cents)
+            value = Decimal(text)
+        elif isinstance(value, float):
+            value = Decimal(repr(value))  # the shortest text that reads back as the float
+        if isinstance(value, Decimal):
+            if not value.is_finite():
+                raise InvalidOperation(f"{value} is not an amount of money")
+            return cls(int((value * 100).to_integral_value(ROUND_HALF_EVEN)))
+        raise TypeError(f"{type(value).__name__} is not an amount of money")
+
+    def to_decimal(self):
+        return Decimal(self.cents).scaleb(-2)
+
+    def __add__(self, other):
+        if type(other) is Money:
+            return Money(self.cents + other.cents)
+        return NotImplemented
+
+    def __radd__(self, other):
+        # sum() starts from 0
+        if other == 0:
+            return self
+        return NotImplemented
+
+    def __sub__(self, other):
+        if type(other) is Money:
+            return Money(self.cents - other.cents)
+        return NotImplemented
+
+    def __mul__(self, quantity):
+        if type(quantity) is int or isinstance(quantity, int):
+            return Money(self.cents * quantity)
+        return NotImplemented
+
+    __rmul__ = __mul__
+
+    def __neg__(self):
+        return Money(-self.cents)
+
+    @staticmethod
+    def _scaled(other):
+        """other in cents (Money, int or Decimal), or None for other types."""
+        if type(other) is Money:
+            return other.cents
+        if isinstance(other, (int, Decimal)):
+            return other * 100
+        return None
+
+    def __eq__(self, other):
+        other = self._scaled(other)
+        return NotImplemented if other is None else self.cents == other
+
+    def __lt__(self, other):
+        other = self._scaled(other)
+        return NotImplemented if other is None else self.cents < other
+
+    def __le__(self, other):
+        other = self._scaled(other)
+        return NotImplemented if other is None else self.cents <= other
+
+    def __gt__(self, other):
+        other = self._scaled(other)
+        return NotImplemented if other is None else self.cents > other
+
+    def __ge__(self, other):
+        other = self._scaled(other)
+        return NotImplemented if other is None else self.cents >= other
+
+    def __hash__(self):
+        # Equal to a Decimal of the same amount, so it must hash like one
+        return hash(self.to_decimal())
+
+    def __bool__(self):
+        return self.cents != 0
+
+    def __str__(self):
+        try:
+            return self._text
+        except AttributeError:
+            self._text = money_text(self.cents)
+            return self._text
+
+    def __format__(self, spec):
+        # Views format money with :.2f, which is str(); other specs go through Decimal
+        return str(self) if spec in ("", ".2f") else format(self.to_decimal(), spec)
+
+    def __repr__(self):
+        return f"Money('{self}')"
+
+_FLOAT_EXACT = 10 ** 13
+
+def money_text(cents):
+    """"12.34" for 1234 cents, without building a Money."""
+    if -_FLOAT_EXACT < cents < _FLOAT_EXACT:
+        # cents / 100 is within 0.005 of the exact amount, so %.2f gives it back
+        return "%.2f" % (cents / 100)
+    units, rest = divmod(abs(cents), 100)
+    return f"{'-' if cents < 0 else ''}{units}.{rest:02d}"
+
+# ---------------------------
+# Storage backends
+# ---------------------------
+def _mysql_connector():
+    try:
+        import mysql.connector
+    except ImportError:
+        raise RuntimeError("The MySQL backend needs mysql-connector-python (pip install mysql-connector-python)")
+    return mysql.connector
+
+class MySQLBackend:
+    """
+    MySQL/InnoDB through mysql.connector, for one or many registers.
+    DBHandler's SQL is written for MySQL with %s placeholders; the few
+    constructs other engines spell differently (and schema introspection,
+    and error classification) come from the backend.
+    """
+    name = "mysql"
+    NOW = "NOW()"
+    TODAY = "CURDATE()"
+    NULL_SAFE_EQ = "<=>"
+    # Each report bucket is labelled with the date it starts on
+    PERIOD_BUCKETS = {
+        "day": "DATE({col})",
+        "week": "DATE_SUB(DATE({col}), INTERVAL WEEKDAY({col}) DAY)",
+        "month": "DATE_SUB(DATE({col}), INTERVAL DAYOFMONTH({col}) - 1 DAY)",
+    }
+
+    def __init__(self, cfg):
+        self.cfg = cfg
+        # Imported here so that the SQLite backend runs without the driver
+        self.connector = _mysql_connector()
+        self.Error = self.connector.Error
+
+    def connect(self):
+        return self.connector.connect(
+            host=self.cfg.HOST,
+            user=self.cfg.USER,
+            password=self.cfg.PASSWORD,
+            database=self.cfg.DATABASE,
+            autocommit=False
+        )
+
+    def now_plus_seconds(self, seconds):
+        return f"NOW() + INTERVAL {seconds} SECOND"
+
+    def least_date(self, value, other):
+        return f"LEAST(CAST({value} AS DATE), {other})"
+
+    def greatest_date(self, value, other):
+        return f"GREATEST(CAST({value} AS DATE), {other})"
+
+    def to_date(self, value):
+        return value
+
+    def day_number(self, value):
+        """Whole days since a fixed epoch; differences of two are day counts."""
+        return f"TO_DAYS({value})"
+
+    def upsert(self, table, keys, replace=(), add=()):
+        """Tail of an INSERT that updates the row already holding `keys` instead of failing."""
+        # Target columns are qualified: in INSERT ... SELECT the source tables may share names
+        sets = [f"{c} = VALUES({c})" for c in replace] + [f"{table}.{c} = {table}.{c} + VALUES({c})" for c in add]
+        return "ON DUPLICATE KEY UPDATE " + ", ".join(sets)
+
+    def create_table(self, cur, ddl):
+        cur.execute(ddl)
+
+    def has_table(self, cur, table):
+        cur.execute("""
+            SELECT COUNT(*) FROM information_schema.tables
+            WHERE table_schema = DATABASE() AND table_name = %s
+        """, (table,))
+        return cur.fetchone()[0] == 1
+
+    def has_column(self, cur, table, column):
+        cur.execute("""
+            SELECT COUNT(*) FROM information_schema.columns
+            WHERE table_schema = DATABASE() AND table_name = %s AND column_name = %s
+        """, (table, column))
+        return cur.fetchone()[0] == 1
+
+    def has_index(self, cur, table, name):
+        cur.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics
+            WHERE table_schema = DATABASE() AND table_name = %s AND index_name = %s
+        """, (table, name))
+        return cur.fetchone()[0] > 0
+
+    def has_unique_index(self, cur, table, column):
+        """True if `column` alone carries a unique index."""
+        cur.execute("""
+            SELECT COUNT(*) FROM information_schema.statistics s
+            WHERE s.table_schema = DATABASE() AND s.table_name = %s AND s.non_unique = 0
+              AND s.column_name = %s AND s.seq_in_index = 1
+              AND NOT EXISTS (SELECT 1 FROM information_schema.statistics s2
+                              WHERE s2.table_schema = s.table_schema AND s2.table_name = s.table_name
+                                AND s2.index_name = s.index_name AND s2.seq_in_index = 2)
+        """, (table, column))
+        return cur.fetchone()[0] > 0
+
+    def is_duplicate(self, e):
+        return isinstance(e, self.connector.IntegrityError) and e.errno == DUPLICATE_KEY
+
+    def is_retryable(self, e):
+        """Deadlock victim or lock wait timeout: the same transaction can simply run again."""
+        return isinstance(e, self.Error) and e.errno in (DEADLOCK, LOCK_WAIT_TIMEOUT)
+
+class SQLiteConnection:
+    """
+    sqlite3 connection with the slice of the mysql.connector API DBHandler
+    and ConnectionPool use. Statements are translated once and cached:
+    %s placeholders become ?, and FOR UPDATE is dropped. Instead of row
+    locks, a transaction that locks or writes starts with BEGIN IMMEDIATE,
+    taking the database's single write lock up front, so a read-check-write
+    sequence cannot interleave with another writer. Plain reads outside a
+    transaction run in autocommit and, in WAL mode, never wait for writers.
+    """
+    WRITES = ("INSERT", "UPDATE", "DELETE", "REPLACE", "CREATE", "ALTER", "DROP", "SAVEPOINT")
+
+    def __init__(self, path, timeout):
+        # isolation_level=None: transactions are begun explicitly (see _prepare)
+        self._con = sqlite3.connect(path, timeout=timeout, isolation_level=None, check_same_thread=False,
+                                    detect_types=sqlite3.PARSE_DECLTYPES, cached_statements=256)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=FULL")  # fsync every commit: a booked sale survives a power cut
+        self._con.execute("PRAGMA foreign_keys=ON")
+        self._sql = {}
+
+    @property
+    def in_transaction(self):
+        return self._con.in_transaction
+
+    def cursor(self, **kw):
+        return SQLiteCursor(self)
+
+    def commit(self):
+        if self._con.in_transaction:
+            self._con.commit()
+
+    def rollback(self):
+        if self._con.in_transaction:
+            self._con.rollback()
+
+    def ping(self, reconnect=False):
+        self._con.execute("SELECT 1")
+
+    def consume_results(self):
+        pass
+
+    def close(self):
+        self._con.close()
+
+    def _prepare(self, sql):
+        stmt = self._sql.get(sql)
+        if stmt is None:
+            locking = "FOR UPDATE" in sql
+            text = sql.replace("FOR UPDATE", "").replace("%s", "?")
+            stmt = self._sql[sql] = (text, locking or text.lstrip().upper().startswith(self.WRITES))
+        if stmt[1] and not self._con.in_transaction:
+            self._con.execute("BEGIN IMMEDIATE")
+        return stmt[0]
+
+class SQLiteCursor:
+    def __init__(self, con):
+        self._con = con
+        self._cur = con._con.cursor()
+
+    def execute(self, sql, params=()):
+        self._cur.execute(self._con._prepare(sql), tuple(params))
+
+    def executemany(self, sql, seq):
+        self._cur.executemany(self._con._prepare(sql), seq)
+
+    def fetchone(self):
+        return self._cur.fetchone()
+
+    def fetchall(self):
+        return self._cur.fetchall()
+
+    def fetchmany(self, size=1):
+        return self._cur.fetchmany(size)
+
+    @property
+    def lastrowid(self):
+        return self._cur.lastrowid
+
+    @property
+    def rowcount(self):
+        return self._cur.rowcount
+
+    @property
+    def description(self):
+        return self._cur.description
+
+    def close(self):
+        self._cur.close()
+
+# Values go in as text in the formats the MySQL connector uses and come back
+# typed by the declared column type (DECIMAL/DATE/DATETIME)
+sqlite3.register_adapter(Decimal, str)
+sqlite3.register_adapter(Money, str)
+sqlite3.register_adapter(date, date.isoformat)
+sqlite3.register_adapter(datetime, lambda d: d.strftime("%Y-%m-%d %H:%M:%S"))
+sqlite3.register_converter("DECIMAL", lambda b: Decimal(b.decode()).quantize(Decimal("0.01")))  # all DECIMAL(x,2)
+sqlite3.register_converter("DATE", lambda b: date.fromisoformat(b.decode()[:10]))
+sqlite3.register_converter("DATETIME", lambda b: datetime.fromisoformat(b.decode()))
+
+class SQLiteBackend(MySQLBackend):
+    """
+    Embedded SQLite file (WAL mode) with the same tables and indexes: no
+    server and no network round trips, for a shop with a single till.
+    """
+    name = "sqlite"
+    Error = sqlite3.Error
+    NOW = "datetime('now', 'localtime')"
+    TODAY = "date('now', 'localtime')"
+    NULL_SAFE_EQ = "IS"
+    PERIOD_BUCKETS = {
+        "day": "date({col})",
+        "week": "date({col}, '-6 days', 'weekday 1')",
+        "month": "date({col}, 'start of month')",
+    }
+
+    def __init__(self, cfg):
+        self.cfg = cfg  # no MySQL driver needed
+
+    def connect(self):
+        return SQLiteConnection(self.cfg.SQLITE_PATH, self.cfg.POOL_TIMEOUT)
+
+    def now_plus_seconds(self, seconds):
+        return f"datetime('now', 'localtime', '+' || {seconds} || ' seconds')"
+
+    def least_date(self, value, other):
+        return f"MIN(date({value}), {other})"
+
+    def greatest_date(self, value, other):
+        return f"MAX(date({value}), {other})"
+
+    def to_date(self, value):
+        return date.fromisoformat(value) if isinstance(value, str) else value
+
+    def day_number(self, value):
+        # date() first: julianday() of a DATETIME after noon would round into the next day
+        return f"CAST(julianday(date({value})) AS INTEGER)"
+
+    def upsert(self, table, keys, replace=(), add=()):
+        sets = [f"{c} = excluded.{c}" for c in replace] + [f"{c} = {table}.{c} + excluded.{c}" for c in add]
+        return f"ON CONFLICT ({', '.join(keys)}) DO UPDATE SET " + ", ".join(sets)
+
+    # MySQL DDL as DBHandler writes it -> SQLite: inline KEYs become CREATE INDEX
+    _INLINE_KEY = re.compile(r",\s*KEY (\w+) (\([^)]*\))")
+
+    def create_table(self, cur, ddl):
+        table = re.search(r"EXISTS (\w+)", ddl).group(1)
+        keys = self._INLINE_KEY.findall(ddl)
+        ddl = self._INLINE_KEY.sub("", ddl).replace("ENGINE=InnoDB", "")
+        ddl = re.sub(r"\b(BIG)?INT AUTO_INCREMENT PRIMARY KEY", "INTEGER PRIMARY KEY AUTOINCREMENT", ddl)
+        cur.execute(ddl)
+        for name, cols in keys:
+            cur.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {table} {cols}")
+
+    def has_table(self, cur, table):
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'table' AND name = %s", (table,))
+        return cur.fetchone()[0] == 1
+
+    def has_column(self, cur, table, column):
+        cur.execute("SELECT COUNT(*) FROM pragma_table_info(%s) WHERE name = %s", (table, column))
+        return cur.fetchone()[0] == 1
+
+    def has_index(self, cur, table, name):
+        cur.execute("SELECT COUNT(*) FROM sqlite_master WHERE type = 'index' AND tbl_name = %s AND name = %s",
+                    (table, name))
+        return cur.fetchone()[0] > 0
+
+    def has_unique_index(self, cur, table, column):
+        cur.execute("""
+            SELECT COUNT(*) FROM pragma_index_list(%s) l
+            WHERE l."unique" = 1
+              AND (SELECT COUNT(*) FROM pragma_index_info(l.name)) = 1
+              AND (SELECT name FROM pragma_index_info(l.name)) = %s
+        """, (table, column))
+        return cur.fetchone()[0] > 0
+
+    def is_duplicate(self, e):
+        return isinstance(e, sqlite3.IntegrityError) and "UNIQUE" in str(e)
+
+    def is_retryable(self, e):
+        # The write lock stayed busy for the whole busy timeout
+        return isinstance(e, sqlite3.OperationalError) and "locked" in str(e)
+
+BACKENDS = {"mysql": MySQLBackend, "sqlite": SQLiteBackend}
 
 # ---------------------------
 # Database handler
 # ---------------------------
+class StockError(ValueError):
+    """A sale asked for a product that does not exist or is out of stock."""
+
+class SchemaError(RuntimeError):
+    """The database lacks a column or table a feature needs (see `pos.py setup-db`)."""
+
+class DBError(RuntimeError):
+    """A DBHandler call failed; raised by raise_error where there is nobody to show a dialog to."""
+
+def raise_error(title, msg):
+    """DBHandler.report_error for headless use: the caller gets an exception instead of None/[]."""
+    raise DBError(f"{title}: {msg}")
+
+DUPLICATE_KEY = 1062
+LOCK_WAIT_TIMEOUT = 1205
+DEADLOCK = 1213
+# Errors that mean "the server cannot be reached" rather than "this sale is wrong".
+# Lock wait timeouts and deadlocks are contention, retried by DBHandler._retry.
+CONNECTION_ERRNOS = {1040, 2002, 2003, 2005, 2006, 2013, 2055}
+
+def is_connection_error(e):
+    if isinstance(e, sqlite3.OperationalError):
+        # "database is locked" is contention: SQLiteBackend.is_retryable
+        return "unable to open" in str(e)
+    # Nothing raised a MySQL error unless MySQLBackend imported the driver
+    connector = sys.modules.get("mysql.connector")
+    return isinstance(e, PoolTimeout) or (connector is not None and isinstance(e, connector.Error)
+                                          and e.errno in CONNECTION_ERRNOS)
+
 class DBHandler:
     def __init__(self, cfg: DBConfig):
         self.cfg = cfg
+        self.backend = BACKENDS[cfg.BACKEND](cfg)
+        self.pool = ConnectionPool(
+            self.backend.connect,
+            size=cfg.POOL_SIZE,
+            timeout=cfg.POOL_TIMEOUT,
+            validate_idle=cfg.POOL_VALIDATE_IDLE
+        )
+        self.catalog = ProductCatalog()
+        self._has_rollup = None     # rollup tables present? (checked lazily)
+        self._has_sale_keys = None  # venta.clave_idempotencia present?
+        self._has_reservations = None  # reserva_stock present?
+        self._has_change_feed = None  # producto_cambio present?
+        self._contention = {"retries": 0, "gave_up": 0}
+        self._contention_lock = threading.Lock()
+        TRACE.enabled = cfg.TRACE_CALLS
+        TRACE.resize(cfg.TRACE_BUFFER)
+        # How errors reach the cashier. The GUI swaps this for a version that
+        # hops to the Tk thread, since DB methods may run on worker threads.
+        self.report_error = messagebox.showerror if messagebox else raise_error
 
     def connect(self):
+        """Checks out a pooled connection; call close() to return it."""
         try:
-            return mysql.connector.connect(
-                host=self.cfg.HOST,
-                user=self.cfg.USER,
-                password=self.cfg.PASSWORD,
-                database=self.cfg.DATABASE,
-                autocommit=False
-            )
-        except mysql.connector.Error as e:
-            messagebox.showerror("DB Error", f"Cannot connect to database: {e}")
+            return self.pool.acquire()
+        except (self.backend.Error, PoolTimeout) as e:
+            self.report_error("DB Error", f"Cannot connect to database: {e}")
             return None
 
+    def pool_stats(self):
+        return self.pool.stats()
+
+    def contention_stats(self):
+        with self._contention_lock:
+            return dict(self._contention)
+
+    def _retry(self, fn, *args):
+        """Runs a transaction, retrying deadlocks and lock wait timeouts with jittered exponential backoff."""
+        for attempt in range(self.cfg.DEADLOCK_RETRIES + 1):
+            try:
+                return fn(*args)
+            except self.backend.Error as e:
+                if not self.backend.is_retryable(e):
+                    raise
+                with self._contention_lock:
+                    self._contention["gave_up" if attempt == self.cfg.DEADLOCK_RETRIES else "retries"] += 1
+                if attempt == self.cfg.DEADLOCK_RETRIES:
+                    raise
+                time.sleep(self.cfg.RETRY_BACKOFF * 2 ** attempt * random.uniform(0.5, 1.5))
+
+    def close(self):
+        self.pool.close_all()
+
     # Inventory queries
-    def get_all_products(self):
+    PRODUCT_COLUMNS = "id_producto, nombre, precio_compra, precio_venta, cantidad, sku"
+
+    def get_all_products(self, reload=False):
+        """Served from the catalog cache; reads the whole table only on first use or reload."""
+        rows = None if reload else self.catalog.rows()
+        if rows is not None:
+            return rows
+        con = self.connect()
+        if not con:
+            return []
+        try:
+            cur = con.cursor()
+            cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto ORDER BY id_producto")
+            rows = cur.fetchall()
+        finally:
+            con.close()
+        self.catalog.load(rows)
+        return rows
+
+    def get_products_page(self, after_id=None, limit=200):
+        """Products ordered by id_producto, starting after after_id (keyset pagination)."""
+        rows = self.catalog.page(after_id, limit)
+        if rows is not None:
+            return rows
         con = self.connect()
         if not con:
             return []
-        cur = con.cursor()
-        cur.execute("SELECT id_producto, nombre, precio_compra, precio_venta, cantidad, sku FROM producto ORDER BY id_producto")
-        rows = cur.fetchall()
-        con.close()
+        try:
+            cur = con.cursor()
+            if after_id is None:
+                cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto ORDER BY id_producto LIMIT %s", (limit,))
+            else:
+                cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto WHERE id_producto > %s ORDER BY id_producto LIMIT %s", (after_id, limit))
+            rows = cur.fetchall()
+        finally:
+            con.close()
+        self.catalog.apply_rows(rows)
         return rows
 
+    def _fetch_products(self, cur, ids):
+        marks = ",".join(["%s"] * len(ids))
+        cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto WHERE id_producto IN ({marks})", list(ids))
+        return cur.fetchall()
+
     def add_product(self, nombre, categoria, precio_compra, precio_venta, cantidad, sku):
         con = self.connect()
         if not con:
@@ -55,11 +1217,14 @@ class DBHandler:
                 INSERT INTO producto (nombre, categoria, precio_compra, precio_venta, cantidad, sku)
                 VALUES (%s,%s,%s,%s,%s,%s)
             """, (nombre, categoria, precio_compra, precio_venta, cantidad, sku))
+            rows = self._fetch_products(cur, [cur.lastrowid])
+            self._log_changes(cur, [(r[0], "U", None) for r in rows])
             con.commit()
+            self.catalog.apply_rows(rows)
             return True
-        except mysql.connector.Error as e:
+        except self.backend.Error as e:
             con.rollback()
-            messagebox.showerror("DB Error", f"Error adding product: {e}")
+            self.report_error("DB Error", f"Error adding product: {e}")
             return False
         finally:
             con.close()
@@ -71,11 +1236,52 @@ class DBHandler:
         try:
             cur = con.cursor()
             cur.execute("UPDATE producto SET cantidad=%s WHERE id_producto=%s", (new_quantity, id_producto))
+            self._log_changes(cur, [(id_producto, "S", new_quantity)])
+            con.commit()
+            self.catalog.apply_stock({id_producto: new_quantity})
+            return True
+        except self.backend.Error as e:
+            con.rollback()
+            self.report_error("DB Error", f"Error updating quantity: {e}")
+            return False
+        finally:
+            con.close()
+
+    def update_product(self, id_producto, nombre, precio_compra, precio_venta, cantidad):
+        con = self.connect()
+        if not con:
+            return False
+        try:
+            cur = con.cursor()
+            cur.execute("""
+                UPDATE producto SET nombre=%s, precio_compra=%s, precio_venta=%s, cantidad=%s WHERE id_producto=%s
+            """, (nombre, str(precio_compra), str(precio_venta), cantidad, id_producto))
+            rows = self._fetch_products(cur, [id_producto])
+            self._log_changes(cur, [(id_producto, "U", None)])
             con.commit()
+            self.catalog.apply_rows(rows)
             return True
-        except mysql.connector.Error as e:
+        except self.backend.Error as e:
             con.rollback()
-            messagebox.showerror("DB Error", f"Error updating quantity: {e}")
+            self.report_error("DB Error", f"Error actualizando producto: {e}")
+            return False
+        finally:
+            con.close()
+
+    def delete_product(self, id_producto):
+        con = self.connect()
+        if not con:
+            return False
+        try:
+            cur = con.cursor()
+            cur.execute("DELETE FROM producto WHERE id_producto=%s", (id_producto,))
+            self._log_changes(cur, [(id_producto, "D", None)])
+            con.commit()
+            self.catalog.remove([id_producto])
+            return True
+        except self.backend.Error as e:
+            con.rollback()
+            self.report_error("DB Error", f"Error eliminando producto: {e}")
             return False
         finally:
             con.close()
@@ -84,117 +1290,2044 @@ class DBHandler:
         con = self.connect()
         if not con:
             return None
-        cur = con.cursor()
-        cur.execute("SELECT id_producto, nombre, precio_compra, precio_venta, cantidad, sku FROM producto WHERE id_producto=%s", (id_producto,))
-        row = cur.fetchone()
-        con.close()
+        try:
+            cur = con.cursor()
+            cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto WHERE id_producto=%s", (id_producto,))
+            row = cur.fetchone()
+        finally:
+            con.close()
+        # Fresh read: keep the cache in step with what the caller is about to edit
+        if row:
+            self.catalog.apply_rows([row])
+        else:
+            self.catalog.remove([id_producto])
         return row
 
-    # Sales transaction: create venta and venta_detalle, deduct inventory
-    def create_sale(self, items):
-        """
-        items: list of dicts: {id_producto, cantidad, precio_unitario}
-        Returns sale_id on success, None on failure.
-        """
-        con = self.connect()
-        if not con:
-            return None
-        try:
-            cur = con.cursor()
-            # Check stock for all items first
-            for it in items:
-                cur.execute("SELECT cantidad FROM producto WHERE id_producto=%s FOR UPDATE", (it['id_producto'],))
-                row = cur.fetchone()
-                if not row:
-                    raise ValueError(f"Producto ID {it['id_producto']} no existe")
-                stock = row[0]
-                if it['cantidad'] > stock:
-                    raise ValueError(f"Stock insuficiente para producto ID {it['id_producto']} (disponible {stock})")
-
-            # Calculate total
-            total = Decimal('0.00')
-            for it in items:
-                subtotal = Decimal(str(it['precio_unitario'])) * Decimal(it['cantidad'])
-                it['subtotal'] = subtotal.quantize(Decimal('0.01'))
-                total += it['subtotal']
+    # Sales transaction: create venta and venta_detalle, deduct inventory
+    def create_sale(self, items):
+        """
+        items: list of dicts: {id_producto, cantidad, precio_unitario}, the price
+        as Money or anything Money.of() takes. Returns sale_id on success, None on failure.
+        """
+        try:
+            return self.book_sale(items)
+        except Exception as e:
+            self.report_error("Venta Error", f"No se pudo completar la venta: {e}")
+            return None
+
+    def book_sale(self, items, idempotency_key=None, fecha=None, allow_negative=False, cart_key=None):
+        """
+        create_sale() without the error dialog: raises StockError for unknown
+        products or insufficient stock, and the backend's Error / PoolTimeout
+        when the database cannot be reached. Deadlocks are retried.
+
+        idempotency_key: booking the same key twice returns the first sale id
+        fecha: when the sale happened (offline sales), defaults to NOW()
+        allow_negative: skip the stock check (for reviewed offline conflicts)
+        cart_key: the cart's stock reservations (MULTI_REGISTER), released on success
+        """
+        return self._retry(self._book_sale, items, idempotency_key, fecha, allow_negative, cart_key)
+
+    def _book_sale(self, items, idempotency_key, fecha, allow_negative, cart_key):
+        con = self.pool.acquire()
+        try:
+            sale_id, stock = self._insert_sale(con.cursor(), items, idempotency_key, fecha, allow_negative, cart_key)
+            con.commit()
+            self.catalog.apply_stock(stock)
+            return sale_id
+        except self.backend.Error as e:
+            con.rollback()
+            if idempotency_key and self.backend.is_duplicate(e):
+                # Another syncer booked this key between our check and insert
+                return self._sale_for_key(idempotency_key)
+            raise
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def book_sales(self, sales):
+        """
+        Books several sales in one transaction, so they share one commit (and
+        one log flush). sales: dicts with items and optionally idempotency_key,
+        fecha and cart_key, as book_sale() takes them.
+
+        Returns one entry per sale, in order: its id, or the StockError /
+        ValueError / SchemaError that sale raised (its changes are rolled back
+        to a savepoint; the rest still commit). Database errors abort the whole
+        batch and are raised; deadlocks retry the whole batch.
+        """
+        return self._retry(self._book_sales, sales)
+
+    def _book_sales(self, sales):
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            results, stock = [], {}
+            for sale in sales:
+                cur.execute("SAVEPOINT venta")
+                try:
+                    sale_id, new = self._insert_sale(cur, sale["items"], sale.get("idempotency_key"), sale.get("fecha"),
+                                                     False, sale.get("cart_key"))
+                except (ValueError, SchemaError) as e:
+                    cur.execute("ROLLBACK TO SAVEPOINT venta")
+                    results.append(e)
+                    continue
+                cur.execute("RELEASE SAVEPOINT venta")
+                results.append(sale_id)
+                stock.update(new)
+            con.commit()
+            self.catalog.apply_stock(stock)
+            return results
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def _insert_sale(self, cur, items, idempotency_key, fecha, allow_negative, cart_key):
+        """
+        The statements of one sale, on cur's open transaction. Returns
+        (sale_id, {id_producto: new cantidad}); the caller commits.
+        """
+        if not items:
+            raise ValueError("La venta no tiene productos")
+        # Schema checks reuse this connection: the background syncer must not
+        # go through connect(), which reports every failure in a dialog
+        if self._has_rollup is None:
+            self._has_rollup = self._check_rollup(cur)
+        rollup = self._has_rollup
+        if idempotency_key:
+            if self._has_sale_keys is None:
+                self._has_sale_keys = self.backend.has_column(cur, "venta", "clave_idempotencia")
+            if not self._has_sale_keys:
+                raise SchemaError("Falta la columna venta.clave_idempotencia: ejecute 'python pos.py setup-db'")
+            cur.execute("SELECT id_venta FROM venta WHERE clave_idempotencia=%s", (idempotency_key,))
+            row = cur.fetchone()
+            if row:
+                return row[0], {}
+        ids = sorted({it['id_producto'] for it in items})
+        marks = ",".join(["%s"] * len(ids))
+        wanted = {}
+        for it in items:
+            wanted[it['id_producto']] = wanted.get(it['id_producto'], 0) + it['cantidad']
+        cases = " ".join(["WHEN %s THEN %s"] * len(ids))
+        case_params = [v for idp in ids for v in (idp, wanted[idp])]
+
+        if self.cfg.MULTI_REGISTER:
+            self._require_reservations(cur)
+            # Optimistic: one conditional decrement instead of a locking read.
+            # A product that no longer has enough stock (net of other carts'
+            # live reservations) is simply not updated.
+            t0 = time.perf_counter()
+            cur.execute(f"""
+                UPDATE producto SET cantidad = cantidad - CASE id_producto {cases} END
+                WHERE id_producto IN ({marks})
+                  AND (%s OR cantidad - {self.RESERVED_BY_OTHERS} >= CASE id_producto {cases} END)
+            """, case_params + ids + [bool(allow_negative), cart_key] + case_params)
+            TRACE.note(lock_ms=(time.perf_counter() - t0) * 1000)
+            updated = cur.rowcount
+            cur.execute(f"SELECT id_producto, cantidad FROM producto WHERE id_producto IN ({marks})", ids)
+            stock = dict(cur.fetchall())  # new quantities: our update holds the row locks
+            if updated != len(ids):
+                for it in items:
+                    idp = it['id_producto']
+                    if idp not in stock:
+                        raise StockError(f"Producto ID {idp} no existe")
+                # Report the first line that did not fit, with what is available to this cart
+                cur.execute(f"""
+                    SELECT id_producto, cantidad - {self.RESERVED_BY_OTHERS}
+                    FROM producto WHERE id_producto IN ({marks})
+                """, [cart_key] + ids)
+                available = {idp: int(n) for idp, n in cur.fetchall()}
+                for it in items:
+                    idp = it['id_producto']
+                    if wanted[idp] > available[idp]:
+                        raise StockError(f"Stock insuficiente para producto ID {idp} (disponible {available[idp]})")
+                raise StockError("Stock insuficiente")
+            stock = {idp: n + wanted[idp] for idp, n in stock.items()}
+        else:
+            # Lock and read every product in one round trip. Rows are locked in
+            # ascending id order so two registers never wait on each other in a cycle.
+            t0 = time.perf_counter()
+            cur.execute(f"""
+                SELECT id_producto, cantidad FROM producto
+                WHERE id_producto IN ({marks})
+                ORDER BY id_producto
+                FOR UPDATE
+            """, ids)
+            stock = dict(cur.fetchall())
+            TRACE.note(lock_ms=(time.perf_counter() - t0) * 1000)
+
+            # Check stock for all items first (same order and messages as the cart)
+            seen = {}
+            for it in items:
+                idp = it['id_producto']
+                if idp not in stock:
+                    raise StockError(f"Producto ID {idp} no existe")
+                seen[idp] = seen.get(idp, 0) + it['cantidad']
+                if seen[idp] > stock[idp] and not allow_negative:
+                    raise StockError(f"Stock insuficiente para producto ID {idp} (disponible {stock[idp]})")
+
+        # Sale total in integer cents (cart prices are already Money)
+        prices = [Money.of(it['precio_unitario']) for it in items]
+        total = Money(sum(p.cents * it['cantidad'] for p, it in zip(prices, items)))
+
+        # Insert venta
+        if idempotency_key:
+            cur.execute(f"INSERT INTO venta (fecha, total, clave_idempotencia) VALUES (COALESCE(%s, {self.backend.NOW}), %s, %s)",
+                        (fecha, str(total), idempotency_key))
+        else:
+            cur.execute(f"INSERT INTO venta (fecha, total) VALUES (COALESCE(%s, {self.backend.NOW}), %s)", (fecha, str(total)))
+        sale_id = cur.lastrowid
+
+        # Insert all detalles at once (the connector rewrites this into a multi-row INSERT)
+        cur.executemany("""
+            INSERT INTO venta_detalle (id_venta, id_producto, cantidad, precio_unitario, subtotal)
+            VALUES (%s,%s,%s,%s,%s)
+        """, [(sale_id, it['id_producto'], it['cantidad'], str(p), money_text(p.cents * it['cantidad']))
+              for p, it in zip(prices, items)])
+
+        if not self.cfg.MULTI_REGISTER:
+            # Deduct stock for every product with a single set-based UPDATE
+            cur.execute(f"""
+                UPDATE producto SET cantidad = cantidad - CASE id_producto {cases} END
+                WHERE id_producto IN ({marks})
+            """, case_params + ids)
+        if cart_key and self._has_reservations:
+            cur.execute("DELETE FROM reserva_stock WHERE clave_carrito=%s", (cart_key,))
+
+        # Stock was read under lock, so the new quantities are exact
+        new_stock = {idp: stock[idp] - wanted[idp] for idp in ids}
+        self._log_changes(cur, [(idp, "S", n) for idp, n in new_stock.items()])
+
+        # Last, so the per-day rollup row is locked for as short as possible
+        if rollup:
+            self._update_rollup(cur, sale_id)
+        return sale_id, new_stock
+
+    # Stock reservations (MULTI_REGISTER)
+    @property
+    def RESERVED_BY_OTHERS(self):
+        """Units other carts hold on a producto row; the bound parameter is the cart asking (NULL counts every cart)."""
+        return f"""(
+            SELECT COALESCE(SUM(r.cantidad), 0) FROM reserva_stock r
+            WHERE r.id_producto = producto.id_producto AND r.expira > {self.backend.NOW}
+              AND NOT (r.clave_carrito {self.backend.NULL_SAFE_EQ} %s))"""
+
+    def _require_reservations(self, cur):
+        if self._has_reservations is None:
+            self._has_reservations = self.backend.has_table(cur, "reserva_stock")
+        if not self._has_reservations:
+            raise SchemaError("Falta la tabla reserva_stock: ejecute 'python pos.py setup-db'")
+
+    def reserve_stock(self, cart_key, id_producto, cantidad):
+        """
+        Sets how many units of a product the cart holds (replacing its previous
+        hold) and renews every hold of the cart for RESERVATION_TTL seconds.
+        Returns the units still available to other carts; raises StockError
+        when the product does not exist or the units are not there.
+        """
+        return self._retry(self._reserve_stock, cart_key, id_producto, cantidad)
+
+    def _reserve_stock(self, cart_key, id_producto, cantidad):
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            self._require_reservations(cur)
+            # The product row lock serializes reservations of one product, for a few ms
+            t0 = time.perf_counter()
+            cur.execute("SELECT cantidad FROM producto WHERE id_producto=%s FOR UPDATE", (id_producto,))
+            row = cur.fetchone()
+            TRACE.note(lock_ms=(time.perf_counter() - t0) * 1000)
+            if not row:
+                raise StockError(f"Producto ID {id_producto} no existe")
+            cur.execute(f"DELETE FROM reserva_stock WHERE id_producto=%s AND expira <= {self.backend.NOW}", (id_producto,))
+            cur.execute("""
+                SELECT COALESCE(SUM(cantidad), 0) FROM reserva_stock
+                WHERE id_producto=%s AND clave_carrito <> %s
+            """, (id_producto, cart_key))
+            available = row[0] - int(cur.fetchone()[0])
+            if cantidad > available:
+                raise StockError(f"Stock insuficiente para producto ID {id_producto} (disponible {available})")
+            expira = self.backend.now_plus_seconds("%s")
+            cur.execute(f"""
+                INSERT INTO reserva_stock (clave_carrito, id_producto, cantidad, expira)
+                VALUES (%s, %s, %s, {expira})
+                {self.backend.upsert("reserva_stock", ("clave_carrito", "id_producto"), replace=("cantidad", "expira"))}
+            """, (cart_key, id_producto, cantidad, self.cfg.RESERVATION_TTL))
+            cur.execute(f"UPDATE reserva_stock SET expira = {expira} WHERE clave_carrito=%s",
+                        (self.cfg.RESERVATION_TTL, cart_key))
+            con.commit()
+            return available - cantidad
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def release_stock(self, cart_key, id_producto=None):
+        """Drops the cart's hold on one product, or on everything."""
+        def release():
+            con = self.pool.acquire()
+            try:
+                cur = con.cursor()
+                if id_producto is None:
+                    cur.execute("DELETE FROM reserva_stock WHERE clave_carrito=%s", (cart_key,))
+                else:
+                    cur.execute("DELETE FROM reserva_stock WHERE clave_carrito=%s AND id_producto=%s", (cart_key, id_producto))
+                con.commit()
+            except Exception:
+                con.rollback()
+                raise
+            finally:
+                con.close()
+        self._retry(release)
+
+    def _sale_for_key(self, idempotency_key):
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT id_venta FROM venta WHERE clave_idempotencia=%s", (idempotency_key,))
+            return cur.fetchone()[0]
+        finally:
+            con.close()
+
+    # Change feed: every write to producto appends (id_producto, tipo, cantidad)
+    # rows to producto_cambio in the same transaction; registers follow it by seq.
+    # tipo: "S" new stock (cantidad), "U" row inserted/edited (re-read it),
+    # "D" deleted, "R" rows not identified (re-read the catalog)
+    def _log_changes(self, cur, changes):
+        if self._has_change_feed is None:
+            self._has_change_feed = self.backend.has_table(cur, "producto_cambio")
+        if not changes or not self._has_change_feed:
+            return
+        cur.executemany(f"""
+            INSERT INTO producto_cambio (id_producto, tipo, cantidad, fecha) VALUES (%s, %s, %s, {self.backend.NOW})
+        """, changes)
+
+    def has_change_feed(self):
+        if self._has_change_feed is None:
+            con = self.pool.acquire()
+            try:
+                self._has_change_feed = self.backend.has_table(con.cursor(), "producto_cambio")
+            finally:
+                con.close()
+        return self._has_change_feed
+
+    def last_change_seq(self):
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT COALESCE(MAX(seq), 0) FROM producto_cambio")
+            return cur.fetchone()[0]
+        finally:
+            con.close()
+
+    def get_changes(self, after, limit=1000, missing=()):
+        """(seq, id_producto, tipo, cantidad) rows after seq `after`, plus the `missing` seqs that exist now, by seq."""
+        sql = "SELECT seq, id_producto, tipo, cantidad FROM producto_cambio WHERE seq > %s"
+        params = [after]
+        if missing:
+            sql += f" OR seq IN ({','.join(['%s'] * len(missing))})"
+            params += list(missing)
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            cur.execute(sql + " ORDER BY seq LIMIT %s", params + [limit])
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def apply_changes(self, changes):
+        """
+        Patches the catalog with get_changes() rows. Returns the ids touched,
+        or None when a change asked for the whole catalog to be re-read.
+        """
+        stock, reread, removed = {}, set(), set()
+        for _, idp, tipo, cantidad in changes:
+            if tipo == "R":
+                self.catalog.invalidate()
+                return None
+            if tipo == "S":
+                stock[idp] = cantidad
+            elif tipo == "U":
+                reread.add(idp)
+            else:
+                removed.add(idp)
+        if not self.catalog.loaded:
+            # Nothing to patch: views read their pages from the database until the next full load
+            return set(stock) | reread | removed
+        rows = []
+        if reread:
+            con = self.pool.acquire()
+            try:
+                rows = self._fetch_products(con.cursor(), sorted(reread))
+            finally:
+                con.close()
+        self.catalog.remove(removed | (reread - {r[0] for r in rows}))
+        self.catalog.apply_stock({idp: n for idp, n in stock.items() if idp not in removed})
+        # Re-read rows are current, newer than any stock change in this batch
+        self.catalog.apply_rows(rows)
+        return set(stock) | reread | removed
+
+    def prune_changes(self, keep_seconds):
+        """Deletes producto_cambio rows older than keep_seconds; returns how many."""
+        if not self.has_change_feed():
+            return 0
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            cur.execute("DELETE FROM producto_cambio WHERE fecha < %s", (datetime.now() - timedelta(seconds=keep_seconds),))
+            con.commit()
+            return cur.rowcount
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    # Reports
+    def get_sales(self, start_date=None, end_date=None):
+        con = self.connect()
+        if not con:
+            return []
+        try:
+            cur = con.cursor()
+            if start_date and end_date:
+                cur.execute("""
+                    SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.nombre, d.cantidad, d.precio_unitario, d.subtotal
+                    FROM venta v
+                    JOIN venta_detalle d ON v.id_venta = d.id_venta
+                    JOIN producto p ON d.id_producto = p.id_producto
+                    WHERE v.fecha BETWEEN %s AND %s
+                    ORDER BY v.fecha DESC, v.id_venta DESC
+                """, (start_date, end_date))
+            else:
+                cur.execute("""
+                    SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.nombre, d.cantidad, d.precio_unitario, d.subtotal
+                    FROM venta v
+                    JOIN venta_detalle d ON v.id_venta = d.id_venta
+                    JOIN producto p ON d.id_producto = p.id_producto
+                    ORDER BY v.fecha DESC, v.id_venta DESC
+                """)
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    def get_sales_page(self, after=None, limit=200, start_date=None, end_date=None):
+        """
+        Same rows as get_sales(), newest first, one page at a time.
+        after: (fecha, id_venta, id_detalle) of the last row already shown, or None.
+        start_date is inclusive and end_date exclusive, so both can be plain dates.
+        """
+        where, params = [], []
+        if start_date:
+            where.append("v.fecha >= %s")
+            params.append(start_date)
+        if end_date:
+            where.append("v.fecha < %s")
+            params.append(end_date)
+        if after is not None:
+            fecha, id_venta, id_detalle = after
+            where.append("(v.fecha < %s OR (v.fecha = %s AND (v.id_venta < %s OR (v.id_venta = %s AND d.id_detalle < %s))))")
+            params += [fecha, fecha, id_venta, id_venta, id_detalle]
+        con = self.connect()
+        if not con:
+            return []
+        try:
+            cur = con.cursor()
+            cur.execute(f"""
+                SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.nombre, d.cantidad, d.precio_unitario, d.subtotal
+                FROM venta v
+                JOIN venta_detalle d ON v.id_venta = d.id_venta
+                JOIN producto p ON d.id_producto = p.id_producto
+                {"WHERE " + " AND ".join(where) if where else ""}
+                ORDER BY v.fecha DESC, v.id_venta DESC, d.id_detalle DESC
+                LIMIT %s
+            """, params + [limit])
+            return cur.fetchall()
+        finally:
+            con.close()
+
+    # Aggregated reports: the grouping happens in the database, only totals
+    # come back (buckets: backend.PERIOD_BUCKETS).
+
+    # Indexes the report queries rely on (see ensure_indexes)
+    REPORT_INDEXES = [
+        # date-range scans and keyset paging on (fecha, id_venta)
+        ("venta", "idx_venta_fecha", "(fecha, id_venta)"),
+        # covers the detail side of the aggregates without touching the clustered rows
+        ("venta_detalle", "idx_detalle_venta", "(id_venta, id_producto, cantidad, subtotal)"),
+    ]
+
+    # Daily rollups, kept current by create_sale and rebuilt by rebuild_rollup().
+    # Closed days are read from here; only today's rows come from venta_detalle.
+    ROLLUP_TABLES = [
+        """
+        CREATE TABLE IF NOT EXISTS venta_resumen_dia (
+            fecha DATE NOT NULL PRIMARY KEY,
+            ventas INT NOT NULL,
+            cantidad INT NOT NULL,
+            ingreso DECIMAL(14,2) NOT NULL,
+            costo DECIMAL(14,2) NOT NULL
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS venta_resumen_producto (
+            fecha DATE NOT NULL,
+            id_producto INT NOT NULL,
+            cantidad INT NOT NULL,
+            ingreso DECIMAL(14,2) NOT NULL,
+            costo DECIMAL(14,2) NOT NULL,
+            PRIMARY KEY (fecha, id_producto),
+            KEY idx_resumen_producto (id_producto, fecha)
+        ) ENGINE=InnoDB
+        """,
+    ]
+
+    # Same aggregates for the incremental path (one sale) and the rebuild (a date range),
+    # so both always agree. Cost is quantity * precio_compra at the time it runs.
+    ROLLUP_SELECT = {
+        "venta_resumen_dia": """
+            INSERT INTO venta_resumen_dia (fecha, ventas, cantidad, ingreso, costo)
+            SELECT DATE(v.fecha), COUNT(DISTINCT v.id_venta), SUM(d.cantidad), SUM(d.subtotal), SUM(d.cantidad * p.precio_compra)
+            FROM venta v
+            JOIN venta_detalle d ON v.id_venta = d.id_venta
+            JOIN producto p ON d.id_producto = p.id_producto
+            WHERE {where}
+            GROUP BY DATE(v.fecha)
+        """,
+        "venta_resumen_producto": """
+            INSERT INTO venta_resumen_producto (fecha, id_producto, cantidad, ingreso, costo)
+            SELECT DATE(v.fecha), d.id_producto, SUM(d.cantidad), SUM(d.subtotal), SUM(d.cantidad * p.precio_compra)
+            FROM venta v
+            JOIN venta_detalle d ON v.id_venta = d.id_venta
+            JOIN producto p ON d.id_producto = p.id_producto
+            WHERE {where}
+            GROUP BY DATE(v.fecha), d.id_producto
+        """,
+    }
+    ROLLUP_KEYS = {
+        "venta_resumen_dia": ("fecha",),
+        "venta_resumen_producto": ("fecha", "id_producto"),
+    }
+    ROLLUP_COLUMNS = {
+        "venta_resumen_dia": ("ventas", "cantidad", "ingreso", "costo"),
+        "venta_resumen_producto": ("cantidad", "ingreso", "costo"),
+    }
+
+    def has_rollup(self):
+        """True once the rollup tables exist (checked once per process)."""
+        if self._has_rollup is None:
+            con = self.connect()
+            if not con:
+                return False
+            try:
+                self._has_rollup = self._check_rollup(con.cursor())
+            finally:
+                con.close()
+        return self._has_rollup
+
+    def _check_rollup(self, cur):
+        return all(self.backend.has_table(cur, t) for t in self.ROLLUP_SELECT)
+
+    def _update_rollup(self, cur, sale_id):
+        for table, select in self.ROLLUP_SELECT.items():
+            upsert = self.backend.upsert(table, self.ROLLUP_KEYS[table], add=self.ROLLUP_COLUMNS[table])
+            cur.execute(select.format(where="v.id_venta = %s") + upsert, (sale_id,))
+
+    def rebuild_rollup(self, start_date=None, end_date=None, progress=None):
+        """
+        Recomputes the rollups for [start_date, end_date) from venta_detalle, one
+        month per transaction. Defaults to the whole history. Returns days rebuilt.
+        Historic cost uses today's precio_compra (the purchase price at sale time is not stored).
+        Raises when the database cannot be reached: 0 days would pass for an empty history.
+        """
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            for ddl in self.ROLLUP_TABLES:
+                self.backend.create_table(cur, ddl)
+            self._has_rollup = True
+            if start_date is None:
+                cur.execute("SELECT DATE(MIN(fecha)) FROM venta")
+                start_date = self.backend.to_date(cur.fetchone()[0]) or date.today()
+            if end_date is None:
+                end_date = date.today() + timedelta(days=1)
+            con.commit()
+
+            chunk = start_date
+            while chunk < end_date:
+                chunk_end = min(period_end("month", chunk.replace(day=1)), end_date)
+                for table, select in self.ROLLUP_SELECT.items():
+                    cur.execute(f"DELETE FROM {table} WHERE fecha >= %s AND fecha < %s", (chunk, chunk_end))
+                    cur.execute(select.format(where="v.fecha >= %s AND v.fecha < %s"), (chunk, chunk_end))
+                con.commit()
+                if progress:
+                    progress(chunk, chunk_end)
+                chunk = chunk_end
+            return (end_date - start_date).days
+        except Exception:
+            con.rollback()
+            raise
+        finally:
+            con.close()
+
+    def get_sales_summary(self, period, start_date, end_date):
+        """
+        Totals per day/week/month in [start_date, end_date), newest first:
+        (periodo, ventas, unidades, ingreso, costo, margen), amounts as Money
+        """
+        bucket = self.backend.PERIOD_BUCKETS[period]
+        raw = f"""
+            SELECT {bucket.format(col="v.fecha")} AS periodo, COUNT(DISTINCT v.id_venta) AS ventas,
+                   SUM(d.cantidad) AS cantidad, SUM(d.subtotal) AS ingreso, SUM(d.cantidad * p.precio_compra) AS costo
+            FROM venta v
+            JOIN venta_detalle d ON v.id_venta = d.id_venta
+            JOIN producto p ON d.id_producto = p.id_producto
+            WHERE v.fecha >= {{lo}} AND v.fecha < %s
+            GROUP BY periodo
+        """
+        if self.has_rollup():
+            sql = f"""
+                SELECT {bucket.format(col="r.fecha")} AS periodo, r.ventas, r.cantidad, r.ingreso, r.costo
+                FROM venta_resumen_dia r
+                WHERE r.fecha >= %s AND r.fecha < {self.backend.least_date("%s", self.backend.TODAY)}
+                UNION ALL
+            """ + raw.format(lo=self.backend.greatest_date("%s", self.backend.TODAY))
+            params = (start_date, end_date, start_date, end_date)
+        else:
+            sql = raw.format(lo="%s")
+            params = (start_date, end_date)
+        con = self.connect()
+        if not con:
+            return []
+        try:
+            cur = con.cursor()
+            cur.execute(f"""
+                SELECT periodo, SUM(ventas), SUM(cantidad), SUM(ingreso), SUM(costo), SUM(ingreso) - SUM(costo)
+                FROM ({sql}) t
+                GROUP BY periodo
+                ORDER BY periodo DESC
+            """, params)
+            # SQLite sums DECIMAL columns as floats; Money rounds them back to cents
+            return [(self.backend.to_date(r[0]), r[1], r[2], Money.of(r[3]), Money.of(r[4]), Money.of(r[5]))
+                    for r in cur.fetchall()]
+        finally:
+            con.close()
+
+    def get_top_products(self, start_date, end_date, limit=20):
+        """
+        Best sellers by revenue in [start_date, end_date):
+        (id_producto, nombre, unidades, ingreso, margen), amounts as Money
+        """
+        raw = """
+            SELECT d.id_producto, d.cantidad, d.subtotal AS ingreso, d.cantidad * pc.precio_compra AS costo
+            FROM venta v
+            JOIN venta_detalle d ON v.id_venta = d.id_venta
+            JOIN producto pc ON d.id_producto = pc.id_producto
+            WHERE v.fecha >= {lo} AND v.fecha < %s
+        """
+        if self.has_rollup():
+            sql = f"""
+                SELECT r.id_producto, r.cantidad, r.ingreso, r.costo
+                FROM venta_resumen_producto r
+                WHERE r.fecha >= %s AND r.fecha < {self.backend.least_date("%s", self.backend.TODAY)}
+                UNION ALL
+            """ + raw.format(lo=self.backend.greatest_date("%s", self.backend.TODAY))
+            params = (start_date, end_date, start_date, end_date, limit)
+        else:
+            sql = raw.format(lo="%s")
+            params = (start_date, end_date, limit)
+        con = self.connect()
+        if not con:
+            return []
+        try:
+            cur = con.cursor()
+            cur.execute(f"""
+                SELECT t.id_producto, p.nombre,
+                       SUM(t.cantidad) AS unidades,
+                       SUM(t.ingreso) AS ingreso,
+                       SUM(t.ingreso) - SUM(t.costo) AS margen
+                FROM ({sql}) t
+                JOIN producto p ON t.id_producto = p.id_producto
+                GROUP BY t.id_producto, p.nombre
+                ORDER BY ingreso DESC
+                LIMIT %s
+            """, params)
+            return [(r[0], r[1], r[2], Money.of(r[3]), Money.of(r[4])) for r in cur.fetchall()]
+        finally:
+            con.close()
+
+    def iter_daily_sales(self, start_date, batch_size=50000):
+        """
+        Yields lists of (id_producto, dia, unidades): units sold per product and
+        closed day since start_date, with dia counted back from today (yesterday = -1).
+        Raises when the database cannot be reached (no history is not "no sales").
+        """
+        day = self.backend.day_number
+        today = day(self.backend.TODAY)
+        if self.has_rollup():
+            sql = f"""
+                SELECT r.id_producto, {day("r.fecha")} - {today}, r.cantidad
+                FROM venta_resumen_producto r
+                WHERE r.fecha >= %s AND r.fecha < {self.backend.TODAY}
+            """
+        else:
+            sql = f"""
+                SELECT d.id_producto, {day("v.fecha")} - {today} AS dia, SUM(d.cantidad)
+                FROM venta v
+                JOIN venta_detalle d ON v.id_venta = d.id_venta
+                WHERE v.fecha >= %s AND v.fecha < {self.backend.TODAY}
+                GROUP BY d.id_producto, dia
+            """
+        yield from self._stream(sql, (start_date,), batch_size)
+
+    # Streaming export: rows come off an unbuffered cursor in fetchmany batches,
+    # so memory stays flat however much history is exported
+    EXPORT_QUERIES = {
+        "sales": """
+            SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.sku, p.nombre,
+                   d.cantidad, d.precio_unitario, d.subtotal, p.precio_compra
+            FROM venta v
+            JOIN venta_detalle d ON v.id_venta = d.id_venta
+            JOIN producto p ON d.id_producto = p.id_producto
+            {where}
+            ORDER BY v.fecha, v.id_venta, d.id_detalle
+        """,
+        "products": """
+            SELECT id_producto, nombre, categoria, precio_compra, precio_venta, cantidad, sku
+            FROM producto
+            ORDER BY id_producto
+        """,
+    }
+
+    def stream_export(self, kind, start_date=None, end_date=None, batch_size=5000):
+        """Yields lists of rows for EXPORT_QUERIES[kind]; dates filter sales to [start, end)."""
+        where, params = [], []
+        if kind == "sales" and start_date:
+            where.append("v.fecha >= %s")
+            params.append(start_date)
+        if kind == "sales" and end_date:
+            where.append("v.fecha < %s")
+            params.append(end_date)
+        sql = self.EXPORT_QUERIES[kind].format(where="WHERE " + " AND ".join(where) if where else "")
+        yield from self._stream(sql, params, batch_size)
+
+    def _stream(self, sql, params, batch_size):
+        # No connection raises (backend Error / PoolTimeout) instead of yielding
+        # nothing: an export with only its header must not pass for a success
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor(buffered=False)
+            cur.execute(sql, params)
+            while True:
+                rows = cur.fetchmany(batch_size)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            # An abandoned unbuffered result must be drained before the connection is reused
+            try:
+                con.consume_results()
+            except Exception:
+                pass
+            con.close()
+
+    # Bulk import: one multi-row upsert per batch, keyed on the unique sku
+    def upsert_products(self, rows):
+        """
+        rows: (nombre, categoria, precio_compra, precio_venta, cantidad, sku) tuples.
+        Writes them in one transaction. Existing skus get the new catalog fields
+        (nombre, categoria, prices); cantidad is only used for new products, as
+        on-hand stock is what sales and the registers keep current.
+        Returns a list of (index, error) for rows that could not be written.
+        """
+        if not rows:
+            return []
+        sql = """
+            INSERT INTO producto (nombre, categoria, precio_compra, precio_venta, cantidad, sku)
+            VALUES (%s,%s,%s,%s,%s,%s)
+        """ + self.backend.upsert("producto", ("sku",),
+                                  replace=("nombre", "categoria", "precio_compra", "precio_venta"))
+        params = [(n, c, str(pc), str(pv), q, sku) for n, c, pc, pv, q, sku in rows]
+        con = self.connect()
+        if not con:
+            return [(i, "sin conexión") for i in range(len(rows))]
+        failed = []
+        try:
+            cur = con.cursor()
+            try:
+                cur.executemany(sql, params)
+            except self.backend.Error:
+                # Find the offending rows: a failed statement does not abort the
+                # transaction, so retry the batch row by row and keep the good ones
+                con.rollback()
+                for i, row in enumerate(params):
+                    try:
+                        cur.execute(sql, row)
+                    except self.backend.Error as e:
+                        failed.append((i, str(e)))
+            bad = {i for i, _ in failed}
+            skus = [row[5] for i, row in enumerate(params) if row[5] is not None and i not in bad]
+            written = []
+            if skus:
+                marks = ",".join(["%s"] * len(skus))
+                cur.execute(f"SELECT {self.PRODUCT_COLUMNS} FROM producto WHERE sku IN ({marks})", skus)
+                written = cur.fetchall()
+            changes = [(r[0], "U", None) for r in written]
+            if len(skus) < len(rows) - len(failed):
+                changes.append((0, "R", None))
+            self._log_changes(cur, changes)
+            con.commit()
+        except self.backend.Error as e:
+            con.rollback()
+            return [(i, str(e)) for i in range(len(rows))]
+        finally:
+            con.close()
+        self.catalog.apply_rows(written)
+        if len(skus) < len(rows) - len(failed):
+            # Rows without sku were plain inserts we did not read back
+            self.catalog.invalidate()
+        return failed
+
+    def _has_unique_sku(self, cur):
+        return self.backend.has_unique_index(cur, "producto", "sku")
+
+    def has_unique_sku(self):
+        # Raises when the database cannot be reached, rather than blaming a missing index
+        con = self.pool.acquire()
+        try:
+            return self._has_unique_sku(con.cursor())
+        finally:
+            con.close()
+
+    # The core tables, for a new database (an embedded SQLite file starts empty)
+    BASE_TABLES = [
+        """
+        CREATE TABLE IF NOT EXISTS producto (
+            id_producto INT AUTO_INCREMENT PRIMARY KEY,
+            nombre VARCHAR(120) NOT NULL,
+            categoria VARCHAR(60),
+            precio_compra DECIMAL(10,2) NOT NULL,
+            precio_venta DECIMAL(10,2) NOT NULL,
+            cantidad INT NOT NULL DEFAULT 0,
+            sku VARCHAR(40) UNIQUE
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS venta (
+            id_venta INT AUTO_INCREMENT PRIMARY KEY,
+            fecha DATETIME NOT NULL,
+            total DECIMAL(12,2) NOT NULL
+        ) ENGINE=InnoDB
+        """,
+        """
+        CREATE TABLE IF NOT EXISTS venta_detalle (
+            id_detalle INT AUTO_INCREMENT PRIMARY KEY,
+            id_venta INT NOT NULL,
+            id_producto INT NOT NULL,
+            cantidad INT NOT NULL,
+            precio_unitario DECIMAL(10,2) NOT NULL,
+            subtotal DECIMAL(12,2) NOT NULL,
+            FOREIGN KEY (id_venta) REFERENCES venta(id_venta),
+            FOREIGN KEY (id_producto) REFERENCES producto(id_producto)
+        ) ENGINE=InnoDB
+        """,
+    ]
+
+    # Columns newer features rely on; added by ensure_schema() / `pos.py setup-db`
+    SCHEMA_COLUMNS = [
+        # offline sales replay with an idempotency key so a retry never books twice
+        ("venta", "clave_idempotencia", "CHAR(36) NULL", "CREATE UNIQUE INDEX uq_venta_clave ON venta (clave_idempotencia)"),
+    ]
+
+    SCHEMA_TABLES = [
+        # short-lived per-cart stock holds for MULTI_REGISTER mode
+        """
+        CREATE TABLE IF NOT EXISTS reserva_stock (
+            clave_carrito CHAR(36) NOT NULL,
+            id_producto INT NOT NULL,
+            cantidad INT NOT NULL,
+            expira DATETIME NOT NULL,
+            PRIMARY KEY (clave_carrito, id_producto),
+            KEY idx_reserva_producto (id_producto, expira)
+        ) ENGINE=InnoDB
+        """,
+        # change feed (outbox) other registers follow to patch their catalog
+        """
+        CREATE TABLE IF NOT EXISTS producto_cambio (
+            seq BIGINT AUTO_INCREMENT PRIMARY KEY,
+            id_producto INT NOT NULL,
+            tipo CHAR(1) NOT NULL,
+            cantidad INT NULL,
+            fecha DATETIME NOT NULL,
+            KEY idx_cambio_fecha (fecha)
+        ) ENGINE=InnoDB
+        """,
+    ]
+
+    def ensure_schema(self):
+        """
+        Creates missing tables, SCHEMA_COLUMNS and indexes; returns what it added.
+        Raises when the database cannot be reached.
+        """
+        created = []
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            for ddl in self.BASE_TABLES + self.SCHEMA_TABLES + self.ROLLUP_TABLES:
+                self.backend.create_table(cur, ddl)
+            for table, column, definition, index in self.SCHEMA_COLUMNS:
+                if not self.backend.has_column(cur, table, column):
+                    cur.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+                    cur.execute(index)
+                    created.append(f"{table}.{column}")
+            con.commit()
+            self._has_rollup = True
+            self._has_sale_keys = True
+            self._has_reservations = True
+            self._has_change_feed = True
+        finally:
+            con.close()
+        return created + self.ensure_indexes()
+
+    def ensure_indexes(self):
+        """
+        Creates any missing REPORT_INDEXES and the unique sku index; returns their
+        names. Raises when the database cannot be reached.
+        """
+        created = []
+        con = self.pool.acquire()
+        try:
+            cur = con.cursor()
+            for table, name, cols in self.REPORT_INDEXES:
+                if not self.backend.has_index(cur, table, name):
+                    cur.execute(f"CREATE INDEX {name} ON {table} {cols}")
+                    created.append(name)
+            # Bulk import upserts by sku, which needs sku to be unique
+            if not self._has_unique_sku(cur):
+                cur.execute("CREATE UNIQUE INDEX uq_producto_sku ON producto (sku)")
+                created.append("uq_producto_sku")
+            con.commit()
+            return created
+        finally:
+            con.close()
+
+# ---------------------------
+# Offline sale journal
+# ---------------------------
+class SaleJournal:
+    """
+    Local, durable queue of finalized sales (SQLite in WAL mode with
+    synchronous=FULL, so every append is fsynced). A sale is safe once
+    append() returns, whether or not MySQL is reachable.
+    """
+    def __init__(self, path):
+        self._lock = threading.Lock()
+        # isolation_level=None: every statement commits (and syncs) on its own
+        self._con = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._con.execute("PRAGMA journal_mode=WAL")
+        self._con.execute("PRAGMA synchronous=FULL")
+        self._con.execute("""
+            CREATE TABLE IF NOT EXISTS venta_pendiente (
+                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                clave TEXT NOT NULL UNIQUE,            -- idempotency key sent to MySQL
+                creada TEXT NOT NULL,                  -- when the cashier finalized it
+                items TEXT NOT NULL,                   -- JSON, same dicts create_sale takes
+                estado TEXT NOT NULL DEFAULT 'pendiente',  -- pendiente/sincronizada/conflicto/descartada
+                id_venta INTEGER,
+                intentos INTEGER NOT NULL DEFAULT 0,
+                error TEXT
+            )
+        """)
+        self._con.execute("CREATE INDEX IF NOT EXISTS idx_pendiente_estado ON venta_pendiente (estado, id)")
+
+    def append(self, items, key=None):
+        """Journals a sale and returns its idempotency key (a new one unless given)."""
+        key = key or str(uuid.uuid4())
+        with self._lock:
+            self._con.execute("INSERT INTO venta_pendiente (clave, creada, items) VALUES (?,?,?)",
+                              (key, datetime.now().strftime("%Y-%m-%d %H:%M:%S"), json.dumps(items, default=str)))
+        return key
+
+    def pending(self, limit=50):
+        with self._lock:
+            rows = self._con.execute("""
+                SELECT clave, creada, items FROM venta_pendiente
+                WHERE estado = 'pendiente' ORDER BY id LIMIT ?
+            """, (limit,)).fetchall()
+        return [(k, creada, json.loads(items)) for k, creada, items in rows]
+
+    def conflicts(self):
+        with self._lock:
+            rows = self._con.execute("""
+                SELECT clave, creada, items, error FROM venta_pendiente
+                WHERE estado = 'conflicto' ORDER BY id
+            """).fetchall()
+        return [(k, creada, json.loads(items), error) for k, creada, items, error in rows]
+
+    def mark(self, key, estado, id_venta=None, error=None):
+        with self._lock:
+            self._con.execute("UPDATE venta_pendiente SET estado=?, id_venta=?, error=COALESCE(?, error) WHERE clave=?",
+                              (estado, id_venta, error, key))
+
+    def record_failure(self, key, error):
+        """Counts a failed attempt; returns how many there have been."""
+        with self._lock:
+            self._con.execute("UPDATE venta_pendiente SET intentos = intentos + 1, error=? WHERE clave=?", (error, key))
+            return self._con.execute("SELECT intentos FROM venta_pendiente WHERE clave=?", (key,)).fetchone()[0]
+
+    def counts(self):
+        with self._lock:
+            return dict(self._con.execute("SELECT estado, COUNT(*) FROM venta_pendiente GROUP BY estado").fetchall())
+
+    def prune(self, days=30):
+        """Drops synced/discarded entries older than `days`."""
+        cutoff = (datetime.now() - timedelta(days=days)).strftime("%Y-%m-%d %H:%M:%S")
+        with self._lock:
+            self._con.execute("""
+                DELETE FROM venta_pendiente
+                WHERE estado IN ('sincronizada', 'descartada') AND creada < ?
+            """, (cutoff,))
+
+    def close(self):
+        with self._lock:
+            self._con.close()
+
+class SaleSyncer:
+    """
+    Replays journaled sales to MySQL on a background thread, oldest first.
+    Each sale carries its idempotency key, so a replay after a crash or a lost
+    reply never books it twice. Sales MySQL rejects (stock went negative while
+    we were offline, product deleted, ...) are parked as conflicts for review.
+    """
+    MAX_ATTEMPTS = 10  # non-connection failures before a sale is parked as a conflict
+
+    def __init__(self, db, journal, interval=5.0, on_change=None):
+        self.db = db
+        self.journal = journal
+        self.interval = interval
+        self.on_change = on_change
+        self.blocked = None  # why syncing is stalled on something a person must fix
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="pos-sync", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=self.interval)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                self.sync_once()
+            except Exception:
+                pass  # e.g. the journal is busy; try again next round
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def sync_once(self):
+        """Replays pending sales until the queue is drained or MySQL is unreachable."""
+        changed = False
+        self.blocked = None
+        try:
+            while not self._stop.is_set():
+                progress = False
+                for key, creada, items in self.journal.pending():
+                    try:
+                        sale_id = self.db.book_sale(items, idempotency_key=key, fecha=creada)
+                    except StockError as e:
+                        self.journal.mark(key, "conflicto", error=str(e))
+                    except SchemaError as e:
+                        self.blocked = str(e)
+                        return changed
+                    except Exception as e:
+                        if is_connection_error(e) or self.db.backend.is_retryable(e):
+                            return changed  # still offline or busy; everything stays queued, in order
+                        if self.journal.record_failure(key, str(e)) < self.MAX_ATTEMPTS:
+                            continue
+                        self.journal.mark(key, "conflicto", error=str(e))
+                    else:
+                        self.journal.mark(key, "sincronizada", id_venta=sale_id)
+                    progress = changed = True
+                if not progress:
+                    return changed  # drained, or every remaining sale failed this round
+            return changed
+        finally:
+            if (changed or self.blocked) and self.on_change:
+                self.on_change()
+
+# ---------------------------
+# Cross-register change feed
+# ---------------------------
+class ChangeFeed:
+    """
+    Follows producto_cambio on a background thread from the last sequence
+    number this register has read, and patches the catalog with what other
+    registers (and the back office) changed. on_change(ids) gets the products
+    touched, or None when the catalog was dropped and must be re-read.
+
+    A seq is handed out at insert but only becomes visible at commit, so one
+    missing below the highest seq read may still be in flight: it is asked
+    for again on every poll until GAP_TIMEOUT (a rolled-back transaction
+    leaves a hole for good).
+    """
+    GAP_TIMEOUT = 60.0
+    BATCH = 1000
+
+    def __init__(self, db, interval=1.0, retention=86400, on_change=None):
+        self.db = db
+        self.interval = interval
+        self.retention = retention
+        self.on_change = on_change
+        self.seq = None         # highest seq read; None until the first poll
+        self._missing = {}      # seq -> monotonic time it was first missed
+        self._last_poll = None  # monotonic time of the last successful poll
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="pos-changes", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def wake(self):
+        self._wake.set()
+
+    def stop(self):
+        self._stop.set()
+        self._wake.set()
+        if self._thread.is_alive():
+            self._thread.join(timeout=self.interval)
+
+    def _loop(self):
+        while not self._stop.is_set():
+            try:
+                if not self.db.has_change_feed():
+                    return  # setup-db has not been run: nothing to follow
+                self.poll_once()
+            except Exception:
+                pass  # database unreachable; catch up next round
+            self._wake.wait(self.interval)
+            self._wake.clear()
+
+    def position(self):
+        """
+        Starts following from the newest change without touching the catalog;
+        called before the catalog is first read. Returns the seq, or None
+        when there is no producto_cambio table.
+        """
+        if not self.db.has_change_feed():
+            return None
+        self.seq = self.db.last_change_seq()
+        self._missing = {}
+        self._last_poll = time.monotonic()
+        return self.seq
+
+    def poll_once(self):
+        """Applies what was committed since the last poll; returns how many changes."""
+        now = time.monotonic()
+        if self.seq is None or now - self._last_poll > self.retention / 2:
+            # First poll, or offline so long that changes we never read may be
+            # pruned: start from the newest seq and re-read whatever was cached
+            self.seq = self.db.last_change_seq()
+            self._missing = {}
+            self._last_poll = now
+            if self.db.catalog.stats()["size"]:
+                self.db.catalog.invalidate()
+                self._notify(None)
+            return 0
+        applied = 0
+        while True:
+            rows = self.db.get_changes(self.seq, self.BATCH, list(self._missing))
+            fresh = []
+            for row in rows:
+                seq = row[0]
+                if seq > self.seq:
+                    # Holes are tracked up to BATCH back (a big jump is a burst of rollbacks)
+                    self._missing.update((s, now) for s in range(max(self.seq + 1, seq - self.BATCH), seq))
+                    self.seq = seq
+                    fresh.append(row)
+                elif self._missing.pop(seq, None) is not None:
+                    fresh.append(row)
+            if fresh:
+                fresh.sort()
+                self._notify(self.db.apply_changes(fresh))
+                applied += len(fresh)
+            if len(rows) < self.BATCH:
+                break
+        self._missing = {s: t for s, t in self._missing.items() if now - t < self.GAP_TIMEOUT}
+        self._last_poll = now
+        return applied
+
+    def _notify(self, ids):
+        if self.on_change:
+            self.on_change(ids)
+
+# ---------------------------
+# Report periods
+# ---------------------------
+PERIODS = {"Diario": "day", "Semanal": "week", "Mensual": "month"}
+
+def period_end(period, start):
+    """First date after the bucket that starts on `start`."""
+    if period == "day":
+        return start + timedelta(days=1)
+    if period == "week":
+        return start + timedelta(days=7)
+    return (start.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+def parse_date(text):
+    return datetime.strptime(text.strip(), "%Y-%m-%d").date()
+
+def default_range(period, today):
+    """[start, end) shown when the Reports tab opens: 30 days, 12 weeks or 12 months."""
+    end = today + timedelta(days=1)
+    if period == "day":
+        return today - timedelta(days=29), end
+    if period == "week":
+        return today - timedelta(days=today.weekday() + 7 * 11), end
+    start = today.replace(day=1)
+    for _ in range(11):
+        start = (start - timedelta(days=1)).replace(day=1)
+    return start, end
+
+# ---------------------------
+# Export
+# ---------------------------
+# Column name and type per export, in query order. The type only matters for Parquet.
+EXPORT_COLUMNS = {
+    "sales": [("id_venta", "int"), ("fecha", "datetime"), ("total", "money"), ("id_detalle", "int"),
+              ("id_producto", "int"), ("sku", "str"), ("nombre", "str"), ("cantidad", "int"),
+              ("precio_unitario", "money"), ("subtotal", "money"), ("precio_compra", "money")],
+    "products": [("id_producto", "int"), ("nombre", "str"), ("categoria", "str"), ("precio_compra", "money"),
+                 ("precio_venta", "money"), ("cantidad", "int"), ("sku", "str")],
+}
+
+def export_data(db, kind, fmt, path, start_date=None, end_date=None, batch_size=5000, progress=None):
+    """
+    Writes db.stream_export(kind, ...) to `path` as "csv" or "parquet", one batch
+    at a time ("-" is stdout, for CSV only). Returns the number of rows written.
+    """
+    if fmt == "parquet" and path == "-":
+        raise ValueError("Parquet export needs an output file")
+    batches = db.stream_export(kind, start_date, end_date, batch_size)
+    if fmt == "parquet":
+        return _write_parquet(kind, path, batches, progress)
+    return _write_csv(kind, path, batches, progress)
+
+def _write_csv(kind, path, batches, progress):
+    total = 0
+    out = sys.stdout if path == "-" else open(path, "w", newline="", encoding="utf-8")
+    try:
+        writer = csv.writer(out)
+        writer.writerow([name for name, _ in EXPORT_COLUMNS[kind]])
+        for rows in batches:
+            writer.writerows(rows)
+            total += len(rows)
+            if progress:
+                progress(total)
+    finally:
+        if out is not sys.stdout:
+            out.close()
+    return total
+
+def _write_parquet(kind, path, batches, progress):
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        raise RuntimeError("Parquet export needs pyarrow (pip install pyarrow)")
+    types = {"int": pa.int64(), "str": pa.string(), "money": pa.decimal128(14, 2), "datetime": pa.timestamp("s")}
+    schema = pa.schema([(name, types[t]) for name, t in EXPORT_COLUMNS[kind]])
+    total = 0
+    # Each batch becomes one row group, so only one batch is ever held in memory
+    with pq.ParquetWriter(path, schema) as writer:
+        for rows in batches:
+            columns = list(zip(*rows))
+            writer.write_table(pa.Table.from_arrays(
+                [pa.array(col, type=field.type) for col, field in zip(columns, schema)], schema=schema))
+            total += len(rows)
+            if progress:
+                progress(total)
+    return total
+
+# ---------------------------
+# Restock forecast
+# ---------------------------
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        raise RuntimeError("The restock forecast needs numpy (pip install numpy)")
+    return numpy
+
+def load_daily_sales(db, days, batch_size=50000):
+    """
+    Arrays (id_producto, dia, unidades) for the last `days` closed days, read
+    with one streamed query (see DBHandler.iter_daily_sales).
+    """
+    np = _numpy()
+    start = date.today() - timedelta(days=days)
+    # fromiter over the flattened tuples is about twice as fast as np.array(rows);
+    # MySQL sums come back as Decimal, which it converts as well as ints
+    parts = [np.fromiter(itertools.chain.from_iterable(rows), dtype=np.int64, count=3 * len(rows)).reshape(-1, 3)
+             for rows in db.iter_daily_sales(start, batch_size)]
+    data = np.concatenate(parts) if parts else np.zeros((0, 3), dtype=np.int64)
+    return data[:, 0], data[:, 1], data[:, 2]
+
+def restock_forecast(ids, stock, sold_id, sold_day, sold_qty, lead_time=7, cover_days=14, z=1.65):
+    """
+    Demand forecast and reorder point for every product at once: one pass of
+    bincount per window over the (product, day) rows, no loop per product.
+    ids/stock describe the catalog, sold_* come from load_daily_sales().
+    Returns a dict of arrays aligned with ids.
+    """
+    np = _numpy()
+    ids = np.asarray(ids, dtype=np.int64)
+    stock = np.asarray(stock, dtype=np.float64)
+    n = len(ids)
+    # Row -> catalog position through a table indexed by id (ids are AUTO_INCREMENT,
+    # so it stays small); sales of products no longer in the catalog are dropped
+    slot = np.full(max(ids.max(initial=0), sold_id.max(initial=0)) + 1, -1, dtype=np.int64)
+    slot[ids] = np.arange(n)
+    pos = slot[sold_id]
+    known = pos >= 0
+    idx, day = pos[known], sold_day[known]
+    qty = sold_qty[known].astype(np.float64)
+
+    def total(lo, hi, weights=qty):
+        """Units per product sold on days [lo, hi)."""
+        m = (day >= lo) & (day < hi)
+        return np.bincount(idx[m], weights=weights[m], minlength=n)
+
+    # Days since each product's first sale (at least a week), so new products are
+    # not averaged over days before they were on the shelf
+    first = np.zeros(n, dtype=np.int64)
+    np.minimum.at(first, idx, day)
+    age = np.maximum(-first, 7)
+
+    out = {}
+    for w in (7, 28, 90):
+        out[f"avg_{w}"] = total(-w, 0) / np.minimum(age, w)
+    # Spread of daily sales over 90 days; days without a sale count as zero
+    days90 = np.minimum(age, 90)
+    var = total(-90, 0, qty * qty) / days90 - out["avg_90"] ** 2
+    out["sigma"] = np.sqrt(np.maximum(var, 0))
+
+    # With more than a year of history, what sold over the coming weeks last year
+    # (scaled by this month against the same month last year) is blended in
+    horizon = lead_time + cover_days
+    same_month = total(-365 - 28, -365) / 28
+    coming = total(-365, -365 + horizon) / horizon
+    growth = np.clip(np.divide(out["avg_28"], same_month, out=np.ones(n), where=same_month > 0), 0.5, 2.0)
+    seasonal = (age >= 365 + 28) & (same_month > 0)
+    out["demand"] = np.where(seasonal, (out["avg_28"] + coming * growth) / 2, out["avg_28"])
+
+    demand = out["demand"]
+    on_hand = np.maximum(stock, 0)
+    safety = z * out["sigma"] * np.sqrt(lead_time)
+    out["reorder_point"] = demand * lead_time + safety
+    out["cover_days"] = np.divide(on_hand, demand, out=np.full(n, np.inf), where=demand > 0)
+    sold28 = total(-28, 0)
+    out["sell_through"] = np.divide(sold28, sold28 + on_hand, out=np.zeros(n), where=sold28 + on_hand > 0)
+    out["suggested"] = np.ceil(np.maximum(demand * horizon + safety - on_hand, 0)).astype(np.int64)
+    return out
+
+class RestockReport:
+    """
+    restock_forecast() for the whole catalog, paged like a database query so a
+    VirtualTable can show it: sorted by any column and, by default, limited to
+    products with demand that are at or below their reorder point.
+    """
+    # Column heading -> forecast/catalog field
+    COLUMNS = {
+        "ID": "id", "Producto": "name", "SKU": "sku", "Stock": "stock",
+        "Venta/día 7d": "avg_7", "Venta/día 28d": "avg_28", "Venta/día 90d": "avg_90",
+        "Pronóstico/día": "demand", "Sell-through 28d": "sell_through", "Días cobertura": "cover_days",
+        "Punto reorden": "reorder_point", "Sugerido": "suggested",
+    }
+
+    def __init__(self, products, sales, lead_time=7, cover_days=14, z=1.65):
+        np = _numpy()
+        # products: get_all_products() rows; sales: load_daily_sales() arrays
+        self.fields = restock_forecast([r[0] for r in products], [r[4] for r in products], *sales,
+                                       lead_time=lead_time, cover_days=cover_days, z=z)
+        self.fields["id"] = np.array([r[0] for r in products], dtype=np.int64)
+        self.fields["stock"] = np.array([r[4] for r in products], dtype=np.int64)
+        self.fields["name"] = np.array([r[1] for r in products], dtype=object)
+        self.fields["sku"] = np.array([r[5] or "" for r in products], dtype=object)
+        f = self.fields
+        self.low = np.flatnonzero((f["demand"] > 0) & (f["stock"] <= f["reorder_point"]))
+        self.low_only = True
+        self.sort_field, self.descending = "cover_days", False
+        self._sort()
+
+    def set_filter(self, low_only):
+        self.low_only = low_only
+        self._sort()
+
+    def sort(self, field, descending=None):
+        """Sorts by field; without `descending`, sorting by the same field again flips the order."""
+        if descending is None:
+            descending = not self.descending if field == self.sort_field else False
+        self.descending = descending
+        self.sort_field = field
+        self._sort()
+
+    def _sort(self):
+        np = _numpy()
+        rows = self.low if self.low_only else np.arange(len(self.fields["id"]))
+        values = self.fields[self.sort_field][rows]
+        if values.dtype == object:
+            values = np.array([v.casefold() for v in values], dtype=object)
+        order = np.argsort(values, kind="stable")
+        self.order = rows[order[::-1] if self.descending else order]
+
+    def __len__(self):
+        return len(self.order)
+
+    def page(self, after=None, limit=200):
+        """Rows after position `after` (None = first page): (position, field values...)."""
+        start = 0 if after is None else after + 1
+        rows = self.order[start:start + limit]
+        columns = [self.fields[f][rows].tolist() for f in self.COLUMNS.values()]
+        return [(start + i,) + row for i, row in enumerate(zip(*columns))]
+
+    def write_csv(self, out):
+        writer = csv.writer(out)
+        writer.writerow(list(self.COLUMNS.values()))
+        after, total = None, 0
+        while True:
+            rows = self.page(after, 5000)
+            if not rows:
+                return total
+            writer.writerows([round(v, 2) if isinstance(v, float) else v for v in r[1:]] for r in rows)
+            after, total = rows[-1][0], total + len(rows)
+
+def restock_report(db, reload=False):
+    """
+    Reads DBConfig.RESTOCK_HISTORY_DAYS of sales and the catalog; returns a
+    RestockReport. Raises when the database cannot be reached.
+    """
+    cfg = db.cfg
+    # Sales first: they raise without a connection, where get_all_products()
+    # would report and return no products, i.e. an empty report
+    sales = load_daily_sales(db, cfg.RESTOCK_HISTORY_DAYS)
+    products = db.get_all_products(reload=reload)
+    return RestockReport(products, sales, cfg.LEAD_TIME_DAYS, cfg.ORDER_COVER_DAYS, cfg.SERVICE_LEVEL_Z)
+
+# ---------------------------
+# Bulk product import
+# ---------------------------
+def parse_product_fields(nombre, categoria, precio_compra, precio_venta, cantidad, sku):
+    """
+    Validates raw text the way the Inventory form does. Returns the tuple
+    add_product()/upsert_products() take; raises ValueError naming the field.
+    """
+    nombre = (nombre or "").strip()
+    if not nombre:
+        raise ValueError("Nombre requerido")
+    return (
+        nombre,
+        (categoria or "").strip(),
+        _parse_field("precio_compra", Decimal, precio_compra),
+        _parse_field("precio_venta", Decimal, precio_venta),
+        _parse_field("cantidad", int, cantidad),
+        (sku or "").strip() or None,
+    )
+
+def _parse_field(name, parse, text):
+    try:
+        return parse(text)
+    except (InvalidOperation, ValueError, TypeError):
+        # Decimal's own message is just the class of the signal
+        raise ValueError(f"{name} inválido: {text!r}") from None
+
+IMPORT_COLUMNS = ("nombre", "categoria", "precio_compra", "precio_venta", "cantidad", "sku")
+
+def import_products_csv(db, path, batch_size=500, progress=None):
+    """
+    Upserts every valid row of a CSV price list by sku, batch_size rows per
+    transaction. Columns: nombre, precio_compra, precio_venta, cantidad and
+    optionally categoria, sku (header names are case-insensitive); cantidad
+    is the initial stock of new products and leaves existing ones alone.
+    Returns {"read", "written", "rejected": [(line, reason, record)], "seconds"}.
+    """
+    if not db.has_unique_sku():
+        raise ValueError("producto.sku no tiene un índice UNIQUE; ejecute 'python pos.py create-indexes'")
+    t0 = time.perf_counter()
+    result = {"read": 0, "written": 0, "rejected": [], "seconds": 0.0}
+    with open(path, newline="", encoding="utf-8-sig") as fh:
+        reader = csv.DictReader(fh)
+        header = {(h or "").strip().lower(): h for h in reader.fieldnames or []}
+        missing = [c for c in IMPORT_COLUMNS if c not in header and c not in ("categoria", "sku")]
+        if missing:
+            raise ValueError(f"Faltan columnas: {', '.join(missing)}")
+
+        batch, lines = [], []
+
+        def flush():
+            failed = db.upsert_products(batch)
+            for i, reason in failed:
+                line, rec = lines[i]
+                result["rejected"].append((line, reason, rec))
+            result["written"] += len(batch) - len(failed)
+            batch.clear()
+            lines.clear()
+            if progress:
+                progress(result["read"], len(result["rejected"]))
+
+        for rec in reader:
+            result["read"] += 1
+            line = reader.line_num
+            try:
+                batch.append(parse_product_fields(*(rec.get(header[c]) if c in header else None for c in IMPORT_COLUMNS)))
+                lines.append((line, rec))
+            except (InvalidOperation, ValueError, TypeError) as e:
+                result["rejected"].append((line, str(e), rec))
+            if len(batch) >= batch_size:
+                flush()
+        if batch:
+            flush()
+    result["seconds"] = time.perf_counter() - t0
+    return result
+
+def write_rejects(path, rejected):
+    with open(path, "w", newline="", encoding="utf-8") as fh:
+        writer = csv.writer(fh)
+        writer.writerow(("linea", "motivo") + IMPORT_COLUMNS)
+        for line, reason, rec in rejected:
+            values = {(k or "").strip().lower(): v for k, v in rec.items()}
+            writer.writerow((line, reason) + tuple(values.get(c, "") for c in IMPORT_COLUMNS))
+
+# ---------------------------
+# Cart
+# ---------------------------
+class CartLine:
+    __slots__ = ("id_producto", "nombre", "cantidad", "precio_unitario", "subtotal")
+
+    def __init__(self, id_producto, nombre, cantidad, precio_unitario):
+        self.id_producto = id_producto
+        self.nombre = nombre
+        self.cantidad = cantidad
+        self.precio_unitario = precio_unitario
+        self.subtotal = precio_unitario * cantidad
+
+class Cart:
+    """
+    Cart lines keyed by id_producto (in the order they were first added) with
+    a running total. Every change is reported to the listeners as
+    (event, line), event being "add", "update", "remove" or "clear" (line is
+    None), so a view only touches the affected row.
+    """
+    def __init__(self):
+        self._lines = {}
+        self._listeners = []
+        self.total = Money(0)
+
+    def subscribe(self, fn):
+        self._listeners.append(fn)
+
+    def __len__(self):
+        return len(self._lines)
+
+    def __iter__(self):
+        return iter(self._lines.values())
+
+    def get(self, id_producto):
+        return self._lines.get(id_producto)
+
+    def quantity(self, id_producto):
+        line = self._lines.get(id_producto)
+        return line.cantidad if line else 0
+
+    def add(self, id_producto, nombre, precio_unitario, cantidad):
+        """Adds units, merging with an existing line for the same product."""
+        line = self._lines.get(id_producto)
+        if line is None:
+            line = self._lines[id_producto] = CartLine(id_producto, nombre, cantidad, Money.of(precio_unitario))
+            self.total += line.subtotal
+            self._emit("add", line)
+        else:
+            self.total -= line.subtotal
+            line.cantidad += cantidad
+            line.subtotal = line.precio_unitario * line.cantidad
+            self.total += line.subtotal
+            self._emit("update", line)
+        return line
+
+    def remove(self, id_producto):
+        line = self._lines.pop(id_producto, None)
+        if line is not None:
+            self.total -= line.subtotal
+            self._emit("remove", line)
+
+    def clear(self):
+        self._lines.clear()
+        self.total = Money(0)
+        self._emit("clear", None)
+
+    def items(self):
+        """The sale lines create_sale()/book_sale() take."""
+        return [{'id_producto': l.id_producto, 'cantidad': l.cantidad, 'precio_unitario': l.precio_unitario}
+                for l in self._lines.values()]
+
+    def _emit(self, event, line):
+        for fn in self._listeners:
+            fn(event, line)
+
+# ---------------------------
+# Background DB jobs
+# ---------------------------
+class JobExecutor:
+    """
+    Runs DB work on worker threads and hands results back to the Tk thread
+    (results are queued and drained by a root.after() poll loop).
+
+    Jobs submitted with the same key are coalesced: a newer submission cancels
+    the older one if it has not started yet, and the result of one that is
+    already running is dropped. key=None opts out (e.g. finalizing a sale).
+    """
+    def __init__(self, root, workers=4, poll_ms=30, on_busy=None):
+        self.root = root
+        self.poll_ms = poll_ms
+        self.on_busy = on_busy            # called with True/False on the Tk thread
+        self._pool = concurrent.futures.ThreadPoolExecutor(max_workers=workers, thread_name_prefix="pos-db")
+        self._results = queue.Queue()
+        self._lock = threading.Lock()
+        self._latest = {}                 # key -> newest generation
+        self._queued = {}                 # key -> (generation, Future) not started yet
+        self._in_flight = 0
+        self._busy = False
+        self._closed = False
+        self.stats = {"submitted": 0, "coalesced": 0, "superseded": 0, "failed": 0}
+        self.root.after(self.poll_ms, self._poll)
+
+    def submit(self, key, fn, *args, on_done=None, on_error=None):
+        with self._lock:
+            self.stats["submitted"] += 1
+            gen = self._latest.get(key, 0) + 1
+            if key is not None:
+                self._latest[key] = gen
+                prev = self._queued.pop(key, None)
+                if prev is not None and prev[1].cancel():
+                    self.stats["coalesced"] += 1
+                    self._in_flight -= 1
+            self._in_flight += 1
+            fut = self._pool.submit(self._run, key, gen, fn, args, on_done, on_error)
+            if key is not None:
+                self._queued[key] = (gen, fut)
+        return fut
 
-            # Insert venta
-            cur.execute("INSERT INTO venta (fecha, total) VALUES (NOW(), %s)", (str(total),))
-            sale_id = cur.lastrowid
+    def post(self, fn, *args):
+        """Runs fn(*args) on the Tk thread (safe to call from any thread)."""
+        self._results.put((None, 0, False, lambda: fn(*args)))
 
-            # Insert detalles and update stock
-            for it in items:
-                cur.execute("""
-                    INSERT INTO venta_detalle (id_venta, id_producto, cantidad, precio_unitario, subtotal)
-                    VALUES (%s,%s,%s,%s,%s)
-                """, (sale_id, it['id_producto'], it['cantidad'], str(it['precio_unitario']), str(it['subtotal'])))
-                # Deduct stock
-                cur.execute("UPDATE producto SET cantidad = cantidad - %s WHERE id_producto=%s", (it['cantidad'], it['id_producto']))
+    def shutdown(self):
+        self._closed = True
+        self._pool.shutdown(wait=False, cancel_futures=True)
 
-            con.commit()
-            return sale_id
+    def _run(self, key, gen, fn, args, on_done, on_error):
+        with self._lock:
+            if key is not None and self._queued.get(key, (None,))[0] == gen:
+                del self._queued[key]
+        try:
+            result = fn(*args)
         except Exception as e:
-            con.rollback()
-            messagebox.showerror("Venta Error", f"No se pudo completar la venta: {e}")
-            return None
-        finally:
-            con.close()
+            err = e
+            self._results.put((key, gen, True, lambda: self._fail(err, on_error)))
+        else:
+            self._results.put((key, gen, True, lambda: on_done(result) if on_done else None))
 
-    # Reports
-    def get_sales(self, start_date=None, end_date=None):
-        con = self.connect()
-        if not con:
+    def _fail(self, e, on_error):
+        self.stats["failed"] += 1
+        if on_error:
+            on_error(e)
+        else:
+            messagebox.showerror("DB Error", f"{type(e).__name__}: {e}")
+
+    def _poll(self):
+        if self._closed:
+            return
+        while True:
+            try:
+                key, gen, is_job, deliver = self._results.get_nowait()
+            except queue.Empty:
+                break
+            if is_job:
+                with self._lock:
+                    self._in_flight -= 1
+            if key is not None and self._latest.get(key) != gen:
+                # A newer job with the same key was submitted; its result wins
+                self.stats["superseded"] += 1
+                continue
+            try:
+                deliver()
+            except Exception as e:
+                messagebox.showerror("Error", f"{type(e).__name__}: {e}")
+        with self._lock:
+            busy = self._in_flight > 0
+        if busy != self._busy:
+            self._busy = busy
+            if self.on_busy:
+                self.on_busy(busy)
+        self.root.after(self.poll_ms, self._poll)
+
+# ---------------------------
+# Virtualized table
+# ---------------------------
+class VirtualTable:
+    """
+    Treeview for large, key-ordered result sets. Only the visible rows plus a
+    small margin exist as Treeview items; the data behind them is fetched a
+    page at a time with keyset pagination and a few pages are kept in memory.
+
+    fetch(after_key, limit) -> rows following after_key (None = first page)
+    key(row)    -> sort key of a row, passed back to fetch() as after_key
+    iid(row)    -> Treeview item id (defaults to str(key(row)))
+    values(row) -> tuple shown in the columns (defaults to the row itself)
+    jobs        -> optional JobExecutor; page fetches then run off the Tk thread
+    """
+    def __init__(self, parent, columns, fetch, key=lambda r: r[0], iid=None, values=None,
+                 width=120, page_size=200, margin=20, max_pages=8, jobs=None):
+        self.fetch = fetch
+        self.key = key
+        self.iid = iid or (lambda r: str(key(r)))
+        self.values = values or (lambda r: r)
+        self.page_size = page_size
+        self.margin = margin
+        self.max_pages = max_pages
+        self.jobs = jobs
+
+        self.frame = ttk.Frame(parent)
+        self.tree = ttk.Treeview(self.frame, columns=columns, show="headings")
+        for c in columns:
+            self.tree.heading(c, text=c)
+            self.tree.column(c, width=width)
+        self.scroll = ttk.Scrollbar(self.frame, orient="vertical", command=self._on_scrollbar)
+        self.tree.pack(side="left", fill="both", expand=True)
+        self.scroll.pack(side="right", fill="y")
+
+        # Tk thread state
+        self.top = 0          # index of the first visible row
+        self.visible = 20     # rows that fit in the widget, updated on resize
+        self._shown = {}      # iid -> values currently in the tree
+        self._total = 0       # known (or estimated) row count, for the scrollbar
+
+        # Page state, only touched by _window() under _lock (it may run on a worker)
+        self._lock = threading.Lock()
+        self._anchors = [None]  # after_key for each page
+        self._pages = {}      # page number -> rows (insertion order = LRU order)
+        self._end_page = None
+        self._stale = False
+
+        self.tree.bind("<Configure>", self._on_resize)
+        self.tree.bind("<MouseWheel>", lambda e: self._on_wheel(-1 if e.delta > 0 else 1))
+        self.tree.bind("<Button-4>", lambda e: self._on_wheel(-1))
+        self.tree.bind("<Button-5>", lambda e: self._on_wheel(1))
+        self.tree.bind("<Prior>", lambda e: self.scroll_to(self.top - self.visible) or "break")
+        self.tree.bind("<Next>", lambda e: self.scroll_to(self.top + self.visible) or "break")
+        self.tree.bind("<Home>", lambda e: self.scroll_to(0) or "break")
+
+    def place(self, **kw):
+        self.frame.place(**kw)
+
+    # Data
+    def _page(self, n):
+        if n in self._pages:
+            self._pages[n] = self._pages.pop(n)
+            return self._pages[n]
+        if self._end_page is not None and n > self._end_page:
             return []
-        cur = con.cursor()
-        if start_date and end_date:
-            cur.execute("""
-                SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.nombre, d.cantidad, d.precio_unitario, d.subtotal
-                FROM venta v
-                JOIN venta_detalle d ON v.id_venta = d.id_venta
-                JOIN producto p ON d.id_producto = p.id_producto
-                WHERE v.fecha BETWEEN %s AND %s
-                ORDER BY v.fecha DESC, v.id_venta DESC
-            """, (start_date, end_date))
+        # Anchors are only known for pages we have walked through
+        while len(self._anchors) <= n:
+            walked = len(self._anchors)
+            self._page(walked - 1)
+            if self._end_page is not None and n > self._end_page:
+                return []
+            if len(self._anchors) == walked:
+                return []
+        rows = self.fetch(self._anchors[n], self.page_size)
+        self._pages[n] = rows
+        if len(self._pages) > self.max_pages:
+            del self._pages[next(iter(self._pages))]
+        if len(rows) == self.page_size:
+            nxt = self.key(rows[-1])
+            if len(self._anchors) == n + 1:
+                self._anchors.append(nxt)
+            elif self._anchors[n + 1] != nxt:
+                # Rows were added/removed since we walked past: later anchors are stale
+                del self._anchors[n + 1:]
+                self._anchors.append(nxt)
+                for p in [p for p in self._pages if p > n]:
+                    del self._pages[p]
         else:
-            cur.execute("""
-                SELECT v.id_venta, v.fecha, v.total, d.id_detalle, d.id_producto, p.nombre, d.cantidad, d.precio_unitario, d.subtotal
-                FROM venta v
-                JOIN venta_detalle d ON v.id_venta = d.id_venta
-                JOIN producto p ON d.id_producto = p.id_producto
-                ORDER BY v.fecha DESC, v.id_venta DESC
-            """)
-        rows = cur.fetchall()
-        con.close()
+            self._end_page = n
+            del self._anchors[n + 1:]
         return rows
 
+    def _rows(self, start, count):
+        out = []
+        n = start // self.page_size
+        skip = start - n * self.page_size
+        while len(out) < count:
+            rows = self._page(n)
+            out.extend(rows[skip:skip + count - len(out)])
+            if self._end_page is not None and n >= self._end_page:
+                break
+            n += 1
+            skip = 0
+        return out
+
+    def _known_rows(self):
+        if self._end_page is not None:
+            return self._end_page * self.page_size + len(self._page(self._end_page))
+        # Unknown total: assume at least one more page than we have anchored
+        return len(self._anchors) * self.page_size
+
+    def _window(self, top, count):
+        """Returns (top, rows, total) for the requested window; may hit the DB."""
+        with self._lock:
+            if self._stale:
+                self._pages = {}
+                self._end_page = None
+                self._stale = False
+            rows = self._rows(top, count)
+            if self._end_page is not None:
+                # Scrolled past the end (or rows were deleted): keep the last rows in view
+                last_top = max(0, self._known_rows() - (count - self.margin))
+                if top > last_top:
+                    top = last_top
+                    rows = self._rows(top, count)
+            TRACE.note(rows=len(rows))
+            return top, rows, self._known_rows()
+
+    # Rendering
+    def refresh(self):
+        """Re-reads the visible window and updates only the rows that changed."""
+        self._stale = True
+        self.render()
+
+    def patch(self, keys):
+        """
+        Rows with these keys changed elsewhere: cached pages are dropped, and
+        the window is redrawn only if one of them is on screen.
+        """
+        self._stale = True
+        if any(str(k) in self._shown for k in keys):
+            self.render()
+
+    def reset(self):
+        """Starts over from the first row (e.g. after the query changed)."""
+        with self._lock:
+            self._anchors = [None]
+        self.top = 0
+        self.refresh()
+
+    def render(self):
+        args = (self.top, self.visible + self.margin)
+        if self.jobs is None:
+            self._show(self._window(*args))
+        else:
+            # Coalesced per table: only the newest scroll position gets drawn
+            self.jobs.submit(("table", id(self)), self._window, *args, on_done=self._show)
+
+    def _show(self, window):
+        self.top, rows, self._total = window
+        TRACE.note(rows=len(rows))
+        wanted = [(self.iid(r), tuple(self.values(r))) for r in rows]
+        keep = {iid for iid, _ in wanted}
+        gone = [iid for iid in self._shown if iid not in keep]
+        if gone:
+            self.tree.delete(*gone)
+            for iid in gone:
+                del self._shown[iid]
+        # Surviving rows keep their relative order, so inserting the new ones at
+        # their index is enough; only rows whose values changed are touched
+        for idx, (iid, vals) in enumerate(wanted):
+            old = self._shown.get(iid)
+            if old is None:
+                self.tree.insert("", idx, iid=iid, values=vals)
+            elif old != vals:
+                self.tree.item(iid, values=vals)
+            self._shown[iid] = vals
+        order = [iid for iid, _ in wanted]
+        if list(self.tree.get_children()) != order:
+            for idx, iid in enumerate(order):
+                self.tree.move(iid, "", idx)
+        self.tree.yview_moveto(0)
+        self._update_scrollbar()
+
+    def _update_scrollbar(self):
+        total = max(self._total, 1)
+        first = self.top / total
+        last = min(1.0, (self.top + self.visible) / total)
+        self.scroll.set(first, last)
+
+    # Scrolling
+    def scroll_to(self, index):
+        self._absorb_native_scroll()
+        self.top = max(0, index)
+        self.render()
+
+    def _absorb_native_scroll(self):
+        # Keyboard navigation may have scrolled the tree into the margin rows
+        n = len(self._shown)
+        if n:
+            self.top += int(round(self.tree.yview()[0] * n))
+
+    def _on_wheel(self, direction):
+        self.scroll_to(self.top + 3 * direction)
+        return "break"
+
+    def _on_scrollbar(self, action, *args):
+        if action == "moveto":
+            self.scroll_to(int(float(args[0]) * self._total))
+        elif action == "scroll":
+            step = self.visible if args[1] == "pages" else 1
+            self.scroll_to(self.top + int(args[0]) * step)
+
+    def _on_resize(self, event):
+        rowheight = int(ttk.Style().lookup("Treeview", "rowheight") or 20)
+        visible = max(1, (event.height - 25) // rowheight)
+        if visible != self.visible:
+            self.visible = visible
+            self.render()
+
 # ---------------------------
 # GUI Application
 # ---------------------------
 class POSApp:
     def __init__(self, root, db: DBHandler):
+        started = time.perf_counter()
         self.root = root
         self.db = db
         self.root.title("POS - Miscelanea Don Papu")
-        self.root.geometry("1100x650")
-        self.cart = []  # list of dicts {id_producto, nombre, cantidad, precio_unitario, subtotal}
+        self.root.geometry("1100x680")
+        self.cart = Cart()
+        self.cart.subscribe(self.on_cart_change)
+        self.cart_key = str(uuid.uuid4())  # owner of this cart's stock reservations (MULTI_REGISTER)
+        self.reserving = {}  # id_producto -> units whose reservation is still in flight
+        self.sale_in_progress = False
+
+        # DB work runs on worker threads; results and errors come back via the Tk loop
+        self.jobs = JobExecutor(root, workers=db.cfg.POOL_SIZE, on_busy=self.set_busy)
+        self.db.report_error = lambda title, msg: self.jobs.post(messagebox.showerror, title, msg)
 
+        # Sales finalized without MySQL go to a local journal and are replayed in the background
+        self.journal = SaleJournal(db.cfg.JOURNAL_PATH)
+        self.offline_var = tk.BooleanVar(value=db.cfg.OFFLINE_CHECKOUT)
+        self.syncer = SaleSyncer(db, self.journal, interval=db.cfg.SYNC_INTERVAL,
+                                 on_change=lambda: self.jobs.post(self.on_sync_change))
+        # Stock and product changes made by other registers, applied as they commit
+        self.changes = ChangeFeed(db, interval=db.cfg.CHANGE_FEED_INTERVAL, retention=db.cfg.CHANGE_FEED_RETENTION,
+                                  on_change=lambda ids: self.jobs.post(self.on_catalog_change, ids))
+
+        # Only the Sales tab is built up front; the rest is built when first shown
+        self.build_status_bar()
         self.create_widgets()
-        self.load_products()
+        self.update_sync_status()
+        # The change feed is positioned before the first catalog read, so no change falls in between
+        self.jobs.submit(None, self.changes.position, on_done=self.on_feed_positioned,
+                         on_error=lambda e: self.on_feed_positioned(None))
+        self.first_frame_ms = None
+        self.root.after_idle(self.on_first_frame, started)
+
+    def on_first_frame(self, started):
+        self.root.update_idletasks()
+        self.first_frame_ms = (time.perf_counter() - started) * 1000
+        # Launch to first interactive frame, and the part of it spent in POSApp
+        TRACE.record("POSApp.startup", process_age() * 1000)
+        TRACE.record("POSApp.first_frame", self.first_frame_ms)
+        # Housekeeping that has no business delaying the first frame
+        self.jobs.submit(None, self.journal.prune)
+        self.jobs.submit(None, self.db.prune_changes, self.db.cfg.CHANGE_FEED_RETENTION, on_error=lambda e: None)
+        self.syncer.start()
+
+    def on_feed_positioned(self, seq):
+        # seq is None without a feed, or with MySQL down (the feed's first poll positions it then)
+        self.load_products_for_sales()
+        self.changes.start()
+
+    def close(self):
+        self.syncer.stop()
+        self.changes.stop()
+        self.jobs.shutdown()
+        self.journal.close()
+
+    def build_status_bar(self):
+        bar = ttk.Frame(self.root)
+        bar.pack(side="bottom", fill="x")
+        self.busy_var = tk.StringVar(value="")
+        self.busy_progress = ttk.Progressbar(bar, mode="indeterminate", length=120)
+        ttk.Label(bar, textvariable=self.busy_var).pack(side="right", padx=5)
+
+    def set_busy(self, busy):
+        if busy:
+            self.busy_var.set("Cargando...")
+            self.busy_progress.pack(side="right", padx=5, pady=2)
+            self.busy_progress.start(15)
+        else:
+            self.busy_var.set("")
+            self.busy_progress.stop()
+            self.busy_progress.pack_forget()
 
     def create_widgets(self):
         tab_control = ttk.Notebook(self.root)
+        self.tab_control = tab_control
         self.tab_inventory = ttk.Frame(tab_control)
         self.tab_sales = ttk.Frame(tab_control)
         self.tab_reports = ttk.Frame(tab_control)
+        self.tab_restock = ttk.Frame(tab_control)
+        self.tab_diagnostics = None  # built on first Ctrl+Shift+D
 
         tab_control.add(self.tab_inventory, text="Inventory")
         tab_control.add(self.tab_sales, text="Sales")
         tab_control.add(self.tab_reports, text="Reports")
+        tab_control.add(self.tab_restock, text="Restock")
         tab_control.pack(expand=1, fill="both")
+        self.root.bind("<Control-Shift-D>", lambda e: self.toggle_diagnostics())
 
-        self.build_inventory_tab()
+        # tab -> builder, until the tab is first shown; loads asked of a built
+        # tab that is not on screen wait in deferred_loads until it is
+        self.unbuilt_tabs = {str(self.tab_inventory): self.build_inventory_tab,
+                             str(self.tab_reports): self.build_reports_tab,
+                             str(self.tab_restock): self.build_restock_tab}
+        self.deferred_loads = {}
+        tab_control.select(self.tab_sales)
         self.build_sales_tab()
-        self.build_reports_tab()
+        tab_control.bind("<<NotebookTabChanged>>", lambda e: self.on_tab_shown())
+
+    def on_tab_shown(self):
+        tab = self.tab_control.select()
+        build = self.unbuilt_tabs.pop(tab, None)
+        if build:
+            build()
+        for load in self.deferred_loads.pop(tab, ()):
+            load()
+
+    def defer_load(self, tab, load):
+        """
+        True if load() should not run now: tab is not built yet (it loads when
+        built) or not on screen (load() runs when it is next shown).
+        """
+        if str(tab) in self.unbuilt_tabs:
+            return True
+        if self.tab_control.select() != str(tab):
+            self.deferred_loads.setdefault(str(tab), {})[load] = None
+            return True
+        return False
 
     # ---------------------------
     # Inventory Tab
@@ -204,15 +3337,13 @@ class POSApp:
 
         # Treeview
         cols = ("ID", "Nombre", "Compra", "Venta", "Cantidad", "SKU")
-        self.inv_tree = ttk.Treeview(frame, columns=cols, show="headings")
-        for c in cols:
-            self.inv_tree.heading(c, text=c)
-            self.inv_tree.column(c, width=120)
-        self.inv_tree.place(x=10, y=10, width=760, height=520)
+        self.inv_table = VirtualTable(frame, cols, fetch=self.db.get_products_page, width=120, jobs=self.jobs)
+        self.inv_table.place(x=10, y=10, width=760, height=520)
+        self.inv_tree = self.inv_table.tree
 
         # Controls
         control_frame = ttk.LabelFrame(frame, text="Product")
-        control_frame.place(x=780, y=10, width=300, height=300)
+        control_frame.place(x=780, y=10, width=300, height=340)
 
         ttk.Label(control_frame, text="Nombre").grid(row=0, column=0, sticky="e", padx=5, pady=5)
         ttk.Label(control_frame, text="Categoria").grid(row=1, column=0, sticky="e", padx=5, pady=5)
@@ -236,37 +3367,51 @@ class POSApp:
         self.i_sku.grid(row=5, column=1, padx=5, pady=3)
 
         ttk.Button(control_frame, text="Add Product", command=self.add_product).grid(row=6, column=1, pady=8)
-        ttk.Button(control_frame, text="Refresh", command=self.load_products).grid(row=7, column=1, pady=4)
+        ttk.Button(control_frame, text="Refresh", command=lambda: self.load_products(reload=True)).grid(row=7, column=1, pady=4)
         ttk.Button(control_frame, text="Edit Selected", command=self.edit_selected_product).grid(row=8, column=1, pady=4)
         ttk.Button(control_frame, text="Delete Selected", command=self.delete_selected_product).grid(row=9, column=1, pady=4)
+        ttk.Button(control_frame, text="Import CSV...", command=self.import_products).grid(row=10, column=1, pady=4)
 
-    def load_products(self):
-        for i in self.inv_tree.get_children():
-            self.inv_tree.delete(i)
-        rows = self.db.get_all_products()
-        for r in rows:
-            self.inv_tree.insert("", tk.END, values=r)
+    def load_products(self, reload=False):
+        if reload:
+            self.reload_catalog()
+            return
+        if self.defer_load(self.tab_inventory, self.load_products):
+            return
+        self.inv_table.refresh()
 
     def add_product(self):
         try:
-            nombre = self.i_nombre.get().strip()
-            categoria = self.i_categoria.get().strip()
-            precio_compra = Decimal(self.i_precio_compra.get())
-            precio_venta = Decimal(self.i_precio_venta.get())
-            cantidad = int(self.i_cantidad.get())
-            sku = self.i_sku.get().strip() or None
-
-            if not nombre:
-                raise ValueError("Nombre requerido")
-
-            ok = self.db.add_product(nombre, categoria, precio_compra, precio_venta, cantidad, sku)
-            if ok:
-                messagebox.showinfo("OK", "Producto agregado")
-                self.clear_product_form()
-                self.load_products()
+            fields = parse_product_fields(self.i_nombre.get(), self.i_categoria.get(), self.i_precio_compra.get(),
+                                          self.i_precio_venta.get(), self.i_cantidad.get(), self.i_sku.get())
+            self.jobs.submit(None, self.db.add_product, *fields, on_done=self.on_product_added)
         except (InvalidOperation, ValueError) as e:
             messagebox.showerror("Input Error", f"Datos inválidos: {e}")
 
+    def on_product_added(self, ok):
+        if ok:
+            messagebox.showinfo("OK", "Producto agregado")
+            self.clear_product_form()
+            self.load_products()
+
+    def import_products(self):
+        path = filedialog.askopenfilename(parent=self.root, filetypes=[("CSV", "*.csv"), ("All files", "*")])
+        if not path:
+            return
+        progress = lambda read, rejected: self.jobs.post(self.busy_var.set, f"Importando... {read} filas ({rejected} rechazadas)")
+        self.jobs.submit(None, import_products_csv, self.db, path, self.db.cfg.IMPORT_BATCH_SIZE, progress,
+                         on_done=lambda res: self.on_products_imported(path, res),
+                         on_error=lambda e: messagebox.showerror("Import Error", f"No se pudo importar: {e}"))
+
+    def on_products_imported(self, path, res):
+        msg = f"{res['written']} de {res['read']} filas importadas en {res['seconds']:.1f}s"
+        if res["rejected"]:
+            rejects = path.rsplit(".", 1)[0] + ".rechazados.csv"
+            write_rejects(rejects, res["rejected"])
+            msg += f"\n{len(res['rejected'])} filas rechazadas, ver {rejects}"
+        messagebox.showinfo("Import", msg)
+        self.load_products()
+
     def clear_product_form(self):
         self.i_nombre.delete(0, tk.END)
         self.i_categoria.delete(0, tk.END)
@@ -282,7 +3427,10 @@ class POSApp:
             return
         item = self.inv_tree.item(sel[0])['values']
         idp = item[0]
-        prod = self.db.get_product_by_id(idp)
+        self.jobs.submit(("edit", idp), self.db.get_product_by_id, idp,
+                         on_done=lambda prod: self.edit_product_dialog(idp, prod))
+
+    def edit_product_dialog(self, idp, prod):
         if not prod:
             messagebox.showerror("Error", "Producto no encontrado")
             return
@@ -299,22 +3447,13 @@ class POSApp:
             messagebox.showerror("Input Error", f"Datos inválidos: {e}")
             return
 
-        con = self.db.connect()
-        if not con:
-            return
-        try:
-            cur = con.cursor()
-            cur.execute("""
-                UPDATE producto SET nombre=%s, precio_compra=%s, precio_venta=%s, cantidad=%s WHERE id_producto=%s
-            """, (new_nombre, str(new_precio_compra), str(new_precio_venta), new_cantidad, idp))
-            con.commit()
-            messagebox.showinfo("OK", "Producto actualizado")
+        self.jobs.submit(None, self.db.update_product, idp, new_nombre, new_precio_compra, new_precio_venta, new_cantidad,
+                         on_done=lambda ok: self.on_product_changed(ok, "Producto actualizado"))
+
+    def on_product_changed(self, ok, msg):
+        if ok:
+            messagebox.showinfo("OK", msg)
             self.load_products()
-        except mysql.connector.Error as e:
-            con.rollback()
-            messagebox.showerror("DB Error", f"Error actualizando producto: {e}")
-        finally:
-            con.close()
 
     def delete_selected_product(self):
         sel = self.inv_tree.selection()
@@ -325,20 +3464,8 @@ class POSApp:
         idp = item[0]
         if not messagebox.askyesno("Confirm", f"Eliminar producto ID {idp}?"):
             return
-        con = self.db.connect()
-        if not con:
-            return
-        try:
-            cur = con.cursor()
-            cur.execute("DELETE FROM producto WHERE id_producto=%s", (idp,))
-            con.commit()
-            messagebox.showinfo("OK", "Producto eliminado")
-            self.load_products()
-        except mysql.connector.Error as e:
-            con.rollback()
-            messagebox.showerror("DB Error", f"Error eliminando producto: {e}")
-        finally:
-            con.close()
+        self.jobs.submit(None, self.db.delete_product, idp,
+                         on_done=lambda ok: self.on_product_changed(ok, "Producto eliminado"))
 
     # ---------------------------
     # Sales Tab
@@ -346,13 +3473,31 @@ class POSApp:
     def build_sales_tab(self):
         frame = self.tab_sales
 
-        # Left: product list
+        # Left: scan/search box, its matches, and the full product list
+        ttk.Label(frame, text="Buscar / escanear:").place(x=10, y=12)
+        self.search_var = tk.StringVar()
+        self.search_entry = ttk.Entry(frame, textvariable=self.search_var)
+        self.search_entry.place(x=130, y=10, width=400)
+        self.search_entry.bind("<KeyRelease>", self.on_search_key)
+        self.search_entry.bind("<Return>", lambda e: self.scan_entered())
+        self.search_entry.bind("<Down>", lambda e: self.focus_search_results())
+        self.search_entry.bind("<Escape>", lambda e: self.clear_search())
+
+        search_cols = ("ID", "Nombre", "Venta", "Stock", "SKU")
+        self.search_tree = ttk.Treeview(frame, columns=search_cols, show="headings")
+        for c, w in zip(search_cols, (50, 220, 70, 60, 120)):
+            self.search_tree.heading(c, text=c)
+            self.search_tree.column(c, width=w)
+        self.search_tree.place(x=10, y=38, width=520, height=130)
+        self.search_tree.bind("<Double-1>", lambda e: self.add_search_result())
+        self.search_tree.bind("<Return>", lambda e: self.add_search_result())
+
         cols = ("ID", "Nombre", "Venta", "Cantidad")
-        self.sales_tree = ttk.Treeview(frame, columns=cols, show="headings")
-        for c in cols:
-            self.sales_tree.heading(c, text=c)
-            self.sales_tree.column(c, width=150)
-        self.sales_tree.place(x=10, y=10, width=520, height=520)
+        # r: id, nombre, precio_compra, precio_venta, cantidad, sku
+        self.sales_table = VirtualTable(frame, cols, fetch=self.db.get_products_page,
+                                        values=lambda r: (r[0], r[1], r[3], r[4]), width=150, jobs=self.jobs)
+        self.sales_table.place(x=10, y=178, width=520, height=352)
+        self.sales_tree = self.sales_table.tree
 
         # Right: cart and controls
         cart_frame = ttk.LabelFrame(frame, text="Cart")
@@ -364,6 +3509,7 @@ class POSApp:
             self.cart_tree.heading(c, text=c)
             self.cart_tree.column(c, width=100)
         self.cart_tree.place(x=10, y=10, width=510, height=300)
+        self.cart_tree.tag_configure("short", foreground="#c9302c")  # more units than the catalog now has
 
         ttk.Button(cart_frame, text="Add Selected to Cart", command=self.add_selected_to_cart).place(x=10, y=320)
         ttk.Button(cart_frame, text="Remove Selected from Cart", command=self.remove_selected_from_cart).place(x=160, y=320)
@@ -374,91 +3520,379 @@ class POSApp:
         ttk.Label(cart_frame, textvariable=self.total_var).place(x=60, y=360)
 
         ttk.Button(cart_frame, text="Finalize Sale", command=self.finalize_sale).place(x=10, y=400)
-        ttk.Button(cart_frame, text="Refresh Products", command=self.load_products_for_sales).place(x=140, y=400)
+        ttk.Button(cart_frame, text="Refresh Products", command=lambda: self.load_products_for_sales(reload=True)).place(x=140, y=400)
 
-        self.load_products_for_sales()
+        ttk.Checkbutton(cart_frame, text="Venta offline (guardar localmente y sincronizar después)",
+                        variable=self.offline_var).place(x=10, y=440)
+        self.sync_var = tk.StringVar(value="")
+        ttk.Label(cart_frame, textvariable=self.sync_var).place(x=10, y=470)
+        ttk.Button(cart_frame, text="Revisar conflictos...", command=self.review_conflicts).place(x=390, y=465)
 
-    def load_products_for_sales(self):
-        for i in self.sales_tree.get_children():
-            self.sales_tree.delete(i)
-        rows = self.db.get_all_products()
-        for r in rows:
-            # r: id, nombre, precio_compra, precio_venta, cantidad, sku
-            self.sales_tree.insert("", tk.END, values=(r[0], r[1], r[3], r[4]))
+    def load_products_for_sales(self, reload=False):
+        if reload:
+            self.reload_catalog()
+            return
+        if self.defer_load(self.tab_sales, self.load_products_for_sales):
+            return
+        self.sales_table.refresh()
 
     def add_selected_to_cart(self):
         sel = self.sales_tree.selection()
         if not sel:
             messagebox.showwarning("Select", "Seleccione un producto")
             return
-        item = self.sales_tree.item(sel[0])['values']
-        idp, nombre, precio_venta, stock = item
+        # Listed rows went through the catalog, which has the typed price and current
+        # stock; the Treeview only has their text
+        row = self.db.catalog.get(int(sel[0]))
+        if row is None:
+            messagebox.showwarning("Select", "El producto ya no existe")
+            return
+        idp, nombre, precio_venta, stock = row[0], row[1], row[3], row[4]
         try:
             qty = simpledialog.askinteger("Cantidad", f"Ingrese cantidad para '{nombre}' (disponible {stock}):", minvalue=1, initialvalue=1)
             if qty is None:
                 return
-            if qty > stock:
-                messagebox.showerror("Stock", "Cantidad mayor al stock disponible")
-                return
-            # Check if already in cart
-            for c in self.cart:
-                if c['id_producto'] == idp:
-                    c['cantidad'] += qty
-                    c['subtotal'] = Decimal(str(c['precio_unitario'])) * Decimal(c['cantidad'])
-                    self.refresh_cart_view()
-                    return
-            price = Decimal(str(precio_venta))
-            subtotal = price * Decimal(qty)
-            self.cart.append({
-                'id_producto': idp,
-                'nombre': nombre,
-                'cantidad': qty,
-                'precio_unitario': price,
-                'subtotal': subtotal
-            })
-            self.refresh_cart_view()
+            self.add_to_cart(idp, nombre, precio_venta, stock, qty)
         except Exception as e:
             messagebox.showerror("Error", f"Entrada inválida: {e}")
 
-    def refresh_cart_view(self):
-        for i in self.cart_tree.get_children():
-            self.cart_tree.delete(i)
-        total = Decimal('0.00')
-        for c in self.cart:
-            self.cart_tree.insert("", tk.END, values=(c['id_producto'], c['nombre'], c['cantidad'], f"{c['precio_unitario']:.2f}", f"{c['subtotal']:.2f}"))
-            total += c['subtotal']
-        self.total_var.set(f"{total:.2f}")
+    def cart_locked(self):
+        """True (after telling the cashier) while the cart is being booked; edits would be lost."""
+        if self.sale_in_progress:
+            messagebox.showwarning("Venta", "Espere a que termine la venta en curso")
+            return True
+        return False
+
+    def add_to_cart(self, idp, nombre, precio_venta, stock, qty):
+        if self.cart_locked():
+            return False
+        if self.db.cfg.MULTI_REGISTER:
+            self.reserve_and_add(idp, nombre, precio_venta, qty)
+            return True
+        if self.cart.quantity(idp) + qty > stock:
+            messagebox.showerror("Stock", "Cantidad mayor al stock disponible")
+            return False
+        self.cart.add(idp, nombre, precio_venta, qty)
+        return True
+
+    def reserve_and_add(self, idp, nombre, precio_venta, qty):
+        # Several tills: the database checks live stock net of the other carts'
+        # reservations, instead of the possibly stale stock shown here
+        key, reserving = self.cart_key, self.reserving
+        reserving[idp] = reserving.get(idp, 0) + qty
+        total = self.cart.quantity(idp) + reserving[idp]
+
+        def settle():
+            reserving[idp] -= qty
+            if not reserving[idp]:
+                del reserving[idp]
+            if self.cart_key == key:
+                return True
+            # The cart was cleared meanwhile: the hold must not outlive it
+            self.jobs.submit(None, self.db.release_stock, key, idp, on_error=lambda e: None)
+            return False
+
+        def done(left):
+            if settle():
+                self.cart.add(idp, nombre, precio_venta, qty)
+
+        def failed(e):
+            if not settle():
+                return
+            messagebox.showerror("Stock", str(e) if isinstance(e, StockError) else f"No se pudo reservar: {e}")
+        self.jobs.submit(None, self.db.reserve_stock, key, idp, total, on_done=done, on_error=failed)
+
+    # Scan/search box. "3*7501055300075" adds three units.
+    SCAN_QTY = re.compile(r"^\s*(\d+)\s*\*\s*(.*)$")
+
+    def parse_scan(self, text):
+        m = self.SCAN_QTY.match(text)
+        if m and int(m.group(1)) > 0:
+            return int(m.group(1)), m.group(2).strip()
+        return 1, text.strip()
+
+    def with_catalog(self, fn):
+        """Runs fn once the whole catalog is in memory (the search index needs it)."""
+        if self.db.catalog.loaded:
+            fn()
+        else:
+            # get_all_products() reports and returns [] without loading when MySQL is down
+            self.jobs.submit("catalog", self.db.get_all_products,
+                             on_done=lambda rows: fn() if self.db.catalog.loaded else None)
+
+    def on_search_key(self, event):
+        if event.keysym not in ("Return", "KP_Enter", "Down", "Up", "Escape"):
+            self.update_search()
+
+    def update_search(self):
+        _, text = self.parse_scan(self.search_var.get())
+        rows = self.db.catalog.search(text) if text else []
+        if rows is None:
+            self.with_catalog(self.update_search)
+            return
+        self.search_tree.delete(*self.search_tree.get_children())
+        for r in rows:
+            self.search_tree.insert("", tk.END, iid=r[0], values=(r[0], r[1], r[3], r[4], r[5] or ""))
+        if rows:
+            self.search_tree.selection_set(rows[0][0])
+
+    def scan_entered(self):
+        qty, text = self.parse_scan(self.search_var.get())
+        if not text:
+            return
+        if not self.db.catalog.loaded:
+            self.with_catalog(self.scan_entered)
+            return
+        # A barcode is an exact sku; anything else adds the highlighted match
+        row = self.db.catalog.get_by_sku(text)
+        if row is None:
+            self.update_search()
+            sel = self.search_tree.selection()
+            row = self.db.catalog.get(int(sel[0])) if sel else None
+        if row is None:
+            self.root.bell()
+            self.search_entry.select_range(0, tk.END)
+            return
+        if self.add_to_cart(row[0], row[1], row[3], row[4], qty):
+            self.clear_search()
+
+    def add_search_result(self):
+        sel = self.search_tree.selection()
+        row = self.db.catalog.get(int(sel[0])) if sel else None
+        if row is not None:
+            qty, _ = self.parse_scan(self.search_var.get())
+            if self.add_to_cart(row[0], row[1], row[3], row[4], qty):
+                self.clear_search()
+
+    def focus_search_results(self):
+        children = self.search_tree.get_children()
+        if children:
+            self.search_tree.focus_set()
+            self.search_tree.focus(self.search_tree.selection()[0] if self.search_tree.selection() else children[0])
+
+    def clear_search(self):
+        self.search_var.set("")
+        self.search_tree.delete(*self.search_tree.get_children())
+        self.search_entry.focus_set()
+
+    def on_cart_change(self, event, line):
+        # Cart rows use the product id as iid, so only the changed row is touched
+        if event == "clear":
+            self.cart_tree.delete(*self.cart_tree.get_children())
+        elif event == "remove":
+            self.cart_tree.delete(line.id_producto)
+        else:
+            values = (line.id_producto, line.nombre, line.cantidad, f"{line.precio_unitario:.2f}", f"{line.subtotal:.2f}")
+            if event == "add":
+                self.cart_tree.insert("", tk.END, iid=line.id_producto, values=values)
+            else:
+                self.cart_tree.item(line.id_producto, values=values)
+            self.mark_short_stock([line.id_producto])
+            self.cart_tree.see(line.id_producto)
+        self.total_var.set(f"{self.cart.total:.2f}")
+
+    def reload_catalog(self):
+        """Rereads the whole producto table, then redraws every view of it."""
+        self.db.catalog.invalidate()
+        self.jobs.submit("catalog_reload", self.db.get_all_products, True,
+                         on_done=lambda rows: self.on_catalog_change(None))
+
+    def on_catalog_change(self, ids):
+        """Another register changed these products (None: the catalog was dropped)."""
+        if ids is None:
+            self.load_products_for_sales()
+            self.load_products()
+            self.load_inventory_report()
+            return
+        # Only tables showing one of the products redraw, and only those rows change
+        self.sales_table.patch(ids)
+        if str(self.tab_inventory) not in self.unbuilt_tabs:
+            self.inv_table.patch(ids)
+        if str(self.tab_reports) not in self.unbuilt_tabs:
+            self.report_inv_table.patch(ids)
+        if any(self.search_tree.exists(idp) for idp in ids):
+            self.update_search()
+        self.mark_short_stock([idp for idp in ids if self.cart.get(idp)])
+
+    def mark_short_stock(self, ids):
+        # With MULTI_REGISTER the cart's units are reserved, so they cannot run short
+        if self.db.cfg.MULTI_REGISTER:
+            return
+        for idp in ids:
+            row = self.db.catalog.get(idp)
+            short = row is not None and self.cart.quantity(idp) > row[4]
+            self.cart_tree.item(idp, tags=("short",) if short else ())
 
     def remove_selected_from_cart(self):
         sel = self.cart_tree.selection()
         if not sel:
             messagebox.showwarning("Select", "Seleccione un item del carrito")
             return
-        item = self.cart_tree.item(sel[0])['values']
-        idp = item[0]
-        self.cart = [c for c in self.cart if c['id_producto'] != idp]
-        self.refresh_cart_view()
+        if self.cart_locked():
+            return
+        idp = int(sel[0])
+        self.cart.remove(idp)
+        if self.db.cfg.MULTI_REGISTER:
+            # A failed release only means the hold lingers until it expires
+            self.jobs.submit(None, self.db.release_stock, self.cart_key, idp, on_error=lambda e: None)
 
     def clear_cart(self):
-        self.cart = []
-        self.refresh_cart_view()
+        if self.cart_locked():
+            return
+        if not self.db.cfg.MULTI_REGISTER:
+            self.cart.clear()
+            return
+        if len(self.cart):
+            self.jobs.submit(None, self.db.release_stock, self.cart_key, on_error=lambda e: None)
+        # Under a new key, reservations still in flight release their own holds
+        self.new_cart()
+
+    def new_cart(self):
+        """Starts over after checkout; the sale took the old cart's reservations with it."""
+        self.cart_key = str(uuid.uuid4())
+        self.reserving = {}
+        self.cart.clear()
 
     def finalize_sale(self):
         if not self.cart:
             messagebox.showwarning("Cart", "El carrito está vacío")
             return
+        if self.sale_in_progress:
+            return
+        if self.reserving:
+            # Those units are not in the cart yet, and their holds are not in the sale
+            messagebox.showwarning("Cart", "Espere a que terminen las reservas en curso")
+            return
         # Prepare items for DB
-        items = []
-        for c in self.cart:
-            items.append({
-                'id_producto': c['id_producto'],
-                'cantidad': c['cantidad'],
-                'precio_unitario': str(c['precio_unitario'])
-            })
-        sale_id = self.db.create_sale(items)
+        items = self.cart.items()
+        if self.offline_var.get():
+            self.finalize_offline(items)
+            return
+        self.sale_in_progress = True
+        key = str(uuid.uuid4())
+        self.jobs.submit(None, self.book_online, items, key, self.cart_key, on_done=self.on_sale_done,
+                         on_error=lambda e: self.on_sale_error(e, items, key))
+
+    def book_online(self, items, key, cart_key):
+        # Keyed (once setup-db has added the column) so that a sale which times
+        # out here and is then saved offline can never be booked twice
+        try:
+            return self.db.book_sale([dict(it) for it in items], idempotency_key=key, cart_key=cart_key)
+        except SchemaError:
+            if self.db.cfg.MULTI_REGISTER:
+                raise
+            return self.db.book_sale([dict(it) for it in items], cart_key=cart_key)
+
+    def on_sale_error(self, e, items, key):
+        self.sale_in_progress = False
+        if is_connection_error(e) and messagebox.askyesno(
+                "Sin conexión", f"No se pudo conectar con la base de datos ({e}).\n\n"
+                                "¿Guardar la venta localmente y sincronizarla después?"):
+            self.finalize_offline(items, key)
+            return
+        messagebox.showerror("Venta Error", f"No se pudo completar la venta: {e}")
+
+    def finalize_offline(self, items, key=None):
+        # Stock is checked against the local catalog; the syncer checks again
+        # against MySQL and parks the sale as a conflict if it no longer fits
+        wanted = {}
+        for it in items:
+            wanted[it['id_producto']] = wanted.get(it['id_producto'], 0) + it['cantidad']
+        left = {}
+        for idp, qty in wanted.items():
+            row = self.db.catalog.get(idp)
+            if row is None:
+                messagebox.showerror("Stock", f"Producto ID {idp} no está en el catálogo local; no se puede verificar el stock")
+                return
+            if qty > row[4]:
+                messagebox.showerror("Stock", f"Stock insuficiente para producto ID {idp} (disponible {row[4]})")
+                return
+            left[idp] = row[4] - qty
+        try:
+            self.journal.append(items, key)
+        except sqlite3.Error as e:
+            messagebox.showerror("Venta Error", f"No se pudo guardar la venta localmente: {e}")
+            return
+        self.db.catalog.apply_stock(left)
+        self.syncer.wake()
+        messagebox.showinfo("Venta", "Venta guardada localmente (pendiente de sincronizar)")
+        self.clear_cart()
+        self.update_sync_status()
+        if self.db.catalog.loaded:
+            # Otherwise the views would go to MySQL, which may be down
+            self.load_products_for_sales()
+            self.load_products()
+
+    def update_sync_status(self):
+        counts = self.journal.counts()
+        text = f"Pendientes: {counts.get('pendiente', 0)}   Conflictos: {counts.get('conflicto', 0)}"
+        if self.syncer.blocked:
+            text += f"   ({self.syncer.blocked})"
+        self.sync_var.set(text)
+
+    def on_sync_change(self):
+        self.update_sync_status()
+        self.load_products_for_sales()
+        self.load_products()
+        self.load_sales_report()
+
+    def review_conflicts(self):
+        win = tk.Toplevel(self.root)
+        win.title("Ventas offline en conflicto")
+        win.geometry("820x380")
+        cols = ("Fecha", "Productos", "Total", "Motivo")
+        tree = ttk.Treeview(win, columns=cols, show="headings")
+        for c, w in zip(cols, (140, 260, 80, 320)):
+            tree.heading(c, text=c)
+            tree.column(c, width=w)
+        tree.place(x=10, y=10, width=800, height=310)
+
+        sales = {}
+        for key, creada, items, error in self.journal.conflicts():
+            sales[key] = (creada, items)
+            total = Money(sum(Money.of(it['precio_unitario']).cents * it['cantidad'] for it in items))
+            desc = ", ".join(f"{it['cantidad']} x ID {it['id_producto']}" for it in items)
+            tree.insert("", tk.END, iid=key, values=(creada, desc, f"{total:.2f}", error))
+
+        def selected():
+            sel = tree.selection()
+            if not sel:
+                messagebox.showwarning("Select", "Seleccione una venta", parent=win)
+            return sel[0] if sel else None
+
+        def resolved(key):
+            tree.delete(key)
+            self.update_sync_status()
+
+        def force():
+            key = selected()
+            if not key or not messagebox.askyesno(
+                    "Forzar venta", "Se registrará la venta aunque el stock quede negativo. ¿Continuar?", parent=win):
+                return
+            creada, items = sales[key]
+
+            def done(sale_id):
+                self.journal.mark(key, "sincronizada", id_venta=sale_id)
+                resolved(key)
+                self.on_sync_change()
+            self.jobs.submit(None, self.db.book_sale, items, key, creada, True, on_done=done,
+                             on_error=lambda e: messagebox.showerror("Venta Error", str(e), parent=win))
+
+        def discard():
+            key = selected()
+            if key and messagebox.askyesno("Descartar", "La venta no se registrará. ¿Continuar?", parent=win):
+                self.journal.mark(key, "descartada")
+                resolved(key)
+
+        ttk.Button(win, text="Forzar venta", command=force).place(x=10, y=335)
+        ttk.Button(win, text="Descartar", command=discard).place(x=130, y=335)
+        ttk.Button(win, text="Cerrar", command=win.destroy).place(x=730, y=335)
+
+    def on_sale_done(self, sale_id):
+        self.sale_in_progress = False
         if sale_id:
             messagebox.showinfo("Venta", f"Venta realizada. ID: {sale_id}")
-            self.clear_cart()
+            self.new_cart()
             self.load_products_for_sales()
             self.load_products()
             # Optionally refresh reports
@@ -470,61 +3904,454 @@ class POSApp:
     def build_reports_tab(self):
         frame = self.tab_reports
 
-        # Sales report
+        # Sales report: aggregated in SQL, detail rows only on drill-down
         sales_frame = ttk.LabelFrame(frame, text="Sales")
         sales_frame.place(x=10, y=10, width=1060, height=300)
 
-        cols = ("Sale ID", "Date", "Total", "Detail ID", "Product ID", "Product", "Qty", "Unit Price", "Subtotal")
-        self.report_sales_tree = ttk.Treeview(sales_frame, columns=cols, show="headings")
+        ttk.Label(sales_frame, text="Periodo").place(x=10, y=5)
+        self.report_period = ttk.Combobox(sales_frame, values=list(PERIODS), state="readonly", width=10)
+        self.report_period.set("Diario")
+        self.report_period.place(x=70, y=5)
+        self.report_period.bind("<<ComboboxSelected>>", lambda e: self.reset_report_range())
+        ttk.Label(sales_frame, text="Desde").place(x=190, y=5)
+        self.report_from = ttk.Entry(sales_frame, width=12)
+        self.report_from.place(x=240, y=5)
+        ttk.Label(sales_frame, text="Hasta").place(x=350, y=5)
+        self.report_to = ttk.Entry(sales_frame, width=12)
+        self.report_to.place(x=395, y=5)
+        ttk.Button(sales_frame, text="Refresh Sales", command=self.load_sales_report).place(x=510, y=3)
+
+        cols = ("Periodo", "Ventas", "Unidades", "Ingreso", "Costo", "Margen")
+        self.report_summary_tree = ttk.Treeview(sales_frame, columns=cols, show="headings")
         for c in cols:
-            self.report_sales_tree.heading(c, text=c)
-            self.report_sales_tree.column(c, width=110)
-        self.report_sales_tree.place(x=10, y=10, width=1030, height=250)
+            self.report_summary_tree.heading(c, text=c)
+            self.report_summary_tree.column(c, width=85)
+        self.report_summary_tree.place(x=10, y=35, width=540, height=210)
+        self.report_summary_tree.bind("<Double-1>", lambda e: self.open_sales_detail())
+        ttk.Button(sales_frame, text="Ver detalle", command=self.open_sales_detail).place(x=10, y=250)
 
-        ttk.Button(sales_frame, text="Refresh Sales", command=self.load_sales_report).place(x=10, y=265)
+        top_cols = ("ID", "Producto", "Unidades", "Ingreso", "Margen")
+        self.report_top_tree = ttk.Treeview(sales_frame, columns=top_cols, show="headings")
+        for c in top_cols:
+            self.report_top_tree.heading(c, text=c)
+            self.report_top_tree.column(c, width=90)
+        self.report_top_tree.column("Producto", width=140)
+        self.report_top_tree.place(x=560, y=35, width=480, height=210)
+        ttk.Label(sales_frame, text="Top productos (por ingreso)").place(x=560, y=252)
+        ttk.Button(sales_frame, text="Exportar ventas...", command=self.export_sales).place(x=110, y=250)
+
+        self.report_ranges = {}  # summary iid -> (start, end) for drill-down
+        self.reset_report_range(load=False)
 
         # Inventory report
         inv_frame = ttk.LabelFrame(frame, text="Inventory")
         inv_frame.place(x=10, y=320, width=1060, height=300)
 
         inv_cols = ("ID", "Product", "Category", "Purchase", "Sale", "Quantity", "SKU")
-        self.report_inv_tree = ttk.Treeview(inv_frame, columns=inv_cols, show="headings")
-        for c in inv_cols:
-            self.report_inv_tree.heading(c, text=c)
-            self.report_inv_tree.column(c, width=140)
-        self.report_inv_tree.place(x=10, y=10, width=1030, height=240)
+        self.report_inv_table = VirtualTable(inv_frame, inv_cols, fetch=self.db.get_products_page,
+                                             values=lambda r: (r[0], r[1], "", f"{r[2]:.2f}", f"{r[3]:.2f}", r[4], r[5]), width=140,
+                                             jobs=self.jobs)
+        self.report_inv_table.place(x=10, y=10, width=1030, height=240)
+        self.report_inv_tree = self.report_inv_table.tree
 
-        ttk.Button(inv_frame, text="Refresh Inventory", command=self.load_inventory_report).place(x=10, y=255)
+        ttk.Button(inv_frame, text="Refresh Inventory", command=lambda: self.load_inventory_report(reload=True)).place(x=10, y=255)
+        ttk.Button(inv_frame, text="Exportar inventario...", command=lambda: self.export_report("products")).place(x=140, y=255)
 
         # Initial load
         self.load_sales_report()
         self.load_inventory_report()
 
+    def reset_report_range(self, load=True):
+        start, end = default_range(PERIODS[self.report_period.get()], date.today())
+        self.report_from.delete(0, tk.END)
+        self.report_from.insert(0, start.isoformat())
+        self.report_to.delete(0, tk.END)
+        self.report_to.insert(0, (end - timedelta(days=1)).isoformat())
+        if load:
+            self.load_sales_report()
+
     def load_sales_report(self):
-        for i in self.report_sales_tree.get_children():
-            self.report_sales_tree.delete(i)
-        rows = self.db.get_sales()
+        if self.defer_load(self.tab_reports, self.load_sales_report):
+            return
+        try:
+            start = parse_date(self.report_from.get())
+            end = parse_date(self.report_to.get()) + timedelta(days=1)
+        except ValueError as e:
+            messagebox.showerror("Input Error", f"Fecha inválida (use AAAA-MM-DD): {e}")
+            return
+        period = PERIODS[self.report_period.get()]
+        self.jobs.submit("report_summary", self.db.get_sales_summary, period, start, end,
+                         on_done=lambda rows: self.show_sales_summary(period, rows))
+        self.jobs.submit("report_top", self.db.get_top_products, start, end,
+                         on_done=self.show_top_products)
+
+    def show_sales_summary(self, period, rows):
+        self.report_summary_tree.delete(*self.report_summary_tree.get_children())
+        self.report_ranges = {}
         for r in rows:
-            # r: id_venta, fecha, total, id_detalle, id_producto, nombre, cantidad, precio_unitario, subtotal
-            self.report_sales_tree.insert("", tk.END, values=r)
+            # r: periodo, ventas, unidades, ingreso, costo, margen
+            iid = self.report_summary_tree.insert("", tk.END, values=(r[0], r[1], r[2], f"{r[3]:.2f}", f"{r[4]:.2f}", f"{r[5]:.2f}"))
+            self.report_ranges[iid] = (r[0], period_end(period, r[0]))
 
-    def load_inventory_report(self):
-        for i in self.report_inv_tree.get_children():
-            self.report_inv_tree.delete(i)
-        rows = self.db.get_all_products()
+    def show_top_products(self, rows):
+        self.report_top_tree.delete(*self.report_top_tree.get_children())
         for r in rows:
-            # r: id, nombre, precio_compra, precio_venta, cantidad, sku
-            self.report_inv_tree.insert("", tk.END, values=(r[0], r[1], "", f"{r[2]:.2f}", f"{r[3]:.2f}", r[4], r[5]))
+            # r: id_producto, nombre, unidades, ingreso, margen
+            self.report_top_tree.insert("", tk.END, values=(r[0], r[1], r[2], f"{r[3]:.2f}", f"{r[4]:.2f}"))
+
+    def open_sales_detail(self):
+        sel = self.report_summary_tree.selection()
+        if not sel:
+            messagebox.showwarning("Select", "Seleccione un periodo")
+            return
+        start, end = self.report_ranges[sel[0]]
+        win = tk.Toplevel(self.root)
+        win.title(f"Ventas {start} - {end - timedelta(days=1)}")
+        win.geometry("1060x420")
+        cols = ("Sale ID", "Date", "Total", "Detail ID", "Product ID", "Product", "Qty", "Unit Price", "Subtotal")
+        # r: id_venta, fecha, total, id_detalle, id_producto, nombre, cantidad, precio_unitario, subtotal
+        table = VirtualTable(win, cols, fetch=lambda after, n: self.db.get_sales_page(after, n, start, end),
+                             key=lambda r: (r[1], r[0], r[3]), iid=lambda r: str(r[3]), width=110, jobs=self.jobs)
+        table.place(x=10, y=10, width=1040, height=400)
+        table.refresh()
+
+    def export_sales(self):
+        try:
+            start = parse_date(self.report_from.get())
+            end = parse_date(self.report_to.get()) + timedelta(days=1)
+        except ValueError as e:
+            messagebox.showerror("Input Error", f"Fecha inválida (use AAAA-MM-DD): {e}")
+            return
+        self.export_report("sales", start, end)
+
+    def export_report(self, kind, start=None, end=None):
+        path = filedialog.asksaveasfilename(
+            parent=self.root, defaultextension=".csv",
+            filetypes=[("CSV", "*.csv"), ("Parquet", "*.parquet")])
+        if not path:
+            return
+        fmt = "parquet" if path.lower().endswith(".parquet") else "csv"
+        self.jobs.submit(None, export_data, self.db, kind, fmt, path, start, end,
+                         on_done=lambda n: messagebox.showinfo("Export", f"{n} filas exportadas a {path}"),
+                         on_error=lambda e: messagebox.showerror("Export Error", f"No se pudo exportar: {e}"))
+
+    def load_inventory_report(self, reload=False):
+        if reload:
+            self.reload_catalog()
+            return
+        if self.defer_load(self.tab_reports, self.load_inventory_report):
+            return
+        self.report_inv_table.refresh()
+
+    # ---------------------------
+    # Restock Tab
+    # ---------------------------
+    def build_restock_tab(self):
+        frame = self.tab_restock
+        cfg = self.db.cfg
+        self.restock = None  # RestockReport, computed off the Tk thread
+
+        self.restock_low_var = tk.BooleanVar(value=True)
+        ttk.Checkbutton(frame, text="Solo bajo punto de reorden", variable=self.restock_low_var,
+                        command=self.filter_restock).place(x=10, y=8)
+        ttk.Button(frame, text="Recalcular", command=lambda: self.load_restock_report(reload=True)).place(x=200, y=5)
+        ttk.Button(frame, text="Exportar...", command=self.export_restock).place(x=290, y=5)
+        ttk.Label(frame, text=f"Plazo de entrega {cfg.LEAD_TIME_DAYS} días, pedido para {cfg.ORDER_COVER_DAYS} días más, "
+                              f"z = {cfg.SERVICE_LEVEL_Z}").place(x=390, y=9)
+        self.restock_status = ttk.Label(frame, text="")
+        self.restock_status.place(x=10, y=590)
+
+        # The whole report is in memory: pages are slices of its sort order, and rows
+        # are keyed by position, so re-sorting only rewrites the values on screen
+        cols = tuple(RestockReport.COLUMNS)
+        self.restock_table = VirtualTable(frame, cols, fetch=lambda after, n: self.restock.page(after, n) if self.restock else [],
+                                          values=self.restock_values, width=80)
+        for c in cols:
+            self.restock_table.tree.heading(c, command=lambda c=c: self.sort_restock(c))
+        self.restock_table.tree.column("Producto", width=200)
+        self.restock_table.place(x=10, y=40, width=1060, height=540)
+
+        self.load_restock_report()
+
+    def load_restock_report(self, reload=False):
+        if self.defer_load(self.tab_restock, self.load_restock_report):
+            return
+        self.restock_status.config(text="Calculando...")
+        self.jobs.submit("restock", restock_report, self.db, reload, on_done=self.show_restock_report,
+                         on_error=self.on_restock_error)
+
+    def on_restock_error(self, e):
+        self.restock_status.config(text="")
+        messagebox.showerror("Restock", f"No se pudo calcular el pronóstico: {e}")
+
+    def show_restock_report(self, report):
+        if self.restock is not None:
+            # Keep the order the user picked across recalculations
+            report.sort_field, report.descending = self.restock.sort_field, self.restock.descending
+        report.set_filter(self.restock_low_var.get())
+        self.restock = report
+        self.restock_status.config(text=f"{len(report.low)} de {len(report.fields['id'])} productos "
+                                        f"en o bajo su punto de reorden")
+        self.update_restock_headings()
+        self.restock_table.reset()
+
+    def restock_values(self, r):
+        # r: position, id, nombre, sku, stock, avg_7, avg_28, avg_90, demanda, sell-through, cobertura, reorden, sugerido
+        cover = "—" if r[10] == float("inf") else f"{r[10]:.1f}"
+        return (r[1], r[2], r[3], r[4], f"{r[5]:.2f}", f"{r[6]:.2f}", f"{r[7]:.2f}", f"{r[8]:.2f}",
+                f"{r[9]:.0%}", cover, f"{r[11]:.1f}", r[12])
+
+    def sort_restock(self, column):
+        if self.restock is None:
+            return
+        self.restock.sort(RestockReport.COLUMNS[column])
+        self.update_restock_headings()
+        self.restock_table.reset()
+
+    def filter_restock(self):
+        if self.restock is None:
+            return
+        self.restock.set_filter(self.restock_low_var.get())
+        self.restock_table.reset()
+
+    def update_restock_headings(self):
+        for c, field in RestockReport.COLUMNS.items():
+            arrow = (" ▼" if self.restock.descending else " ▲") if field == self.restock.sort_field else ""
+            self.restock_table.tree.heading(c, text=c + arrow)
+
+    def export_restock(self):
+        if self.restock is None:
+            return
+        path = filedialog.asksaveasfilename(parent=self.root, defaultextension=".csv", filetypes=[("CSV", "*.csv")])
+        if not path:
+            return
+        try:
+            with open(path, "w", newline="", encoding="utf-8") as out:
+                n = self.restock.write_csv(out)
+        except OSError as e:
+            messagebox.showerror("Export Error", f"No se pudo exportar: {e}")
+            return
+        messagebox.showinfo("Export", f"{n} filas exportadas a {path}")
+
+    # ---------------------------
+    # Diagnostics Tab (hidden; Ctrl+Shift+D)
+    # ---------------------------
+    DIAG_COLUMNS = ("Llamada", "N", "p50 ms", "p95 ms", "Máx ms", "Filas", "Conexión ms", "Bloqueo ms", "Errores")
+
+    def toggle_diagnostics(self):
+        if self.tab_diagnostics is None:
+            self.tab_diagnostics = ttk.Frame(self.tab_control)
+            self.tab_control.add(self.tab_diagnostics, text="Diagnóstico")
+            self.build_diagnostics_tab()
+        elif self.tab_control.tab(self.tab_diagnostics, "state") == "hidden":
+            self.tab_control.add(self.tab_diagnostics)
+        else:
+            self.tab_control.hide(self.tab_diagnostics)
+            return
+        self.tab_control.select(self.tab_diagnostics)
+        self.refresh_diagnostics()
+
+    def build_diagnostics_tab(self):
+        frame = self.tab_diagnostics
+        self.diag_views = {}
+        # Database calls vs. what the Tk thread spends loading and drawing
+        for group, title, y in (("db", "Consultas (DBHandler)", 5), ("ui", "Carga y render (POSApp / tablas)", 205)):
+            box = ttk.LabelFrame(frame, text=title)
+            box.place(x=10, y=y, width=1060, height=195)
+            tree = ttk.Treeview(box, columns=self.DIAG_COLUMNS, show="headings")
+            for c in self.DIAG_COLUMNS:
+                tree.heading(c, text=c)
+                tree.column(c, width=190 if c == "Llamada" else 55, anchor="w" if c == "Llamada" else "e")
+            tree.place(x=5, y=5, width=680, height=165)
+            canvas = tk.Canvas(box, background="white", highlightthickness=0)
+            canvas.place(x=695, y=5, width=355, height=165)
+            tree.bind("<<TreeviewSelect>>", lambda e, g=group: self.draw_histogram(g))
+            self.diag_views[group] = (tree, canvas)
+
+        slow = ttk.LabelFrame(frame, text=f"Llamadas lentas (> {self.db.cfg.TRACE_SLOW_MS} ms, más recientes primero)")
+        slow.place(x=10, y=405, width=1060, height=150)
+        cols = ("Hora", "Llamada", "ms", "Filas", "Conexión ms", "Bloqueo ms", "Hilo", "Error")
+        self.diag_slow_tree = ttk.Treeview(slow, columns=cols, show="headings")
+        for c, w in zip(cols, (80, 260, 70, 60, 85, 85, 180, 150)):
+            self.diag_slow_tree.heading(c, text=c)
+            self.diag_slow_tree.column(c, width=w)
+        self.diag_slow_tree.place(x=5, y=5, width=1045, height=120)
+
+        ttk.Button(frame, text="Actualizar", command=self.refresh_diagnostics).place(x=10, y=560)
+        ttk.Button(frame, text="Exportar JSONL...", command=lambda: self.export_trace("jsonl")).place(x=110, y=560)
+        ttk.Button(frame, text="Exportar Prometheus...", command=lambda: self.export_trace("prom")).place(x=240, y=560)
+        ttk.Button(frame, text="Limpiar", command=lambda: (TRACE.clear(), self.refresh_diagnostics())).place(x=400, y=560)
+
+    def refresh_diagnostics(self):
+        fmt = lambda v: "" if v is None else f"{v:.1f}"
+        self.diag_stats = {st["name"]: st for st in TRACE.summary()}
+        for group, (tree, canvas) in self.diag_views.items():
+            selected = tree.selection()
+            tree.delete(*tree.get_children())
+            rows = [st for st in self.diag_stats.values() if (st["name"].startswith("DBHandler.")) == (group == "db")]
+            # Slowest first
+            rows.sort(key=lambda st: -(st["p95"] or 0))
+            for st in rows:
+                tree.insert("", tk.END, iid=st["name"], values=(
+                    st["name"], st["count"], fmt(st["p50"]), fmt(st["p95"]), fmt(st["max"]),
+                    st["rows"], f"{st['acquire_ms']:.1f}", f"{st['lock_ms']:.1f}", st["errors"]))
+            keep = [iid for iid in selected if tree.exists(iid)]
+            if keep:
+                tree.selection_set(keep)
+            elif rows:
+                tree.selection_set(rows[0]["name"])
+            self.draw_histogram(group)
+
+        self.diag_slow_tree.delete(*self.diag_slow_tree.get_children())
+        for c in TRACE.recent(self.db.cfg.TRACE_SLOW_MS):
+            self.diag_slow_tree.insert("", tk.END, values=(
+                time.strftime("%H:%M:%S", time.localtime(c["ts"])), c["call"], fmt(c["ms"]), c.get("rows", ""),
+                fmt(c.get("acquire_ms")), fmt(c.get("lock_ms")), c["thread"], c.get("error", "")))
+
+    def draw_histogram(self, group):
+        tree, canvas = self.diag_views[group]
+        canvas.delete("all")
+        sel = tree.selection()
+        st = self.diag_stats.get(sel[0]) if sel else None
+        if not st:
+            return
+        counts = st["buckets"]
+        labels = [f"{b:g}" for b in Tracer.BUCKETS_MS] + ["+"]
+        width, height = 355, 165  # as placed in build_diagnostics_tab
+        bar = width / len(counts)
+        top = max(counts) or 1
+        canvas.create_text(5, 2, anchor="nw", text=f"{st['name']} (ms, ≤ límite)", font="TkSmallCaptionFont")
+        for i, (n, label) in enumerate(zip(counts, labels)):
+            x0 = i * bar + 2
+            h = (height - 40) * n / top
+            canvas.create_rectangle(x0, height - 18 - h, x0 + bar - 4, height - 18,
+                                    fill="#d9534f" if i >= len(counts) - 4 else "#5b9bd5", outline="")
+            if n:
+                canvas.create_text(x0 + bar / 2 - 2, height - 20 - h, anchor="s", text=str(n), font="TkSmallCaptionFont")
+            canvas.create_text(x0 + bar / 2 - 2, height - 2, anchor="s", text=label, font="TkSmallCaptionFont")
+
+    def export_trace(self, fmt):
+        ext = ".jsonl" if fmt == "jsonl" else ".prom"
+        path = filedialog.asksaveasfilename(parent=self.root, defaultextension=ext,
+                                            filetypes=[("JSON lines", "*.jsonl")] if fmt == "jsonl" else [("Prometheus", "*.prom *.txt")])
+        if not path:
+            return
+        try:
+            with open(path, "w", encoding="utf-8") as fh:
+                if fmt == "jsonl":
+                    n = TRACE.write_jsonl(fh)
+                else:
+                    fh.write(TRACE.prometheus())
+                    n = len(TRACE.stats)
+        except OSError as e:
+            messagebox.showerror("Export Error", f"No se pudo exportar: {e}")
+            return
+        messagebox.showinfo("Export", f"{n} {'llamadas' if fmt == 'jsonl' else 'series'} exportadas a {path}")
+
+# Every DBHandler entry point, and the GUI paths that load data or redraw tables
+# (but not the change-feed poll, which would fill the buffer with idle calls)
+trace_methods(DBHandler, lambda name: not name.startswith("_") and name not in ("connect", "close", "get_changes"))
+trace_methods(VirtualTable, lambda name: name in ("_window", "_show"))
+trace_methods(POSApp, lambda name: name.startswith(("load_", "show_", "update_")) or name == "on_cart_change")
 
 # ---------------------------
 # Run application
 # ---------------------------
 def main():
     cfg = DBConfig()
+    parser = argparse.ArgumentParser(description="POS - Miscelanea Don Papu (no command opens the register)")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=cfg.BACKEND,
+                        help="mysql server, or an embedded sqlite file for a single till")
+    parser.add_argument("--sqlite-path", default=cfg.SQLITE_PATH, help="database file for --backend sqlite")
+    sub = parser.add_subparsers(dest="command")
+    sub.add_parser("setup-db", help="add the columns, indexes and rollup tables newer features need")
+    sub.add_parser("create-indexes", help="create the indexes the sales reports rely on")
+    p = sub.add_parser("rebuild-rollup", help="create/recompute the daily sales rollup tables")
+    p.add_argument("--from", dest="start", type=parse_date, help="first day (YYYY-MM-DD), default: first sale")
+    p.add_argument("--to", dest="end", type=parse_date, help="last day, inclusive (default: today)")
+    p = sub.add_parser("export", help="stream sales or products to CSV/Parquet")
+    p.add_argument("kind", choices=sorted(EXPORT_COLUMNS))
+    p.add_argument("--out", default="-", help="output file ('-' = stdout, CSV only)")
+    p.add_argument("--format", choices=["csv", "parquet"], default="csv")
+    p.add_argument("--from", dest="start", type=parse_date, help="first sale day (YYYY-MM-DD)")
+    p.add_argument("--to", dest="end", type=parse_date, help="last sale day, inclusive")
+    p.add_argument("--batch-size", type=int, default=5000)
+    p = sub.add_parser("import-products", help="upsert products by sku from a CSV price list")
+    p.add_argument("file")
+    p.add_argument("--batch-size", type=int, default=cfg.IMPORT_BATCH_SIZE)
+    p.add_argument("--rejects", help="write rejected rows (with the reason) to this CSV")
+    p = sub.add_parser("restock", help="demand forecast and reorder points per product, as CSV")
+    p.add_argument("--out", default="-", help="output file ('-' = stdout)")
+    p.add_argument("--all", action="store_true", help="every product, not only those at or below their reorder point")
+    p.add_argument("--sort", choices=list(RestockReport.COLUMNS.values()), default="cover_days")
+    p.add_argument("--desc", action="store_true")
+    args = parser.parse_args()
+    cfg.BACKEND = args.backend
+    cfg.SQLITE_PATH = args.sqlite_path
+
     db = DBHandler(cfg)
+    if cfg.BACKEND == "sqlite":
+        # An embedded database is ours to set up: create whatever is missing
+        db.report_error = lambda title, msg: print(f"{title}: {msg}", file=sys.stderr)
+        try:
+            db.ensure_schema()
+        except (db.backend.Error, PoolTimeout) as e:
+            sys.exit(f"DB Error: Cannot connect to database: {e}")
+    if args.command:
+        # Command-line tools: errors go to stderr instead of dialogs
+        db.report_error = lambda title, msg: print(f"{title}: {msg}", file=sys.stderr)
+        try:
+            if args.command == "setup-db":
+                created = db.ensure_schema()
+                print("Created: " + ", ".join(created) if created else "Schema is up to date")
+                print("Run 'rebuild-rollup' once to backfill the rollup tables from existing sales")
+            elif args.command == "create-indexes":
+                created = db.ensure_indexes()
+                print("Created: " + ", ".join(created) if created else "All report indexes already exist")
+            elif args.command == "rebuild-rollup":
+                end = args.end + timedelta(days=1) if args.end else None
+                days = db.rebuild_rollup(args.start, end, progress=lambda a, b: print(f"  {a} .. {b - timedelta(days=1)}"))
+                print(f"Rollup rebuilt for {days} days")
+            elif args.command == "export":
+                if args.format == "parquet" and args.out == "-":
+                    parser.error("--format parquet needs --out FILE")
+                end = args.end + timedelta(days=1) if args.end else None
+                n = export_data(db, args.kind, args.format, args.out, args.start, end, args.batch_size)
+                print(f"{n} rows exported", file=sys.stderr)
+            elif args.command == "import-products":
+                res = import_products_csv(db, args.file, args.batch_size,
+                                          progress=lambda read, rej: print(f"  {read} read, {rej} rejected", file=sys.stderr))
+                print(f"{res['written']}/{res['read']} rows written in {res['seconds']:.2f}s "
+                      f"({res['read'] / max(res['seconds'], 1e-9):.0f} rows/s), {len(res['rejected'])} rejected")
+                if args.rejects and res["rejected"]:
+                    write_rejects(args.rejects, res["rejected"])
+            elif args.command == "restock":
+                t0 = time.perf_counter()
+                report = restock_report(db)
+                report.set_filter(not args.all)
+                report.sort(args.sort, args.desc)
+                out = sys.stdout if args.out == "-" else open(args.out, "w", newline="", encoding="utf-8")
+                try:
+                    n = report.write_csv(out)
+                finally:
+                    if out is not sys.stdout:
+                        out.close()
+                print(f"{n} products ({len(report.low)} at or below reorder point) in {time.perf_counter() - t0:.2f}s",
+                      file=sys.stderr)
+        except (db.backend.Error, PoolTimeout) as e:
+            # Exit status 1, so scripts and cron jobs see the failure
+            sys.exit(f"DB Error: {e}")
+        finally:
+            db.close()
+        return
+
     root = tk.Tk()
     app = POSApp(root, db)
-    root.mainloop()
+    try:
+        root.mainloop()
+    finally:
+        app.close()
+        db.close()
 
 if __name__ == "__main__":
     main()
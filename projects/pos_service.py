@@ -0,0 +1,449 @@
+"""
+Headless sales service: the catalog, sales and reports of pos.py over
+HTTP/JSON, for web/mobile tills and servers without a display.
+
+    python pos_service.py --port 8080
+    python pos_service.py --backend sqlite --sqlite-path pos.sqlite3 --port 8080
+
+    GET  /health
+    GET  /products?after=<id>&limit=<n>      keyset page, in id order
+    GET  /products/<id>
+    GET  /products/sku/<sku>
+    GET  /products/search?q=<text>&limit=<n>
+    POST /sales    {"items": [{"id_producto": 1, "cantidad": 2, "precio_unitario": "16.00"}],
+                    "idempotency_key": "optional, at most 36 chars"}  -> 201 {"id_venta": n}
+    GET  /reports/summary?period=day|week|month&from=YYYY-MM-DD&to=YYYY-MM-DD
+    GET  /reports/top?from=YYYY-MM-DD&to=YYYY-MM-DD&limit=<n>
+    GET  /metrics                             Prometheus text (call tracing + service counters)
+
+precio_unitario defaults to the catalog's precio_venta; report ranges include
+`to` and default to what the Reports tab shows. Errors come back as
+{"error": "..."}: 400 bad request, 404 unknown product or route, 409 out of
+stock, 503 database unreachable or service overloaded (with Retry-After).
+
+Each sale is not its own transaction: requests are queued and a few writer
+tasks book them in batches with DBHandler.book_sales, so one commit covers
+many sales. The queue and the number of requests in flight are bounded;
+past that the service answers 503 at once rather than letting latency grow.
+
+The catalog is served from memory and kept current by following the
+producto_cambio change feed; without it (before setup-db) it is reloaded
+every --catalog-refresh seconds.
+"""
+import argparse
+import asyncio
+import json
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, datetime, timedelta
+from decimal import Decimal, InvalidOperation
+from urllib.parse import parse_qs, unquote, urlsplit
+
+from pos import (BACKENDS, TRACE, ChangeFeed, DBConfig, DBError, DBHandler, Money, PoolTimeout, SchemaError, StockError,
+                 default_range, is_connection_error, parse_date, raise_error)
+
+PRODUCT_FIELDS = ("id_producto", "nombre", "precio_compra", "precio_venta", "cantidad", "sku")
+SUMMARY_FIELDS = ("periodo", "ventas", "unidades", "ingreso", "costo", "margen")
+TOP_FIELDS = ("id_producto", "nombre", "unidades", "ingreso", "margen")
+REASONS = {200: "OK", 201: "Created", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+           409: "Conflict", 413: "Payload Too Large", 500: "Internal Server Error", 503: "Service Unavailable"}
+MONEY_FIELDS = {"precio_compra", "precio_venta", "ingreso", "costo", "margen"}
+MAX_PRICE = Money.of("99999999.99")       # precio_unitario DECIMAL(10,2)
+MAX_SUBTOTAL = Money.of("9999999999.99")   # subtotal DECIMAL(12,2)
+MAX_BODY = 1 << 20
+MAX_LIMIT = 1000
+
+class Overloaded(Exception):
+    """The sale queue or the request limit is full; the client should retry shortly."""
+
+class HTTPError(Exception):
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def record(fields, row):
+    """Row tuple -> JSON object; money as 2-decimal strings."""
+    return {f: Money.of(v) if f in MONEY_FIELDS and v is not None else v for f, v in zip(fields, row)}
+
+def to_json(value):
+    if isinstance(value, (Decimal, Money)):
+        return str(value)
+    if isinstance(value, (date, datetime)):
+        return value.isoformat()
+    raise TypeError(f"{type(value).__name__} is not JSON serializable")
+
+# ---------------------------
+# Async DB layer
+# ---------------------------
+class AsyncDB:
+    """
+    DBHandler for coroutines. Blocking calls run on one worker thread per
+    pooled connection, so they queue here instead of timing out in the pool.
+    """
+    def __init__(self, db):
+        self.db = db
+        self._executor = ThreadPoolExecutor(max_workers=db.cfg.POOL_SIZE, thread_name_prefix="db")
+
+    async def call(self, fn, *args):
+        return await asyncio.get_running_loop().run_in_executor(self._executor, fn, *args)
+
+    def close(self):
+        self._executor.shutdown(wait=True)
+        self.db.close()
+
+class SaleBatcher:
+    """
+    Books the sales of concurrent requests max_batch at a time. A writer takes
+    whatever is queued, waits up to `linger` seconds for more while the batch
+    is not full, and books it with one DBHandler.book_sales call.
+    """
+    def __init__(self, adb, writers=2, max_batch=64, linger=0.001, max_queue=1000):
+        self.adb = adb
+        self.writers = writers
+        self.max_batch = max_batch
+        self.linger = linger
+        self.queue = asyncio.Queue(max_queue)
+        self.stats = {"sales": 0, "batches": 0, "rejected": 0, "fallbacks": 0}
+        self._tasks = []
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._writer()) for _ in range(self.writers)]
+
+    async def stop(self):
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+
+    async def book(self, sale):
+        """Sale id, or the exception book_sale would have raised for it."""
+        fut = asyncio.get_running_loop().create_future()
+        try:
+            self.queue.put_nowait((sale, fut))
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            raise Overloaded("Demasiadas ventas en espera")
+        return await fut
+
+    async def _writer(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = loop.time() + self.linger
+            while len(batch) < self.max_batch:
+                if not self.queue.empty():
+                    batch.append(self.queue.get_nowait())
+                    continue
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), remaining))
+                except asyncio.TimeoutError:
+                    break
+            await self._book(batch)
+
+    async def _book(self, batch):
+        sales = [sale for sale, _ in batch]
+        try:
+            results = await self.adb.call(self.adb.db.book_sales, sales)
+        except Exception as e:
+            if len(batch) == 1 or is_connection_error(e):
+                results = [e] * len(batch)
+            else:
+                # One sale can sink the batch (e.g. a key another till booked
+                # meanwhile): book them one by one so only that one fails
+                self.stats["fallbacks"] += 1
+                results = []
+                for sale in sales:
+                    try:
+                        results.append(await self.adb.call(self.adb.db.book_sale, sale["items"],
+                                                           sale.get("idempotency_key")))
+                    except Exception as e:
+                        results.append(e)
+        self.stats["batches"] += 1
+        self.stats["sales"] += len(batch)
+        for (_, fut), res in zip(batch, results):
+            if fut.done():  # the client went away
+                continue
+            if isinstance(res, Exception):
+                fut.set_exception(res)
+            else:
+                fut.set_result(res)
+
+# ---------------------------
+# HTTP/JSON API
+# ---------------------------
+class SalesService:
+    def __init__(self, adb, batcher, max_inflight=2000):
+        self.adb = adb
+        self.db = adb.db
+        self.batcher = batcher
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self.stats = {"requests": 0, "overloaded": 0, "errors": 0}
+
+    async def handle(self, reader, writer):
+        """One client connection: HTTP/1.1 requests with keep-alive, answered in order."""
+        try:
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                keep_alive = True
+                try:
+                    method, target, version = line.decode("latin-1").split()
+                    headers = {}
+                    while True:
+                        line = await reader.readline()
+                        if line in (b"\r\n", b"\n", b""):
+                            break
+                        name, _, value = line.decode("latin-1").partition(":")
+                        headers[name.strip().lower()] = value.strip()
+                    length = int(headers.get("content-length") or 0)
+                    if length > MAX_BODY:
+                        raise HTTPError(413, "Cuerpo demasiado grande")
+                    body = await reader.readexactly(length) if length else b""
+                    keep_alive = version == "HTTP/1.1" and headers.get("connection", "").lower() != "close"
+                    status, payload, extra = await self.respond(method, target, body)
+                except HTTPError as e:
+                    keep_alive = False
+                    status, payload, extra = e.status, {"error": str(e)}, {}
+                except ValueError:
+                    keep_alive = False
+                    status, payload, extra = 400, {"error": "Solicitud HTTP inválida"}, {}
+                if isinstance(payload, str):
+                    data, ctype = payload.encode(), "text/plain; version=0.0.4"
+                else:
+                    data, ctype = json.dumps(payload, default=to_json).encode(), "application/json"
+                head = [f"HTTP/1.1 {status} {REASONS.get(status, '')}", f"Content-Type: {ctype}",
+                        f"Content-Length: {len(data)}"]
+                head += [f"{k}: {v}" for k, v in extra.items()]
+                if not keep_alive:
+                    head.append("Connection: close")
+                writer.write(("\r\n".join(head) + "\r\n\r\n").encode("latin-1") + data)
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.LimitOverrunError):
+            pass
+        finally:
+            writer.close()
+
+    async def respond(self, method, target, body):
+        """(status, JSON-able payload or Prometheus text, extra headers)"""
+        self.stats["requests"] += 1
+        if self.inflight >= self.max_inflight:
+            self.stats["overloaded"] += 1
+            return 503, {"error": "Servicio saturado, reintente"}, {"Retry-After": "1"}
+        self.inflight += 1
+        try:
+            return await self.route(method, target, body)
+        except HTTPError as e:
+            return e.status, {"error": str(e)}, {}
+        except Overloaded as e:
+            self.stats["overloaded"] += 1
+            return 503, {"error": str(e)}, {"Retry-After": "1"}
+        except StockError as e:
+            return 409, {"error": str(e)}, {}
+        except (ValueError, KeyError, TypeError) as e:
+            return 400, {"error": f"Solicitud inválida: {e}"}, {}
+        except Exception as e:
+            self.stats["errors"] += 1
+            if isinstance(e, (DBError, PoolTimeout)) or is_connection_error(e):
+                return 503, {"error": f"Base de datos no disponible: {e}"}, {"Retry-After": "5"}
+            if self.db.backend.is_retryable(e):
+                # Still contended after DBHandler's own retries
+                return 503, {"error": f"Base de datos ocupada: {e}"}, {"Retry-After": "1"}
+            if isinstance(e, SchemaError):
+                return 500, {"error": str(e)}, {}
+            return 500, {"error": f"{type(e).__name__}: {e}"}, {}
+        finally:
+            self.inflight -= 1
+
+    async def route(self, method, target, body):
+        url = urlsplit(target)
+        path = [unquote(p) for p in url.path.strip("/").split("/") if p]
+        query = {k: v[-1] for k, v in parse_qs(url.query).items()}
+        if method == "POST" and path == ["sales"]:
+            sale_id = await self.batcher.book(self.parse_sale(body))
+            return 201, {"id_venta": sale_id}, {}
+        if method != "GET":
+            raise HTTPError(405 if path == ["sales"] else 404, "Ruta no encontrada")
+
+        if path == ["health"]:
+            return 200, {"ok": True, "catalog": self.db.catalog.loaded, "queue": self.batcher.queue.qsize(),
+                         "inflight": self.inflight, "pool": self.db.pool_stats(), "sales": self.batcher.stats}, {}
+        if path == ["metrics"]:
+            return 200, TRACE.prometheus() + self.metrics(), {}
+        if path and path[0] == "products":
+            return 200, await self.products(path[1:], query), {}
+        if path == ["reports", "summary"]:
+            period = query.get("period", "day")
+            if period not in ("day", "week", "month"):
+                raise ValueError("period: day, week o month")
+            start, end = self.report_range(period, query)
+            rows = await self.adb.call(self.db.get_sales_summary, period, start, end)
+            return 200, [record(SUMMARY_FIELDS, r) for r in rows], {}
+        if path == ["reports", "top"]:
+            start, end = self.report_range("day", query)
+            rows = await self.adb.call(self.db.get_top_products, start, end, self.limit(query, 20))
+            return 200, [record(TOP_FIELDS, r) for r in rows], {}
+        raise HTTPError(404, "Ruta no encontrada")
+
+    async def products(self, path, query):
+        catalog = self.db.catalog
+        if not catalog.loaded:
+            await self.adb.call(self.db.get_all_products)
+        if not path:
+            after = int(query["after"]) if "after" in query else None
+            rows = catalog.page(after, self.limit(query, 200))
+            if rows is None:
+                rows = await self.adb.call(self.db.get_products_page, after, self.limit(query, 200))
+            return [record(PRODUCT_FIELDS, r) for r in rows]
+        if path == ["search"]:
+            rows = catalog.search(query.get("q", ""), self.limit(query, 20)) or []
+            return [record(PRODUCT_FIELDS, r) for r in rows]
+        if len(path) == 2 and path[0] == "sku":
+            row = catalog.get_by_sku(path[1])
+        elif len(path) == 1:
+            row = catalog.get(int(path[0]))
+        else:
+            raise HTTPError(404, "Ruta no encontrada")
+        if row is None:
+            raise HTTPError(404, "Producto no encontrado")
+        return record(PRODUCT_FIELDS, row)
+
+    def parse_sale(self, body):
+        data = json.loads(body or b"null")
+        if not isinstance(data, dict) or not isinstance(data.get("items"), list) or not data["items"]:
+            raise ValueError("items debe ser una lista de productos")
+        items = []
+        for it in data["items"]:
+            if not isinstance(it, dict):
+                raise ValueError("cada item debe ser un objeto")
+            idp, qty = it.get("id_producto"), it.get("cantidad")
+            # JSON integers only: int() would truncate 2.9 and accept "2" or true
+            if type(idp) is not int:
+                raise ValueError(f"id_producto debe ser un entero: {idp!r}")
+            if type(qty) is not int:
+                raise ValueError(f"cantidad debe ser un entero (producto {idp}): {qty!r}")
+            if qty <= 0:
+                raise ValueError(f"cantidad debe ser positiva (producto {idp})")
+            price = it.get("precio_unitario")
+            if price is None:
+                row = self.db.catalog.get(idp)
+                if row is None:
+                    raise StockError(f"Producto ID {idp} no existe")
+                price = row[3]
+            elif type(price) not in (str, int, float):
+                # bool is an int to Money.of(): true would be 1.00
+                raise ValueError(f"precio_unitario inválido (producto {idp}): {price!r}")
+            try:
+                price = Money.of(price)
+            except (InvalidOperation, TypeError):
+                raise ValueError(f"precio_unitario inválido (producto {idp}): {price!r}") from None
+            if price.cents < 0 or price > MAX_PRICE or price * qty > MAX_SUBTOTAL:
+                raise ValueError(f"precio_unitario fuera de rango (producto {idp}): {price}")
+            items.append({"id_producto": idp, "cantidad": qty, "precio_unitario": price})
+        key = data.get("idempotency_key")
+        if key is not None and not (isinstance(key, str) and 0 < len(key) <= 36):
+            raise ValueError("idempotency_key: texto de 1 a 36 caracteres")
+        return {"items": items, "idempotency_key": key}
+
+    @staticmethod
+    def report_range(period, query):
+        """[start, end) from the inclusive from/to parameters."""
+        start, end = default_range(period, date.today())
+        if "from" in query:
+            start = parse_date(query["from"])
+        if "to" in query:
+            end = parse_date(query["to"]) + timedelta(days=1)
+        return start, end
+
+    @staticmethod
+    def limit(query, default):
+        return max(1, min(MAX_LIMIT, int(query.get("limit", default))))
+
+    def metrics(self):
+        lines = []
+        counters = [("pos_service_requests_total", self.stats["requests"]),
+                    ("pos_service_overloaded_total", self.stats["overloaded"]),
+                    ("pos_service_errors_total", self.stats["errors"]),
+                    ("pos_service_sales_total", self.batcher.stats["sales"]),
+                    ("pos_service_sale_batches_total", self.batcher.stats["batches"])]
+        for name, value in counters:
+            lines += [f"# TYPE {name} counter", f"{name} {value}"]
+        for name, value in (("pos_service_sale_queue", self.batcher.queue.qsize()),
+                            ("pos_service_inflight", self.inflight)):
+            lines += [f"# TYPE {name} gauge", f"{name} {value}"]
+        return "\n".join(lines) + "\n"
+
+# ---------------------------
+# Run service
+# ---------------------------
+async def refresh_catalog(adb, interval):
+    """Picks up what other tills and the back office changed, every `interval` seconds (no change feed)."""
+    while True:
+        await asyncio.sleep(interval)
+        try:
+            await adb.call(adb.db.get_all_products, True)
+        except Exception as e:
+            print(f"Catalog refresh failed: {e}", file=sys.stderr)
+
+async def serve(args, cfg):
+    db = DBHandler(cfg)
+    db.report_error = raise_error
+    if cfg.BACKEND == "sqlite":
+        db.ensure_schema()
+    adb = AsyncDB(db)
+    batcher = SaleBatcher(adb, args.writers, args.max_batch, args.linger_ms / 1000, args.max_queue)
+    service = SalesService(adb, batcher, args.max_inflight)
+    feed = ChangeFeed(db, interval=cfg.CHANGE_FEED_INTERVAL, retention=cfg.CHANGE_FEED_RETENTION)
+    refresher = None
+    if await adb.call(db.has_change_feed):
+        # Position the feed before reading the catalog, so no change falls in between
+        await adb.call(feed.position)
+        feed.start()
+    else:
+        refresher = asyncio.create_task(refresh_catalog(adb, args.catalog_refresh))
+    await adb.call(db.get_all_products)
+    batcher.start()
+    server = await asyncio.start_server(service.handle, args.host, args.port, backlog=1024)
+    print(f"Listening on http://{args.host}:{args.port} ({cfg.BACKEND})", file=sys.stderr)
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        if refresher:
+            refresher.cancel()
+        feed.stop()
+        await batcher.stop()
+        adb.close()
+
+def main():
+    cfg = DBConfig()
+    parser = argparse.ArgumentParser(description="POS headless sales service (HTTP/JSON)")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default=cfg.BACKEND)
+    parser.add_argument("--database", default=cfg.DATABASE, help="MySQL database for --backend mysql")
+    parser.add_argument("--sqlite-path", default=cfg.SQLITE_PATH, help="database file for --backend sqlite")
+    parser.add_argument("--writers", type=int, default=2, help="concurrent sale batches (each holds a connection)")
+    parser.add_argument("--max-batch", type=int, default=64, help="sales per transaction")
+    parser.add_argument("--linger-ms", type=float, default=1.0, help="wait for more sales before booking a short batch")
+    parser.add_argument("--max-queue", type=int, default=1000, help="queued sales before answering 503")
+    parser.add_argument("--max-inflight", type=int, default=2000, help="requests in progress before answering 503")
+    parser.add_argument("--catalog-refresh", type=float, default=60.0, help="seconds between catalog reloads, without a change feed")
+    args = parser.parse_args()
+    cfg.BACKEND = args.backend
+    cfg.DATABASE = args.database
+    cfg.SQLITE_PATH = args.sqlite_path
+    # Writers and report/lookup calls each need a connection
+    cfg.POOL_SIZE = max(cfg.POOL_SIZE, args.writers + 2)
+    try:
+        asyncio.run(serve(args, cfg))
+    except KeyboardInterrupt:
+        pass
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+"""
+DBHandler, the offline journal and the change feed against throwaway SQLite
+databases (no MySQL needed). Run with: python -m unittest (or pytest) from
+this directory.
+"""
+import os
+import tempfile
+import unittest
+from decimal import Decimal
+
+from pos import ChangeFeed, DBConfig, DBHandler, Money, SaleJournal, SaleSyncer, StockError
+
+def sqlite_db(tmp, name="pos.sqlite3"):
+    cfg = DBConfig()
+    cfg.BACKEND = "sqlite"
+    cfg.SQLITE_PATH = os.path.join(tmp, name)
+    db = DBHandler(cfg)
+    db.report_error = lambda title, msg: None
+    db.ensure_schema()
+    return db
+
+class SQLiteTestCase(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = sqlite_db(self.tmp.name)
+        # (nombre, categoria, precio_compra, precio_venta, cantidad, sku)
+        self.db.add_product("Café", "bebidas", Decimal("5.00"), Decimal("8.50"), 10, "C1")
+        self.db.add_product("Pan", "panadería", Decimal("0.40"), Decimal("0.75"), 3, "P1")
+
+    def tearDown(self):
+        self.db.close()
+        self.tmp.cleanup()
+
+    def stock(self, idp, db=None):
+        return (db or self.db).get_product_by_id(idp)[4]
+
+    def sale_count(self):
+        con = self.db.connect()
+        try:
+            cur = con.cursor()
+            cur.execute("SELECT COUNT(*) FROM venta")
+            return cur.fetchone()[0]
+        finally:
+            con.close()
+
+def line(idp, qty, price="1.00"):
+    return {"id_producto": idp, "cantidad": qty, "precio_unitario": price}
+
+class BookSaleTest(SQLiteTestCase):
+    def test_sale_deducts_stock(self):
+        sale_id = self.db.book_sale([line(1, 2, Money.of("8.50")), line(2, 1, "0.75")])
+        self.assertIsNotNone(sale_id)
+        self.assertEqual((self.stock(1), self.stock(2)), (8, 2))
+        summary = self.db.get_sales_summary("day", *self.all_time())
+        self.assertEqual(summary[0][3], Money.of("17.75"))
+
+    def test_insufficient_stock_books_nothing(self):
+        with self.assertRaises(StockError):
+            self.db.book_sale([line(1, 1), line(2, 4)])
+        self.assertEqual((self.stock(1), self.stock(2)), (10, 3))
+        self.assertEqual(self.sale_count(), 0)
+
+    def test_unknown_product(self):
+        with self.assertRaises(StockError):
+            self.db.book_sale([line(99, 1)])
+
+    def test_batch_isolates_the_failing_sale(self):
+        results = self.db.book_sales([{"items": [line(1, 2)]},
+                                      {"items": [line(1, 1), line(2, 5)]},
+                                      {"items": [line(2, 3)]}])
+        self.assertIsInstance(results[0], int)
+        self.assertIsInstance(results[1], StockError)
+        self.assertIsInstance(results[2], int)
+        # The failed sale's first line was rolled back with it
+        self.assertEqual((self.stock(1), self.stock(2)), (8, 0))
+        self.assertEqual(self.sale_count(), 2)
+
+    def test_idempotency_key_books_once(self):
+        first = self.db.book_sale([line(1, 1)], idempotency_key="k-1")
+        again = self.db.book_sale([line(1, 1)], idempotency_key="k-1")
+        self.assertEqual(first, again)
+        self.assertEqual(self.stock(1), 9)
+
+    @staticmethod
+    def all_time():
+        from datetime import date
+        return date(2000, 1, 1), date(2100, 1, 1)
+
+class JournalSyncTest(SQLiteTestCase):
+    def setUp(self):
+        super().setUp()
+        self.journal = SaleJournal(os.path.join(self.tmp.name, "journal.db"))
+        self.syncer = SaleSyncer(self.db, self.journal)
+
+    def tearDown(self):
+        self.journal.close()
+        super().tearDown()
+
+    def test_replays_pending_sales(self):
+        self.journal.append([line(1, 2, Money.of("8.50"))])
+        self.assertTrue(self.syncer.sync_once())
+        self.assertEqual(self.journal.counts(), {"sincronizada": 1})
+        self.assertEqual(self.stock(1), 8)
+
+    def test_sale_that_no_longer_fits_is_a_conflict(self):
+        self.journal.append([line(2, 2)])
+        self.syncer.sync_once()
+        self.db.book_sale([line(2, 1)])  # another till sold the rest meanwhile
+        late = self.journal.append([line(2, 1)])
+        self.journal.append([line(1, 1)])
+        self.syncer.sync_once()
+        self.assertEqual(self.journal.counts(), {"sincronizada": 2, "conflicto": 1})
+        [(key, _, items, error)] = self.journal.conflicts()
+        self.assertEqual(key, late)
+        self.assertIn("Stock insuficiente", error)
+        # Later sales still went through, and nothing went negative
+        self.assertEqual((self.stock(1), self.stock(2)), (9, 0))
+
+    def test_replay_after_a_lost_reply_books_once(self):
+        key = self.journal.append([line(1, 1)])
+        self.db.book_sale([line(1, 1)], idempotency_key=key)  # booked, but the reply never came
+        self.syncer.sync_once()
+        self.assertEqual(self.journal.counts(), {"sincronizada": 1})
+        self.assertEqual(self.stock(1), 9)
+
+class ChangeFeedTest(SQLiteTestCase):
+    """Two registers on one database: `other` writes, self.db follows the feed."""
+    def setUp(self):
+        super().setUp()
+        self.other = DBHandler(self.db.cfg)
+        self.other.report_error = self.db.report_error
+        self.changes = []
+        self.feed = ChangeFeed(self.db, on_change=self.changes.append)
+        self.feed.position()
+        self.db.get_all_products()
+
+    def tearDown(self):
+        self.other.close()
+        super().tearDown()
+
+    def test_first_poll_keeps_a_positioned_catalog(self):
+        self.assertEqual(self.feed.poll_once(), 0)
+        self.assertTrue(self.db.catalog.loaded)
+        self.assertEqual(self.changes, [])
+
+    def test_stock_change_is_patched(self):
+        self.other.book_sale([line(1, 4)])
+        self.assertEqual(self.feed.poll_once(), 1)
+        self.assertEqual(self.changes, [{1}])
+        self.assertEqual(self.db.catalog.get(1)[4], 6)
+
+    def test_product_update_and_delete(self):
+        self.other.update_product(2, "Pan integral", Decimal("0.50"), Decimal("0.90"), 3)
+        self.other.add_product("Té", "bebidas", Decimal("1.00"), Decimal("2.00"), 5, "T1")
+        self.feed.poll_once()
+        self.assertEqual(self.db.catalog.get(2)[1], "Pan integral")
+        self.assertEqual(self.db.catalog.get(2)[3], Decimal("0.90"))
+        self.assertEqual(self.db.catalog.get_by_sku("T1")[1], "Té")
+        self.other.delete_product(2)
+        self.feed.poll_once()
+        self.assertIsNone(self.db.catalog.get(2))
+        self.assertTrue(self.db.catalog.loaded)
+
+    def test_unloaded_catalog_is_not_patched(self):
+        self.db.catalog.invalidate()
+        self.other.update_product(2, "Pan integral", Decimal("0.50"), Decimal("0.90"), 3)
+        self.feed.poll_once()
+        self.assertEqual(self.changes, [{2}])
+        self.assertEqual(self.db.catalog.get(2)[1], "Pan")  # left as read; views go to the database
+
+class UpsertProductsTest(SQLiteTestCase):
+    def test_existing_sku_keeps_its_stock(self):
+        self.db.book_sale([line(1, 4)])
+        failed = self.db.upsert_products([
+            ("Café molido", "bebidas", Decimal("5.50"), Decimal("9.00"), 100, "C1"),
+            ("Leche", "lácteos", Decimal("0.80"), Decimal("1.20"), 12, "L1"),
+        ])
+        self.assertEqual(failed, [])
+        cafe = self.db.get_product_by_id(1)
+        self.assertEqual((cafe[1], cafe[3], cafe[4]), ("Café molido", Decimal("9.00"), 6))
+        leche = self.db.catalog.get_by_sku("L1")
+        self.assertEqual(self.stock(leche[0]), 12)
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,90 @@
+"""
+pos_service request validation against a throwaway SQLite database.
+Run with: python -m unittest (or pytest) from this directory.
+"""
+import asyncio
+import json
+import tempfile
+import unittest
+from decimal import Decimal
+
+from pos import Money
+from pos_service import AsyncDB, SaleBatcher, SalesService
+from test_pos import sqlite_db
+
+class ParseSaleTest(unittest.TestCase):
+    def setUp(self):
+        self.tmp = tempfile.TemporaryDirectory()
+        self.db = sqlite_db(self.tmp.name)
+        self.db.add_product("Café", "bebidas", Decimal("5.00"), Decimal("8.50"), 10, "C1")
+        self.db.get_all_products()
+        self.adb = AsyncDB(self.db)
+        self.service = SalesService(self.adb, SaleBatcher(self.adb))  # not started: nothing gets booked
+
+    def tearDown(self):
+        self.adb.close()
+        self.tmp.cleanup()
+
+    def parse(self, **item):
+        line = {"id_producto": 1, "cantidad": 1}
+        line.update(item)
+        return self.service.parse_sale(json.dumps({"items": [line]}).encode())
+
+    def assert_rejected(self, **item):
+        with self.assertRaises(ValueError):
+            self.parse(**item)
+        line = {"id_producto": 1, "cantidad": 1}
+        line.update(item)
+        body = json.dumps({"items": [line]}).encode()
+        status, payload, _ = asyncio.run(self.service.respond("POST", "/sales", body))
+        self.assertEqual(status, 400, payload)
+
+    def test_valid_sale(self):
+        sale = self.parse(cantidad=2, precio_unitario="8.50")
+        self.assertEqual(sale["items"], [{"id_producto": 1, "cantidad": 2, "precio_unitario": Money.of("8.50")}])
+
+    def test_price_defaults_to_catalog(self):
+        self.assertEqual(self.parse()["items"][0]["precio_unitario"], Money.of("8.50"))
+
+    def test_fractional_quantity(self):
+        self.assert_rejected(cantidad=2.9)
+
+    def test_quantity_as_text(self):
+        self.assert_rejected(cantidad="2")
+
+    def test_quantity_as_bool(self):
+        self.assert_rejected(cantidad=True)
+
+    def test_non_positive_quantity(self):
+        self.assert_rejected(cantidad=0)
+
+    def test_product_id_as_text(self):
+        self.assert_rejected(id_producto="1")
+
+    def test_product_id_as_float(self):
+        self.assert_rejected(id_producto=1.0)
+
+    def test_product_id_as_bool(self):
+        self.assert_rejected(id_producto=True)
+
+    def test_price_as_bool(self):
+        self.assert_rejected(precio_unitario=True)
+
+    def test_price_as_list(self):
+        self.assert_rejected(precio_unitario=[1])
+
+    def test_price_not_a_number(self):
+        self.assert_rejected(precio_unitario="x")
+
+    def test_negative_price(self):
+        self.assert_rejected(precio_unitario="-5")
+
+    def test_price_beyond_column(self):
+        self.assert_rejected(precio_unitario=1e30)
+
+    def test_item_not_an_object(self):
+        with self.assertRaises(ValueError):
+            self.service.parse_sale(b'{"items": [1]}')
+
+if __name__ == "__main__":
+    unittest.main()